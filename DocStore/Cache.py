@@ -0,0 +1,292 @@
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import bson
+from bson import Binary
+from pymongo.collection import Collection
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int) -> None:
+        """
+        An in-process least recently used cache of byte strings, bounded by the total size of the stored values.
+        Every entry carries its own expiry time.
+        :param max_bytes: The maximum total size of all stored values.
+        """
+        self.__max_bytes = max_bytes
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a value, if it is cached and not expired.
+        :param key: The key.
+        :return: The value, or None.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                self.__remove(key)
+                return None
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        """
+        Store a value, evicting the least recently used entries if the cache is full. Values larger than the whole
+        cache are not stored.
+        :param key: The key.
+        :param value: The value.
+        :param expires_at: Epoch time after which the value is no longer returned.
+        """
+        if len(value) > self.__max_bytes:
+            return
+        with self.__lock:
+            self.__remove(key)
+            self.__entries[key] = (value, expires_at)
+            self.__size += len(value)
+            while self.__size > self.__max_bytes:
+                self.__remove(next(iter(self.__entries)))
+
+    def delete(self, key: str) -> None:
+        """
+        Remove a value.
+        :param key: The key.
+        """
+        with self.__lock:
+            self.__remove(key)
+
+    def size(self) -> int:
+        """
+        :return: The total size of all stored values.
+        """
+        return self.__size
+
+    def __remove(self, key: str) -> None:
+        """
+        Remove an entry. Must be called while holding the lock.
+        :param key: The key.
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__size -= len(entry[0])
+
+
+class MongoCacheBackend:
+    def __init__(self, collection: Collection) -> None:
+        """
+        A cache shared by all workers, stored in a MongoDB collection with a TTL index.
+        :param collection: The collection to store the cache entries in.
+        """
+        self.__collection = collection
+        self.__collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a value, if it is cached and not expired.
+        :param key: The key.
+        :return: The value, or None.
+        """
+        entry = self.__collection.find_one({"_id": key, "expires_at": {"$gt": datetime.datetime.utcnow()}})
+        return bytes(entry["value"]) if entry else None
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        """
+        Store a value.
+        :param key: The key.
+        :param value: The value.
+        :param expires_at: Epoch time after which the value is no longer returned.
+        """
+        self.__collection.replace_one({"_id": key},
+                                      {"value": Binary(value),
+                                       "expires_at": datetime.datetime.utcfromtimestamp(expires_at)},
+                                      upsert=True)
+
+    def delete(self, key: str) -> None:
+        """
+        Remove a value.
+        :param key: The key.
+        """
+        self.__collection.delete_one({"_id": key})
+
+
+class RedisCacheBackend:
+    def __init__(self, url: str) -> None:
+        """
+        A cache shared by all workers, stored in Redis (or any server speaking the Redis protocol).
+        Requires the redis package.
+        :param url: The URL of the server, e.g. redis://localhost:6379/0.
+        """
+        import redis
+        self.__client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a value, if it is cached and not expired.
+        :param key: The key.
+        :return: The value, or None.
+        """
+        return self.__client.get(key)
+
+    def set(self, key: str, value: bytes, expires_at: float) -> None:
+        """
+        Store a value.
+        :param key: The key.
+        :param value: The value.
+        :param expires_at: Epoch time after which the value is no longer returned.
+        """
+        self.__client.set(key, value, exat=int(expires_at))
+
+    def delete(self, key: str) -> None:
+        """
+        Remove a value.
+        :param key: The key.
+        """
+        self.__client.delete(key)
+
+
+class ReportCache:
+    def __init__(self, max_bytes: int, allow_updates_every_n_seconds: int, shared_backend=None,
+                 min_ttl: int = 30) -> None:
+        """
+        Caches stored reports in front of the database. Reports are kept in an in-process LRU cache and, optionally, a
+        backend shared by all workers (MongoCacheBackend or RedisCacheBackend).
+        A report is cached until it may be refreshed from FFLogs (loaded_at + the update cadence), but at least for
+        min_ttl seconds. Writes to a report must invalidate it.
+        :param max_bytes: The maximum total size of the reports in the in-process cache.
+        :param allow_updates_every_n_seconds: The minimum time between updates to a report from the FFLogs API.
+        :param shared_backend: The optional shared cache.
+        :param min_ttl: The minimum time in seconds a report is cached for. Invalidation only reaches the in-process
+        cache of the writing worker (and the shared backend), so other workers may serve a report from their
+        in-process cache for up to this long after it was refreshed.
+        """
+        self.__local = LRUCache(max_bytes)
+        self.__shared = shared_backend
+        self.__allow_updates_every_n_seconds = allow_updates_every_n_seconds
+        self.__min_ttl = min_ttl
+        self.__stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "invalidations": 0}
+        self.__stats_lock = threading.Lock()
+
+    def get(self, code: str) -> Optional[dict]:
+        """
+        Get a cached report.
+        :param code: The report code.
+        :return: A copy of the cached report (including its database ID), or None.
+        """
+        key = f"report:{code}"
+        value = self.__local.get(key)
+        if value is not None:
+            self.__count("local_hits")
+            return bson.BSON(value).decode()
+        if self.__shared is not None:
+            value = self.__shared.get(key)
+            if value is not None:
+                self.__count("shared_hits")
+                report = bson.BSON(value).decode()
+                self.__local.set(key, value, self.__expires_at(report))
+                return report
+        self.__count("misses")
+        return None
+
+    def set(self, report: dict) -> None:
+        """
+        Cache a report, as it is stored in the database.
+        :param report: The report.
+        """
+        key = f"report:{report['code']}"
+        value = bson.BSON.encode(report)
+        expires_at = self.__expires_at(report)
+        self.__local.set(key, value, expires_at)
+        if self.__shared is not None:
+            self.__shared.set(key, value, expires_at)
+
+    def invalidate(self, code: str) -> None:
+        """
+        Remove a report from the cache.
+        :param code: The report code.
+        """
+        key = f"report:{code}"
+        self.__count("invalidations")
+        self.__local.delete(key)
+        if self.__shared is not None:
+            self.__shared.delete(key)
+
+    def get_stats(self) -> dict:
+        """
+        :return: The hit, miss and invalidation counters, and the size of the in-process cache in bytes.
+        """
+        with self.__stats_lock:
+            return dict(self.__stats, local_bytes=self.__local.size())
+
+    def __count(self, counter: str) -> None:
+        """
+        Increment a counter. Requests of all threads of the worker share the cache.
+        :param counter: The name of the counter.
+        """
+        with self.__stats_lock:
+            self.__stats[counter] += 1
+
+    def __expires_at(self, report: dict) -> float:
+        """
+        :param report: The report.
+        :return: The time until which the report may be served from the cache.
+        """
+        return max(report["loaded_at"] + self.__allow_updates_every_n_seconds, time.time() + self.__min_ttl)
+
+
+class VodMetadataCache:
+    def __init__(self, shared_backend=None, max_bytes: int = 4 * 1024 * 1024, ttl: int = 30 * 24 * 60 * 60,
+                 negative_ttl: int = 10 * 60) -> None:
+        """
+        Caches the metadata of Twitch and YouTube videos (title, owner, creation time), which never changes, in an
+        in-process LRU cache and optionally a backend shared by all workers. Videos which don't exist are cached as
+        well, for a shorter time, as they may still be processing or become public later.
+        :param shared_backend: The optional shared cache (MongoCacheBackend or RedisCacheBackend).
+        :param max_bytes: The maximum total size of the in-process cache.
+        :param ttl: Time in seconds metadata is cached for.
+        :param negative_ttl: Time in seconds a missing video is cached for.
+        """
+        self.__local = LRUCache(max_bytes)
+        self.__shared = shared_backend
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+
+    def get(self, platform: str, video_id: str) -> (bool, Optional[dict]):
+        """
+        Get the cached metadata of a video.
+        :param platform: "twitch" or "youtube".
+        :param video_id: The video ID.
+        :return: A tuple of whether the video is cached, and its metadata. The metadata is None if the video is cached
+        as not found.
+        """
+        key = f"vod:{platform}:{video_id}"
+        value = self.__local.get(key)
+        if value is None and self.__shared is not None:
+            value = self.__shared.get(key)
+            if value is not None:
+                # The remaining lifetime in the shared cache is unknown, so keep it locally for the shorter TTL only.
+                self.__local.set(key, value, time.time() + self.__negative_ttl)
+        if value is None:
+            return False, None
+        return True, json.loads(value)["metadata"]
+
+    def set(self, platform: str, video_id: str, metadata: Optional[dict]) -> None:
+        """
+        Cache the metadata of a video.
+        :param platform: "twitch" or "youtube".
+        :param video_id: The video ID.
+        :param metadata: The metadata, or None if the video does not exist.
+        """
+        key = f"vod:{platform}:{video_id}"
+        value = json.dumps({"metadata": metadata}).encode("utf-8")
+        expires_at = time.time() + (self.__ttl if metadata is not None else self.__negative_ttl)
+        self.__local.set(key, value, expires_at)
+        if self.__shared is not None:
+            self.__shared.set(key, value, expires_at)
@@ -0,0 +1,129 @@
+from typing import Optional
+
+# The columnar format stores the fights and deaths of a report as parallel arrays instead of lists of objects, so the
+# keys of the objects are stored once rather than once per fight or death. Timestamps are stored as small integers:
+# fights by their offset from the start of the report and their duration, deaths by the time since the previous death.
+# Fights are prepended and deaths are appended when a report is updated, and neither changes the stored values.
+FIGHT_COLUMNS = ("id", "encounterID")
+DEATH_COLUMNS = ("targetID", "fight")
+
+
+def is_columnar(report: dict) -> bool:
+    """
+    Check whether the fights and deaths of a report are in the columnar format.
+    :param report: The report (or a projection of it).
+    :return: True if the fights or deaths are columnar.
+    """
+    return isinstance(report.get("fights"), dict) or isinstance(report.get("deaths"), dict)
+
+
+def encode_report(report: dict) -> dict:
+    """
+    Convert the fights and deaths of a report to the columnar format.
+    :param report: The report, with fights and deaths as lists. It is not modified.
+    :return: A copy of the report with columnar fights and deaths, and the key "columnar" set to True.
+    """
+    encoded = dict(report, columnar=True)
+    if isinstance(report.get("fights"), list):
+        encoded["fights"] = encode_fights(report["fights"], report["startTime"])
+    if isinstance(report.get("deaths"), list):
+        encoded["deaths"] = encode_deaths(report["deaths"], report["startTime"])
+    return encoded
+
+
+def decode_report(report: Optional[dict]) -> Optional[dict]:
+    """
+    Convert the fights and deaths of a report to lists of objects. Reports which are not columnar (e.g. stored before
+    the columnar format existed) are returned as they are.
+    :param report: The report, or None.
+    :return: The report with fights and deaths as lists. The key "columnar" tells whether the report was columnar.
+    """
+    if report is None:
+        return None
+    if not is_columnar(report):
+        report["columnar"] = False
+        return report
+    if isinstance(report.get("fights"), dict):
+        report["fights"] = decode_fights(report["fights"])
+    if isinstance(report.get("deaths"), dict):
+        report["deaths"] = decode_deaths(report["deaths"])
+    report["columnar"] = True
+    return report
+
+
+def encode_fights(fights: list, base: float) -> dict:
+    """
+    Convert fights to the columnar format.
+    :param fights: The fights.
+    :param base: The start time of the report.
+    :return: The columns of the fights.
+    """
+    columns = {"base": base, "start": [], "duration": []}
+    columns.update({key: [] for key in FIGHT_COLUMNS})
+    for fight in fights:
+        columns["start"].append(__compact(fight["startTime"] - base))
+        columns["duration"].append(__compact(fight["endTime"] - fight["startTime"]))
+        for key in FIGHT_COLUMNS:
+            columns[key].append(fight[key])
+    return columns
+
+
+def decode_fights(columns: dict) -> list:
+    """
+    Convert columnar fights to a list of fights.
+    :param columns: The columns of the fights.
+    :return: The fights.
+    """
+    fights = []
+    for i, start in enumerate(columns["start"]):
+        fight = {key: columns[key][i] for key in FIGHT_COLUMNS}
+        fight["startTime"] = columns["base"] + start
+        fight["endTime"] = fight["startTime"] + columns["duration"][i]
+        fights.append(fight)
+    return fights
+
+
+def encode_deaths(deaths: list, base: float, previous: Optional[float] = None) -> dict:
+    """
+    Convert deaths to the columnar format.
+    :param deaths: The deaths, in chronological order.
+    :param base: The start time of the report.
+    :param previous: The timestamp of the death before the first of the given deaths, if they are appended to other
+    deaths.
+    :return: The columns of the deaths. To append them to stored deaths, push each column except the base.
+    """
+    columns = {"base": base, "timestamp": []}
+    columns.update({key: [] for key in DEATH_COLUMNS})
+    previous = base if previous is None else previous
+    for death in deaths:
+        columns["timestamp"].append(__compact(death["timestamp"] - previous))
+        previous = death["timestamp"]
+        for key in DEATH_COLUMNS:
+            columns[key].append(death[key])
+    return columns
+
+
+def decode_deaths(columns: dict) -> list:
+    """
+    Convert columnar deaths to a list of deaths.
+    :param columns: The columns of the deaths. Columns which are missing (e.g. the fight of deaths stored per fight) are
+    left out of the deaths.
+    :return: The deaths.
+    """
+    deaths = []
+    timestamp = columns["base"]
+    for i, offset in enumerate(columns["timestamp"]):
+        timestamp += offset
+        death = {"timestamp": timestamp}
+        death.update({key: columns[key][i] for key in DEATH_COLUMNS if key in columns})
+        deaths.append(death)
+    return deaths
+
+
+def __compact(value: float):
+    """
+    Store whole numbers as integers, which take less space than floats in BSON and JSON.
+    :param value: The value.
+    :return: The value as an integer if it is a whole number.
+    """
+    return int(value) if float(value).is_integer() else value
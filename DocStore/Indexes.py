@@ -0,0 +1,98 @@
+import logging
+from typing import Dict, List
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Indexes per collection as (keys, options). Creating an index which already exists is a no-op, so these can be
+# applied on every startup.
+INDEXES = {
+    "reports": [([("code", ASCENDING)], {"unique": True})],
+    # The deaths of a report, one bucket per fight. Read per report in fight order, or for a single fight.
+    "report_deaths": [([("code", ASCENDING), ("fight", ASCENDING)], {"unique": True})],
+    "auths": [([("user", ASCENDING)], {"unique": True})],
+    "metadata": [([("name", ASCENDING)], {"unique": True})],
+    # Expired leases are removed by MongoDB, in case a worker died while holding one.
+    "leases": [([("expires_at", ASCENDING)], {"expireAfterSeconds": 0})],
+    # Workers take the oldest queued job, and finished jobs are removed by MongoDB after a while.
+    "ingest_jobs": [([("status", ASCENDING), ("created_at", ASCENDING)], {}),
+                    ([("expires_at", ASCENDING)], {"expireAfterSeconds": 0})],
+    # The metrics of workers which exited are removed by MongoDB after a while.
+    "metrics": [([("expires_at", ASCENDING)], {"expireAfterSeconds": 0})],
+}
+
+# Indexes for the session collection (see DocStore.Sessions). Sessions are looked up by id, and expired sessions are
+# removed by MongoDB.
+SESSION_INDEXES = [
+    ([("id", ASCENDING)], {"unique": True}),
+    ([("expiration", ASCENDING)], {"expireAfterSeconds": 0}),
+]
+
+
+def ensure_indexes(db: Database, session_collection: str = "sessions") -> None:
+    """
+    Create all indexes the application relies on, if they don't exist yet.
+    If an index can't be created (e.g. a unique index on a collection which already contains duplicates), a warning is
+    logged and the remaining indexes are still created.
+    :param db: The VodSync database.
+    :param session_collection: The name of the session collection.
+    """
+    for collection, indexes in list(INDEXES.items()) + [(session_collection, SESSION_INDEXES)]:
+        for keys, options in indexes:
+            try:
+                db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                logger.warning("Could not create index %s on %s: %s", keys, collection, e)
+
+
+def get_hot_queries(session_collection: str = "sessions") -> Dict[str, tuple]:
+    """
+    Get the queries the application runs on every request or report load, with sample filters.
+    :param session_collection: The name of the session collection.
+    :return: A dictionary of query name to (collection, filter).
+    """
+    return {
+        "reports by code": ("reports", {"code": "sample"}),
+        "deaths by report": ("report_deaths", {"code": "sample"}),
+        "deaths by fight": ("report_deaths", {"code": "sample", "fight": 1}),
+        "auths by user": ("auths", {"user": "sample@example.com"}),
+        "metadata by name": ("metadata", {"name": "encounter_dict"}),
+        "leases by key": ("leases", {"_id": "report:sample"}),
+        "rate limits by key": ("rate_limits", {"_id": "fflogs"}),
+        "ingest jobs by status": ("ingest_jobs", {"status": "queued"}),
+        "sessions by id": (session_collection, {"id": "sample"}),
+    }
+
+
+def verify_query_plans(db: Database, session_collection: str = "sessions") -> Dict[str, List[str]]:
+    """
+    Run explain() on every hot query and collect the stages of the winning plans.
+    :param db: The VodSync database.
+    :param session_collection: The name of the session collection.
+    :return: A dictionary of query name to the stages of its winning plan. A query containing a "COLLSCAN" stage is not
+    served by an index.
+    """
+    plans = {}
+    for name, (collection, query) in get_hot_queries(session_collection).items():
+        explanation = db[collection].find(query).explain()
+        plans[name] = plan_stages(explanation["queryPlanner"]["winningPlan"])
+    return plans
+
+
+def plan_stages(plan: dict) -> List[str]:
+    """
+    Flatten a query plan into the list of its stages, outermost first.
+    :param plan: A (winning) plan from the output of explain().
+    :return: The stage names.
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        stages += plan_stages(input_stage)
+    # Newer servers wrap the classic plan when the slot based execution engine is used.
+    if "queryPlan" in plan:
+        stages += plan_stages(plan["queryPlan"])
+    return stages
@@ -0,0 +1,172 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Optional
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# The stages of a job in the order they complete, and the fields of the partial report each stage adds.
+STAGES = ("queued", "fights", "deaths", "players")
+STAGE_FIELDS = {
+    "fights": ["code", "title", "startTime", "endTime", "fights", "encounternames"],
+    "deaths": ["deaths", "death_index"],
+    "players": ["player_data"],
+}
+
+
+class IngestJobs:
+    def __init__(self, mongo, job_collection: Collection, token_manager, workers: int = 2, lease_seconds: int = 300,
+                 poll_interval: float = 1.0, keep_seconds: int = 3600) -> None:
+        """
+        Loads reports from FFLogs in background threads, so requests for a report which is not stored yet don't have
+        to wait for it. Jobs are queued in a MongoDB collection, which every worker takes jobs from. While a job
+        runs, the partial report is stored in the job document stage by stage (fights first, then deaths, then player
+        names, see STAGE_FIELDS), so clients can show each part as soon as it is loaded.
+        Jobs only store the user who queued them. Their FFLogs token is read when the job runs.
+        :param mongo: The MongoDBConnection.
+        :param job_collection: The collection storing the jobs.
+        :param token_manager: The TokenManager, which refreshes the token of the user if needed.
+        :param workers: The number of job threads per worker process.
+        :param lease_seconds: How long a job may run without completing a stage. If a worker dies while running a job,
+        other workers take over after this time.
+        :param poll_interval: Time in seconds between checks for new jobs when the queue is empty.
+        :param keep_seconds: How long finished jobs are kept, so clients can read their outcome.
+        """
+        self.__mongo = mongo
+        self.__job_collection = job_collection
+        self.__token_manager = token_manager
+        self.__workers = workers
+        self.__lease_seconds = lease_seconds
+        self.__poll_interval = poll_interval
+        self.__keep_seconds = keep_seconds
+        self.__owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4()}"
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+
+    def enqueue(self, code: str, username: str) -> dict:
+        """
+        Queue a report to be loaded, unless it is already queued or loading.
+        :param code: The report code.
+        :param username: The user whose FFLogs auth the report is loaded with.
+        :return: The job document, see get_job.
+        """
+        self.ensure_started()
+        now = datetime.datetime.utcnow()
+        job = {"status": "queued", "stage": "queued", "user": username, "created_at": now}
+        try:
+            self.__job_collection.insert_one(dict(job, _id=code))
+        except DuplicateKeyError:
+            # Only finished jobs are restarted, e.g. if the previous attempt failed.
+            self.__job_collection.update_one({"_id": code, "status": {"$in": ["done", "failed"]}},
+                                             {"$set": job, "$unset": {"report": "", "counts": "", "result_status": "",
+                                                                      "expires_at": ""}})
+        self.__wakeup.set()
+        return self.get_job(code)
+
+    def get_job(self, code: str, since: str = "queued") -> Optional[dict]:
+        """
+        Get the state of the job for a report.
+        :param code: The report code.
+        :param since: The last stage the caller has the partial report of (see STAGES). The fields of this and earlier
+        stages are left out of the partial report.
+        :return: The job, or None if there is none. The job contains its "status" ("queued", "running", "done" or
+        "failed"), the last completed "stage", the partial "report" while it is running, the "counts" of fights,
+        deaths and players loaded so far, and the "result_status" of the load once it is finished.
+        """
+        self.ensure_started()
+        projection = {"user": 0, "owner": 0}
+        for stage in STAGES[1:STAGES.index(since) + 1]:
+            projection.update({f"report.{key}": 0 for key in STAGE_FIELDS[stage]})
+        return self.__job_collection.find_one({"_id": code}, projection)
+
+    def ensure_started(self) -> None:
+        """
+        Start the job threads of this worker process, if they aren't running.
+        The threads are started lazily, so they run in the worker process rather than a pre-fork master.
+        """
+        with self.__lock:
+            self.__threads = [thread for thread in self.__threads if thread.is_alive()]
+            while len(self.__threads) < self.__workers:
+                thread = threading.Thread(target=self.__run, name=f"ingest-{len(self.__threads)}", daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+
+    def __run(self) -> None:
+        """
+        Run jobs until the worker exits.
+        """
+        while True:
+            try:
+                job = self.__claim()
+                if job:
+                    self.__process(job)
+                    continue
+            except Exception:
+                logger.exception("Could not run ingest job")
+            self.__wakeup.wait(self.__poll_interval)
+            self.__wakeup.clear()
+
+    def __claim(self) -> Optional[dict]:
+        """
+        Take the oldest queued job, or a job whose worker died.
+        :return: The job, or None if there is nothing to do.
+        """
+        now = datetime.datetime.utcnow()
+        return self.__job_collection.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_expires_at": {"$lt": now}}]},
+            {"$set": {"status": "running", "owner": self.__owner,
+                      "lease_expires_at": now + datetime.timedelta(seconds=self.__lease_seconds)}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER)
+
+    def __process(self, job: dict) -> None:
+        """
+        Load the report of a job and record the outcome.
+        :param job: The claimed job.
+        """
+        code = job["_id"]
+
+        def progress(stage: str, report: dict) -> None:
+            update = {f"report.{key}": report[key] for key in STAGE_FIELDS[stage] if key in report}
+            update["stage"] = stage
+            update["counts"] = {"fights": len(report.get("fights", [])), "deaths": len(report.get("deaths", [])),
+                                "players": len(report.get("player_data", {}))}
+            # Every completed stage renews the lease, so large reports are not taken over while they still load.
+            update["lease_expires_at"] = (datetime.datetime.utcnow()
+                                          + datetime.timedelta(seconds=self.__lease_seconds))
+            self.__job_collection.update_one({"_id": code, "owner": self.__owner}, {"$set": update})
+
+        try:
+            status = self.__load(code, job, progress)
+        except Exception:
+            logger.exception("Could not load report %s", code)
+            status = 500
+        self.__job_collection.update_one(
+            {"_id": code, "owner": self.__owner},
+            {"$set": {"status": "done" if status == 200 else "failed", "result_status": status,
+                      "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=self.__keep_seconds)},
+             # The report is stored by now.
+             "$unset": {"report": "", "lease_expires_at": ""}})
+
+    def __load(self, code: str, job: dict, progress) -> int:
+        """
+        Load the report of a job with the FFLogs token of the user who queued it.
+        :param code: The report code.
+        :param job: The job.
+        :param progress: Called with the name of each completed stage and the report loaded so far, see
+        MongoDBConnection.ingest_report.
+        :return: The status code of the load. 401 if the user is not authorized with FFLogs anymore.
+        """
+        auths = self.__mongo.get_auth_keys(job["user"])
+        if "fflogs" not in auths:
+            return 401
+        status, _ = self.__token_manager.call_with_auth(
+            job["user"], auths, "fflogs", lambda token: (self.__mongo.ingest_report(code, token, progress), None))
+        return status
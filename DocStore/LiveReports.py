@@ -0,0 +1,180 @@
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+from bson import json_util
+import FFLogs.API
+from DocStore.RateLimiter import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, code: str, fflogs_token: str, version: int) -> None:
+        """
+        A viewer following a live report.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token of the viewer, used to refresh the report.
+        :param version: The version of the report the viewer has.
+        """
+        self.code = code
+        self.fflogs_token = fflogs_token
+        self.version = version
+        self.__messages = queue.Queue()
+
+    def publish(self, event: str, data: str) -> None:
+        """
+        Queue a message for the viewer.
+        :param event: The event name.
+        :param data: The serialized event data.
+        """
+        self.__messages.put((event, data))
+
+    def get(self, timeout: float) -> Optional[tuple]:
+        """
+        Wait for the next message.
+        :param timeout: The maximum time to wait in seconds.
+        :return: A tuple of (event, data), or None if no message arrived in time.
+        """
+        try:
+            return self.__messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveReports:
+    def __init__(self, mongo, update_cadence: int, poll_interval: float = 2.0, max_subscriptions: int = 8) -> None:
+        """
+        Pushes updates of reports to the viewers following them. A single background thread per worker watches all
+        reports with viewers in this worker:
+        - Per report and update period, only one worker across all workers refreshes the report from FFLogs (see
+          MongoDBConnection.try_live_lease), using the token of one of its viewers.
+        - Every worker polls the versions of its reports, and sends the fights, deaths and players added since the
+          version each viewer has. This also picks up refreshes made by other workers.
+        FFLogs traffic therefore depends on the number of live reports, not the number of viewers.
+        Every viewer holds a thread of the worker while it follows a report, so only max_subscriptions viewers are
+        accepted per worker, leaving the other threads for regular requests.
+        :param mongo: The MongoDBConnection.
+        :param update_cadence: The minimum time between updates to a report from the FFLogs API.
+        :param poll_interval: Time in seconds between checks for new report versions.
+        :param max_subscriptions: The maximum number of viewers following reports in this worker.
+        """
+        self.__mongo = mongo
+        self.__update_cadence = update_cadence
+        self.__poll_interval = poll_interval
+        self.__max_subscriptions = max_subscriptions
+        self.__subscription_count = 0
+        self.__subscriptions = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def subscribe(self, code: str, fflogs_token: str, version: int) -> Optional[Subscription]:
+        """
+        Start following a report.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token of the viewer.
+        :param version: The version of the report the viewer has.
+        :return: The subscription, which receives "delta" and "full" events (see MongoDBConnection.find_report_delta)
+        and "auth" events if the token of the viewer was rejected by FFLogs. Must be passed to unsubscribe. None if
+        this worker already has max_subscriptions viewers.
+        """
+        subscription = Subscription(code, fflogs_token, version)
+        with self.__lock:
+            if self.__subscription_count >= self.__max_subscriptions:
+                return None
+            self.__subscription_count += 1
+            self.__subscriptions.setdefault(code, []).append(subscription)
+            # The thread is started lazily, so it runs in the worker process rather than a pre-fork master.
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="live-reports", daemon=True)
+                self.__thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Stop following a report.
+        :param subscription: The subscription returned by subscribe.
+        """
+        with self.__lock:
+            subscriptions = self.__subscriptions.get(subscription.code, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self.__subscription_count -= 1
+            if not subscriptions:
+                self.__subscriptions.pop(subscription.code, None)
+
+    def __run(self) -> None:
+        """
+        Watch all followed reports until the worker exits.
+        """
+        while True:
+            try:
+                self.__poll()
+            except Exception:
+                logger.exception("Could not poll live reports")
+            time.sleep(self.__poll_interval)
+
+    def __poll(self) -> None:
+        """
+        Refresh the followed reports which are due, and send new versions to their viewers.
+        """
+        with self.__lock:
+            followed = {code: list(subscriptions) for code, subscriptions in self.__subscriptions.items()}
+        if not followed:
+            return
+
+        versions = self.__mongo.get_report_versions(followed)
+        refreshed = False
+        for code, (_, loaded_at) in versions.items():
+            # Only compete for the lease once the report is due, as the lease blocks refreshes for a whole period.
+            if time.time() - loaded_at > self.__update_cadence and self.__mongo.try_live_lease(code):
+                refreshed = self.__refresh(code, followed[code]) or refreshed
+        if refreshed:
+            versions = self.__mongo.get_report_versions(followed)
+
+        for code, (version, _) in versions.items():
+            self.__publish(code, version, followed[code])
+
+    def __refresh(self, code: str, subscriptions: list) -> bool:
+        """
+        Refresh a report from FFLogs with the token of the newest viewer which has a working one.
+        :param code: The report code.
+        :param subscriptions: The viewers of the report.
+        :return: True if the report was refreshed.
+        """
+        for subscription in reversed(subscriptions):
+            if subscription.fflogs_token is None:
+                continue
+            # Live refreshes yield to interactive requests when the FFLogs budget runs low.
+            with FFLogs.API.priority(BACKGROUND):
+                status, delta = self.__mongo.update_report(code, subscription.fflogs_token)
+            if status == 401:
+                # The viewer has to refresh their token, until then use somebody else's.
+                subscription.fflogs_token = None
+                subscription.publish("auth", "{}")
+                continue
+            return delta is not None
+        return False
+
+    def __publish(self, code: str, version: int, subscriptions: list) -> None:
+        """
+        Send the changes since their version to all viewers of a report which are behind.
+        :param code: The report code.
+        :param version: The current version of the report.
+        :param subscriptions: The viewers of the report.
+        """
+        # Viewers on the same version get the same message, so each delta is only built once.
+        messages = {}
+        for subscription in subscriptions:
+            if subscription.version >= version:
+                continue
+            if subscription.version not in messages:
+                token = subscription.fflogs_token or next((s.fflogs_token for s in subscriptions if s.fflogs_token),
+                                                          None)
+                status, delta = self.__mongo.find_report_delta(code, token, subscription.version)
+                if delta is None:
+                    continue
+                messages[subscription.version] = ("delta" if "delta" in delta else "full", json_util.dumps(delta))
+            subscription.publish(*messages[subscription.version])
+            subscription.version = version
@@ -1,18 +1,71 @@
+import threading
 import time
-from typing import Optional
-from pymongo import MongoClient
+from typing import Optional, Iterable, Callable, TypedDict
+from pymongo import MongoClient, ASCENDING, InsertOne, ReplaceOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from dotenv import load_dotenv
 import FFLogs.API
+import Metrics.registry
+from DocStore import Indexes, Columnar
+from DocStore.Cache import ReportCache, MongoCacheBackend, RedisCacheBackend
+from DocStore.RateLimiter import PREFETCH
+from DocStore.SingleFlight import SingleFlight
 
 load_dotenv()
 
+# Number of version marks kept per report. Clients with older versions receive the full report instead of a delta.
+VERSION_HISTORY = 50
+
+# Groups of report fields which can be requested separately. The metadata is always returned.
+REPORT_FIELDS = {
+    "metadata": ["code", "title", "startTime", "endTime", "loaded_at", "version"],
+    "fights": ["fights"],
+    "deaths": ["deaths", "death_index"],
+    "players": ["player_data"],
+}
+
+# Deaths within this many seconds before the end of a fight are counted as the wipe, rather than as the deaths which
+# caused it.
+WIPE_SECONDS = 10
+
+# Keys the fights of a report can be sorted by in fight listings (see find_fights), and the maximum page size.
+FIGHT_SORT_KEYS = ("start", "duration", "deaths")
+MAX_FIGHT_PAGE = 500
+
+# Keys of reports read from the database which tell how the report is stored. They are not sent to clients.
+STORAGE_KEYS = ("columnar", "bucketed")
+
+# Providers a user can authorize with, each stored as a subdocument of the auths document of the user.
+PROVIDERS = ("fflogs", "twitch", "youtube")
+
+
+class ProviderAuth(TypedDict, total=False):
+    token: str
+    refresh_token: str
+    # Epoch time at which the access token expires. Missing for auths stored before expiry times were recorded.
+    expires_at: float
+    # The name of the user at the provider (the e-mail address for YouTube).
+    username: str
+    # The FFLogs user id.
+    uid: int
+
 
 class MongoDBConnection:
-    def __init__(self, uri: str, certificate_file: str, allow_updates_every_n_seconds: int) -> None:
+    def __init__(self, uri: str, certificate_file: str, allow_updates_every_n_seconds: int,
+                 preload_encounters: bool = False, cache_max_bytes: int = 64 * 1024 * 1024,
+                 shared_cache: Optional[str] = None, columnar: bool = False) -> None:
         """
         :param uri: The URI to connect to the MongoDB database.
         :param certificate_file: The path to the certificate file.
         :param allow_updates_every_n_seconds: The minimum time between updates to a report from the FFLogs API.
+        :param preload_encounters: If True, the names of all encounters in the current zones are loaded from FFLogs
+        the first time an unknown encounter ID is encountered, so later reports never wait for name lookups.
+        :param cache_max_bytes: The maximum size of the in-process report cache.
+        :param shared_cache: The report cache shared by all workers: "mongodb" to use a TTL collection in this
+        database, a redis:// URL to use Redis, or None to only use the in-process cache.
+        :param columnar: If True, the fights and deaths of reports are stored in the columnar format (see
+        DocStore.Columnar). Reports stored in the other format are converted the next time they are updated, and can
+        be read in either format.
         """
         # host=os.getenv("MONGODB_URI"), tls=True, tlsCertificateKeyFile=os.getenv("MONGODB_CERT")
         # Connect to the corresponding MongoDB database and prepare the collections.
@@ -20,7 +73,21 @@ class MongoDBConnection:
         self.__db = self.__client.VodSync
         self.__auth_collection = self.__db.auths
         self.__report_collection = self.__db.reports
+        self.__deaths_collection = self.__db.report_deaths
+        self.__columnar = columnar
         self.__metadata_collection = self.__db.metadata
+        # Make sure all lookups are served by an index.
+        Indexes.ensure_indexes(self.__db)
+        # Prepare the report cache.
+        if shared_cache == "mongodb":
+            shared_backend = MongoCacheBackend(self.__db.report_cache)
+        elif shared_cache:
+            shared_backend = RedisCacheBackend(shared_cache)
+        else:
+            shared_backend = None
+        self.__report_cache = ReportCache(cache_max_bytes, allow_updates_every_n_seconds, shared_backend)
+        # Loads and refreshes of the same report are only run once at a time across all workers.
+        self.__single_flight = SingleFlight(self.__db.leases)
         # Prepare metadata (FFLogs Encounter Name Mapping) if it doesn't exist.
         self.__fflogs_encounters = self.__metadata_collection.find_one({"name": "encounter_dict"})
         if not self.__fflogs_encounters:
@@ -32,19 +99,52 @@ class MongoDBConnection:
             self.__fflogs_encounters = self.__fflogs_encounters["encounter_mappings"]
         # Store the minimum time between updates to a report.
         self.__allow_updates_every_n_seconds = allow_updates_every_n_seconds
+        # Whether to bulk load encounter names, and whether this already happened in this process.
+        self.__preload_encounters = preload_encounters
+        self.__encounters_preloaded = False
+        # Serializes the resolution of missing encounter names. The encounter dictionary is never modified in place but
+        # replaced with an updated copy, so readers can iterate the reference they read without holding the lock.
+        self.__encounter_lock = threading.Lock()
 
-    def store_auth_keys(self, username: str, auths: dict) -> None:
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def update_provider(self, username: str, provider: str, auth: ProviderAuth,
+                        previous: Optional[ProviderAuth] = None) -> bool:
         """
-        Inserts or updates an auths document for given user(name).
-        :param username: The user to store the auth document for.
-        :param auths: The known auths for the user.
+        Stores the auth of a user for one provider, creating the auths document of the user if it doesn't exist. Only
+        the subdocument of the provider is written, so concurrent updates of other providers are kept.
+        :param username: The user to store the auth for.
+        :param provider: "fflogs", "twitch" or "youtube".
+        :param auth: The auth of the provider.
+        :param previous: The auth of the provider as it is currently stored, if known. Nothing is written if it equals
+        the new auth.
+        :return: True if the auth was written.
         """
-        auths["user"] = username
-        if "_id" in auths:
-            self.__auth_collection.replace_one({"_id": auths["_id"]}, auths, upsert=True)
-        else:
-            self.__auth_collection.insert_one(auths)
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider {provider}")
+        if auth == previous:
+            return False
+        try:
+            self.__auth_collection.update_one({"user": username}, {"$set": {provider: auth}}, upsert=True)
+        except DuplicateKeyError:
+            # a concurrent upsert created the document first, so the update matches it now
+            self.__auth_collection.update_one({"user": username}, {"$set": {provider: auth}})
+        return True
 
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def remove_provider(self, username: str, provider: str) -> bool:
+        """
+        Removes the auth of a user for one provider, e.g. on sign out or if it can't be refreshed anymore.
+        :param username: The user to remove the auth for.
+        :param provider: "fflogs", "twitch" or "youtube".
+        :return: True if an auth was removed.
+        """
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider {provider}")
+        result = self.__auth_collection.update_one({"user": username, provider: {"$exists": True}},
+                                                   {"$unset": {provider: ""}})
+        return result.modified_count > 0
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
     def get_auth_keys(self, username: str) -> dict:
         """
         Returns stored authentication keys for given user key (email)
@@ -57,8 +157,10 @@ class MongoDBConnection:
         else:
             return auth
 
-    def find_or_load_report(self, code: str, fflogs_token: str, update: bool = False, unknown: bool = False) -> (
-            int, Optional[dict]):
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def find_or_load_report(self, code: str, fflogs_token: str, update: bool = False, unknown: bool = False,
+                            fields: Optional[Iterable[str]] = None, fight_id: Optional[int] = None,
+                            since_version: Optional[int] = None, load: bool = True) -> (int, Optional[dict]):
         """
         Attempt to find a report by code. If it doesn't exist, make one attempt to load it from FFLogs using the
         provided auth token.
@@ -67,44 +169,650 @@ class MongoDBConnection:
         :param update: If True, try to refresh the log if it is found in the database.
         If this fails, return the old report.
         :param unknown: Whether to include unknown encounters (ID=0). Only when the log is updated from the database.
+        :param fields: The field groups to return (see REPORT_FIELDS). The metadata of the report is always returned.
+        If None, the full report is returned.
+        :param fight_id: If given, only the deaths of this fight are returned. Implies the "deaths" field group.
+        :param since_version: If given (and no fields are selected), only what was added to the report after this
+        version is returned, see __diff_report.
+        :param load: If False, a report which is not stored is not loaded from FFLogs, and the status is 404.
         :return: A status code for the request, and the report data if it could be found or loaded. Otherwise, the
         report may be None or incomplete and should not be used.
         """
-        report = self.__report_collection.find_one({"code": code})
+        fields = self.__resolve_fields(fields, fight_id)
+        report = self.__get_report(code, fields, fight_id)
         status = 200
-        if not report:
-            # Attempt to load the report from FFLogs.
-            status, report = FFLogs.API.get_report_data(fflogs_token, code)
-            if status == 200:
-                if report is not None:
-                    # If the report was loaded successfully, store it in the database.
-                    self.__report_collection.insert_one(report)
-                else:
-                    # Custom error code to signify that the report is successfully loaded, but has no data.
-                    # Note that this is different from an empty report, as here, no metadata is available.
-                    status = 800
+        if not report and not load:
+            status = 404
+        elif not report:
+            # Attempt to load the report from FFLogs, or wait for whoever is already loading it.
+            status, report = self.__single_flight.run(f"report:{code}",
+                                                      lambda: self.__load_report(code, fflogs_token),
+                                                      lambda: self.__find_report(code))
         else:
             # If the report was found in the database, check if it needs to be updated.
             if update and time.time() - report["loaded_at"] > self.__allow_updates_every_n_seconds:
-                status, new_report = FFLogs.API.try_update_report(fflogs_token, report, unknown=unknown)
-                if status == 200:
-                    # If the report was updated successfully, store the new report in the database.
-                    new_report["_id"] = report["_id"]
-                    self.__report_collection.replace_one({"_id": report["_id"]}, new_report, upsert=True)
-                    # Return the new report in this case.
-                    report = new_report
+                status, report, _ = self.__single_flight.run(
+                    f"report:{code}",
+                    lambda: self.__refresh_report(report, fflogs_token, unknown),
+                    lambda: (200, self.__read_report({"_id": report["_id"]}) or report, None))
+                # Keep the cache in sync with whatever is now stored.
+                self.__report_cache.set(report)
 
         if report:
+            # Only return the requested fields. Reports read with a projection already are in this shape.
+            if fields is not None:
+                report = self.__project_report(report, fields, fight_id)
+            # The deaths of a single fight start at the beginning of the returned deaths.
+            if fight_id is not None and report.get("death_index"):
+                report["death_index"] = {key: dict(entry, start=0) for key, entry in report["death_index"].items()}
+
             # Try to append encounter names.
-            status, report = self.__append_encounter_dict(report, fflogs_token)
+            if "fights" in report:
+                status, report = self.__append_encounter_dict(report, fflogs_token)
+
+            # Only return what the client doesn't have yet.
+            if since_version is not None and fields is None:
+                report = self.__diff_report(report, since_version)
 
-            # We don't return the ID of the report in responses.
+            # We don't return the ID of the report, the version marks or the storage format in responses.
             if "_id" in report:
                 del report["_id"]
+            if "versions" in report:
+                del report["versions"]
+            for key in STORAGE_KEYS:
+                report.pop(key, None)
 
         # Return whatever latest status code and report we have as the final result.
         return status, report
 
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def update_report(self, code: str, fflogs_token: str, unknown: bool = False) -> (int, Optional[dict]):
+        """
+        Refresh a stored report from FFLogs, if the minimum time between updates has passed, and return what changed.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token.
+        :param unknown: Whether to include unknown encounters (ID=0). This requires reloading the full report.
+        :return: A status code for the request, and the delta if the report was refreshed. The delta contains the new
+        fights, deaths, player_data entries and encounternames, and the updated endTime, loaded_at and version of the
+        report. If the full report had to be reloaded, the delta is the full report with the key "full" set to True.
+        The delta is None if the report does not exist, or if it was not refreshed.
+        """
+        report = self.__get_report(code)
+        if not report:
+            return 404, None
+        if time.time() - report["loaded_at"] <= self.__allow_updates_every_n_seconds:
+            return 200, None
+
+        status, report, delta = self.__single_flight.run(
+            f"report:{code}",
+            lambda: self.__refresh_report(report, fflogs_token, unknown),
+            lambda: (200, report, None))
+        if status != 200 or delta is None:
+            return status, None
+
+        status, delta = self.__append_encounter_dict(delta, fflogs_token)
+        if "_id" in delta:
+            del delta["_id"]
+        for key in STORAGE_KEYS:
+            delta.pop(key, None)
+        return status, delta
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def ingest_report(self, code: str, fflogs_token: str, progress: Callable[[str, dict], None]) -> int:
+        """
+        Load a report from FFLogs and store it, reporting partial results along the way. Used by background ingest
+        jobs, see IngestJobs.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token.
+        :param progress: Called with the name of each completed stage ("fights", "deaths", "players") and the report
+        loaded so far, including the encounter names of its fights.
+        :return: The status code of the load, as returned by find_or_load_report.
+        """
+        def report_progress(stage: str, report: dict) -> None:
+            # Work on a copy, the loader keeps filling in the report.
+            _, partial = self.__append_encounter_dict(dict(report), fflogs_token)
+            # The encounter dictionary uses strings due to MongoDB limitations.
+            partial["encounternames"] = {str(k): v for k, v in partial.get("encounternames", {}).items()}
+            partial["death_index"] = self.__index_deaths(partial["fights"], partial.get("deaths", []))
+            progress(stage, partial)
+
+        status, _ = self.__single_flight.run(f"report:{code}",
+                                             lambda: self.__load_report(code, fflogs_token, report_progress),
+                                             lambda: self.__find_report(code))
+        return status
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def find_report_delta(self, code: str, fflogs_token: str, since_version: int) -> (int, Optional[dict]):
+        """
+        Read what was added to a stored report after a version. The report is read from the database rather than the
+        report cache, which may lag behind refreshes made by other workers.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token, used to resolve encounter names.
+        :param since_version: The version the client has.
+        :return: A status code, and the delta (or the full report, if the version is unknown) as returned by
+        find_or_load_report with since_version. The report is None if it does not exist.
+        """
+        report = self.__read_report({"code": code})
+        if not report:
+            return 404, None
+        self.__report_cache.set(report)
+        status, report = self.__append_encounter_dict(report, fflogs_token)
+        report = self.__diff_report(report, since_version)
+        if "_id" in report:
+            del report["_id"]
+        if "versions" in report:
+            del report["versions"]
+        for key in STORAGE_KEYS:
+            report.pop(key, None)
+        return status, report
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def find_fights(self, code: str, fflogs_token: str, offset: int = 0, limit: int = 100,
+                    encounter_id: Optional[int] = None, min_duration: Optional[float] = None,
+                    has_deaths: Optional[bool] = None, sort: str = "start",
+                    descending: bool = True) -> (int, Optional[dict]):
+        """
+        List a page of the fights of a stored report, filtered and sorted on the server, so clients never have to hold
+        or render every fight of a large report.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token, used to resolve encounter names.
+        :param offset: The position of the first fight of the page in the filtered fights.
+        :param limit: The maximum number of fights on the page (at most MAX_FIGHT_PAGE).
+        :param encounter_id: If given, only fights of this encounter are listed.
+        :param min_duration: If given, only fights lasting at least this many seconds are listed.
+        :param has_deaths: If True, only fights with deaths (not counting the wipe) are listed. If False, only fights
+        without.
+        :param sort: The key to sort by, see FIGHT_SORT_KEYS.
+        :param descending: Whether to list the largest (e.g. the latest) fights first.
+        :return: A status code, and the page if the report is stored. The page contains the version of the report, the
+        number of fights matching the filters ("total"), the offset and limit, the fights (each with its number of
+        deaths as "death_count") and the encounter names of the listed fights. The status is 404 if the report is
+        not stored.
+        """
+        if sort not in FIGHT_SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        limit = max(0, min(limit, MAX_FIGHT_PAGE))
+        offset = max(0, offset)
+
+        report = self.__get_report(code)
+        if not report:
+            return 404, None
+        death_index = report.get("death_index")
+        if death_index is None:
+            death_index = self.__index_deaths(report["fights"], report["deaths"])
+
+        fights = []
+        for fight in report["fights"]:
+            entry = death_index.get(str(fight["id"]))
+            death_count = entry["count"] - entry["wipe_count"] if entry else 0
+            if encounter_id is not None and fight["encounterID"] != encounter_id:
+                continue
+            if min_duration is not None and fight["endTime"] - fight["startTime"] < min_duration:
+                continue
+            if has_deaths is not None and (death_count > 0) != has_deaths:
+                continue
+            fights.append(dict(fight, death_count=death_count))
+
+        if sort == "start":
+            fights.sort(key=lambda fight: (fight["startTime"], fight["id"]), reverse=descending)
+        elif sort == "duration":
+            fights.sort(key=lambda fight: fight["endTime"] - fight["startTime"], reverse=descending)
+        else:
+            fights.sort(key=lambda fight: fight["death_count"], reverse=descending)
+
+        status, page = self.__append_encounter_dict({"fights": fights[offset:offset + limit]}, fflogs_token)
+        page.update({"code": code, "version": report.get("version", 0), "total": len(fights), "offset": offset,
+                     "limit": limit})
+        return status, page
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def get_report_versions(self, codes: Iterable[str]) -> dict:
+        """
+        Read the current version of stored reports from the database.
+        :param codes: The report codes.
+        :return: A dictionary of report code to (version, loaded_at). Reports which are not stored are missing.
+        """
+        return {report["code"]: (report.get("version", 0), report["loaded_at"])
+                for report in self.__report_collection.find({"code": {"$in": list(codes)}},
+                                                            {"code": 1, "version": 1, "loaded_at": 1})}
+
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def try_live_lease(self, code: str) -> bool:
+        """
+        Try to become the worker which refreshes a live report for the current update period.
+        :param code: The report code.
+        :return: True if this worker should refresh the report now.
+        """
+        return self.__single_flight.try_lease(f"live:{code}", self.__allow_updates_every_n_seconds)
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the report cache.
+        :return: See ReportCache.get_stats.
+        """
+        return self.__report_cache.get_stats()
+
+    def __get_report(self, code: str, fields: Optional[set] = None, fight_id: Optional[int] = None) -> Optional[dict]:
+        """
+        Read a stored report through the report cache.
+        :param code: The report code.
+        :param fields: The field groups to read. If the report is not cached, only these are read from the database
+        (and the result is not cached). If None, the full report is read.
+        :param fight_id: If given, only the deaths of this fight are read from the database.
+        :return: The report (a copy, which may be modified), or None if it is not stored. A cached report is always
+        returned in full.
+        """
+        report = self.__report_cache.get(code)
+        if report is None:
+            if fields is None:
+                report = self.__read_report({"code": code})
+                if report:
+                    if "death_index" not in report:
+                        # Index the deaths of reports stored before deaths were indexed.
+                        report["death_index"] = self.__index_deaths(report["fights"], report["deaths"])
+                        self.__report_collection.update_one({"_id": report["_id"], "death_index": {"$exists": False}},
+                                                            {"$set": {"death_index": report["death_index"]}})
+                    self.__report_cache.set(report)
+            else:
+                report = self.__read_report({"code": code}, self.__projection(fields, fight_id), fight_id)
+                if (report and fight_id is not None and report.get("death_index")
+                        and (report["bucketed"] or not report["columnar"])):
+                    # Only the deaths of the fight were read. Columnar deaths stored in the report are read in full.
+                    report["death_index"] = {key: dict(entry, start=0)
+                                             for key, entry in report["death_index"].items()}
+        return report
+
+    def __read_report(self, query: dict, projection: Optional[dict] = None,
+                      fight_id: Optional[int] = None) -> Optional[dict]:
+        """
+        Read a stored report (or a projection of it) in any storage format, together with its deaths.
+        :param query: The filter.
+        :param projection: The projection, if any.
+        :param fight_id: If given, only the deaths of this fight are read from the death buckets.
+        :return: The report with its fights and deaths as lists (see Columnar.decode_report), or None if it is not
+        stored. The key "bucketed" tells whether its deaths are stored in death buckets rather than the report.
+        """
+        report = Columnar.decode_report(self.__report_collection.find_one(query, projection))
+        if report is None:
+            return None
+        report["bucketed"] = report.get("bucketed", False)
+        if report["bucketed"] and (projection is None or "deaths" in projection):
+            report["deaths"] = self.__read_deaths(report["code"], report.get("death_index", {}), fight_id)
+        return report
+
+    def __read_deaths(self, code: str, death_index: dict, fight_id: Optional[int] = None) -> list:
+        """
+        Read the deaths of a report from its death buckets, in the order of the death index.
+        :param code: The report code.
+        :param death_index: The death index of the report. Buckets of fights which are not in the index (e.g. written
+        by a refresh which did not complete) are ignored.
+        :param fight_id: If given, only the deaths of this fight are read.
+        :return: The deaths.
+        """
+        query = {"code": code} if fight_id is None else {"code": code, "fight": fight_id}
+        deaths = []
+        for bucket in self.__deaths_collection.find(query, {"_id": 0, "fight": 1, "deaths": 1}).sort("fight",
+                                                                                                     ASCENDING):
+            if str(bucket["fight"]) in death_index:
+                deaths += self.__decode_bucket(bucket)
+        return deaths
+
+    def __write_deaths(self, code: str, start_time: float, deaths: list, replace: bool = False) -> None:
+        """
+        Store deaths in the death buckets of a report, one bucket per fight. Buckets are only ever inserted, as the
+        deaths of a fight are complete once the fight appears in a report.
+        :param code: The report code.
+        :param start_time: The start time of the report.
+        :param deaths: The deaths, sorted by fight.
+        :param replace: If True, the given deaths replace all stored deaths of the report (e.g. after a full reload).
+        """
+        buckets = {}
+        for death in deaths:
+            buckets.setdefault(death["fight"], []).append(death)
+        if replace:
+            requests = [ReplaceOne({"code": code, "fight": fight},
+                                   self.__encode_bucket(code, fight, start_time, bucket), upsert=True)
+                        for fight, bucket in buckets.items()]
+            requests.append(DeleteMany({"code": code, "fight": {"$nin": list(buckets)}}))
+            self.__deaths_collection.bulk_write(requests)
+            return
+        if not buckets:
+            return
+        try:
+            self.__deaths_collection.bulk_write([InsertOne(self.__encode_bucket(code, fight, start_time, bucket))
+                                                 for fight, bucket in buckets.items()], ordered=False)
+        except BulkWriteError as e:
+            # Another worker which loaded or refreshed the report at the same time stored the same buckets.
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    def __encode_bucket(self, code: str, fight: int, start_time: float, deaths: list) -> dict:
+        """
+        Build the death bucket of a fight in the configured storage format.
+        :param code: The report code.
+        :param fight: The fight ID.
+        :param start_time: The start time of the report.
+        :param deaths: The deaths of the fight.
+        :return: The document to store. The fight ID is not repeated in every death.
+        """
+        if self.__columnar:
+            columns = Columnar.encode_deaths(deaths, start_time)
+            del columns["fight"]
+            return {"code": code, "fight": fight, "deaths": columns}
+        return {"code": code, "fight": fight,
+                "deaths": [{key: value for key, value in death.items() if key != "fight"} for death in deaths]}
+
+    @staticmethod
+    def __decode_bucket(bucket: dict) -> list:
+        """
+        Read the deaths of a death bucket in either storage format.
+        :param bucket: The death bucket.
+        :return: The deaths.
+        """
+        deaths = Columnar.decode_deaths(bucket["deaths"]) if isinstance(bucket["deaths"], dict) else bucket["deaths"]
+        for death in deaths:
+            death["fight"] = bucket["fight"]
+        return deaths
+
+    def __encode_report(self, report: dict) -> dict:
+        """
+        Convert a report to the configured storage format. Its deaths are not part of the document, they are stored
+        in death buckets (see __write_deaths).
+        :param report: The report with its fights as a list. It is not modified.
+        :return: The document to store.
+        """
+        document = {key: value for key, value in report.items() if key not in ("columnar", "bucketed", "deaths")}
+        document["bucketed"] = True
+        if self.__columnar:
+            return Columnar.encode_report(document)
+        return document
+
+    @staticmethod
+    def __resolve_fields(fields: Optional[Iterable[str]], fight_id: Optional[int]) -> Optional[set]:
+        """
+        Validate the requested field groups.
+        :param fields: The requested field groups, or None for the full report.
+        :param fight_id: The fight to return deaths for, if any.
+        :return: The set of field groups, or None for the full report.
+        """
+        if fields is None:
+            return None if fight_id is None else {"deaths"}
+        fields = set(fields)
+        unknown_fields = fields - REPORT_FIELDS.keys()
+        if unknown_fields:
+            raise ValueError(f"Unknown report fields: {', '.join(sorted(unknown_fields))}")
+        if fight_id is not None:
+            fields.add("deaths")
+        return fields
+
+    @staticmethod
+    def __projection(fields: set, fight_id: Optional[int]) -> dict:
+        """
+        Build the MongoDB projection for the requested field groups.
+        :param fields: The field groups.
+        :param fight_id: If given, the deaths are filtered to this fight.
+        :return: The projection.
+        """
+        projection = {key: 1 for group in fields | {"metadata"} for key in REPORT_FIELDS[group]}
+        projection["bucketed"] = 1
+        if fight_id is not None:
+            # Deaths stored in the report (before deaths were bucketed) are filtered in the database, unless they are
+            # columnar. Those are sliced by the death index instead.
+            projection["deaths"] = {"$cond": [{"$isArray": "$deaths"},
+                                              {"$filter": {"input": "$deaths", "as": "death",
+                                                           "cond": {"$eq": ["$$death.fight", fight_id]}}},
+                                              "$deaths"]}
+            del projection["death_index"]
+            projection[f"death_index.{fight_id}"] = 1
+        return projection
+
+    @staticmethod
+    def __project_report(report: dict, fields: set, fight_id: Optional[int]) -> dict:
+        """
+        Reduce a report to the requested field groups, the same way __projection does in the database.
+        :param report: The report.
+        :param fields: The field groups.
+        :param fight_id: If given, the deaths are filtered to this fight.
+        :return: The reduced report.
+        """
+        keys = {key for group in fields | {"metadata"} for key in REPORT_FIELDS[group]} | {"_id"}
+        report = {key: value for key, value in report.items() if key in keys}
+        if fight_id is not None and "death_index" in report:
+            entry = report["death_index"].get(str(fight_id))
+            report["deaths"] = report["deaths"][entry["start"]:entry["start"] + entry["count"]] if entry else []
+            report["death_index"] = {str(fight_id): entry} if entry else {}
+        return report
+
+    def __load_report(self, code: str, fflogs_token: str,
+                      progress: Optional[Callable[[str, dict], None]] = None) -> (int, Optional[dict]):
+        """
+        Load a report from FFLogs and store it in the database.
+        :param code: The report code.
+        :param fflogs_token: The fflogs auth token.
+        :param progress: Optional callback for partial results, see FFLogs.API.get_report_data.
+        :return: A status code for the request, and the report if it could be loaded.
+        """
+        # Another worker may have finished loading the report just before we started.
+        existing = self.__find_report(code)
+        if existing:
+            return existing
+
+        status, report = FFLogs.API.get_report_data(fflogs_token, code, progress)
+        if status == 200:
+            if report is not None:
+                # If the report was loaded successfully, store it in the database.
+                report["version"] = 1
+                report["versions"] = [self.__version_mark(report)]
+                # The deaths are read back from their buckets in the order of the fights.
+                report["deaths"].sort(key=lambda death: death["fight"])
+                report["death_index"] = self.__index_deaths(report["fights"], report["deaths"])
+                # The buckets are written first, so the report is never stored without its deaths.
+                self.__write_deaths(code, report["startTime"], report["deaths"])
+                try:
+                    report["_id"] = self.__report_collection.insert_one(self.__encode_report(report)).inserted_id
+                    report["columnar"] = self.__columnar
+                    report["bucketed"] = True
+                except DuplicateKeyError:
+                    # Someone else stored the report in the meantime, use theirs.
+                    report = self.__read_report({"code": code})
+                self.__report_cache.set(report)
+            else:
+                # Custom error code to signify that the report is successfully loaded, but has no data.
+                # Note that this is different from an empty report, as here, no metadata is available.
+                status = 800
+        return status, report
+
+    def __find_report(self, code: str) -> Optional[tuple]:
+        """
+        Read a stored report from the database.
+        :param code: The report code.
+        :return: A tuple of (200, report) if the report exists, otherwise None.
+        """
+        report = self.__read_report({"code": code})
+        return (200, report) if report else None
+
+    def __refresh_report(self, report: dict, fflogs_token: str, unknown: bool) -> (int, dict, Optional[dict]):
+        """
+        Refresh a stored report if it is still due for an update. Must be called while holding the report's lease.
+        :param report: The stored report, including its database ID.
+        :param fflogs_token: The fflogs auth token.
+        :param unknown: Whether to include unknown encounters (ID=0).
+        :return: See __update_report.
+        """
+        # Another worker may have refreshed the report between our read and acquiring the lease.
+        report = self.__read_report({"_id": report["_id"]}) or report
+        if time.time() - report["loaded_at"] <= self.__allow_updates_every_n_seconds:
+            return 200, report, None
+        return self.__update_report(report, fflogs_token, unknown)
+
+    def __update_report(self, report: dict, fflogs_token: str, unknown: bool) -> (int, dict, Optional[dict]):
+        """
+        Refresh a stored report from FFLogs. Unless unknown encounters are requested or the last known fight has
+        changed since, only the new data is fetched and appended to the stored document.
+        :param report: The stored report, including its database ID.
+        :param fflogs_token: The fflogs auth token.
+        :param unknown: Whether to include unknown encounters (ID=0).
+        :return: The status code, the latest known report, and the delta that was applied. If the refresh failed,
+        the report is returned unmodified. If another worker refreshed the report at the same time, the report is
+        re-read from the database and the delta is None.
+        """
+        delta = None
+        if not unknown:
+            status, delta = FFLogs.API.try_load_report_delta(fflogs_token, report)
+            if status != 200:
+                return status, report, None
+
+        if unknown or delta.get("last_fight_changed"):
+            # Fights with ID 0 before the last known fight may have been dismissed, and a fight which was still in
+            # progress can't be replaced by a delta, so reload the full report.
+            status, new_report = FFLogs.API.try_update_report(fflogs_token, report, unknown=unknown)
+            if status != 200:
+                return status, report, None
+            new_report["_id"] = report["_id"]
+            new_report["version"] = report.get("version", 0) + 1
+            # Fights and deaths may have been inserted anywhere, so clients can't be sent a delta from older versions.
+            new_report["versions"] = [self.__version_mark(new_report)]
+            new_report["deaths"].sort(key=lambda death: death["fight"])
+            new_report["death_index"] = self.__index_deaths(new_report["fights"], new_report["deaths"])
+            self.__report_cache.invalidate(report["code"])
+            self.__write_deaths(report["code"], new_report["startTime"], new_report["deaths"], replace=True)
+            self.__report_collection.replace_one({"_id": report["_id"]}, self.__encode_report(new_report), upsert=True)
+            new_report["columnar"] = self.__columnar
+            new_report["bucketed"] = True
+            return 200, new_report, dict(new_report, full=True)
+
+        # Only write what changed: new fights go to the front (latest pull first), new deaths to the back.
+        update = {
+            "$set": {key: delta[key] for key in ("endTime", "loaded_at", "last_queried_death_timestamp",
+                                                 "last_fight_id")},
+            "$inc": {"version": 1},
+        }
+        for pid, player in delta["player_data"].items():
+            update["$set"][f"player_data.{pid}"] = player
+        delta["deaths"].sort(key=lambda death: death["fight"])
+        bucketed = report.get("bucketed", False)
+        if not bucketed:
+            # Move the deaths of reports stored before deaths were bucketed out of the report, and index them in the
+            # order of their buckets.
+            report["deaths"].sort(key=lambda death: death["fight"])
+            report["death_index"] = self.__index_deaths(report["fights"], report["deaths"])
+            self.__write_deaths(report["code"], report["startTime"], report["deaths"])
+            update["$set"]["bucketed"] = True
+            update["$unset"] = {"deaths": ""}
+        # The new deaths all belong to the new fights, so they only need new buckets and index entries, and are
+        # appended to the stored deaths.
+        self.__write_deaths(report["code"], report["startTime"], delta["deaths"])
+        delta["death_index"] = self.__index_deaths(delta["fights"], delta["deaths"], offset=len(report["deaths"]))
+        if bucketed:
+            for fight_id, entry in delta["death_index"].items():
+                update["$set"][f"death_index.{fight_id}"] = entry
+        else:
+            update["$set"]["death_index"] = dict(report["death_index"], **delta["death_index"])
+        # Remember how many fights and deaths the new version has, so clients can be sent what was added since.
+        mark = {"version": report.get("version", 0) + 1,
+                "fights": len(report["fights"]) + len(delta["fights"]),
+                "deaths": len(report["deaths"]) + len(delta["deaths"])}
+        update["$push"] = {"versions": {"$each": [mark], "$slice": -VERSION_HISTORY}}
+        if report.get("columnar", False) != self.__columnar:
+            # Convert the stored fights to the configured format.
+            document = self.__encode_report(dict(report, fights=delta["fights"] + report["fights"]))
+            update["$set"]["fights"] = document["fights"]
+            if self.__columnar:
+                update["$set"]["columnar"] = True
+            else:
+                update.setdefault("$unset", {})["columnar"] = ""
+        elif delta["fights"] and report.get("columnar"):
+            # Push every column of the new fights, the stored values don't change.
+            for key, column in Columnar.encode_fights(delta["fights"], report["startTime"]).items():
+                if key != "base":
+                    update["$push"][f"fights.{key}"] = {"$each": column, "$position": 0}
+        elif delta["fights"]:
+            update["$push"]["fights"] = {"$each": delta["fights"], "$position": 0}
+
+        # The version guards against applying a delta twice if another worker refreshed the report in the meantime.
+        self.__report_cache.invalidate(report["code"])
+        result = self.__report_collection.update_one({"_id": report["_id"], "version": report.get("version")}, update)
+        if result.matched_count == 0:
+            return 200, self.__read_report({"_id": report["_id"]}), None
+
+        # Apply the same delta to the report we already have in memory.
+        report["fights"] = delta["fights"] + report["fights"]
+        report["deaths"] = report["deaths"] + delta["deaths"]
+        report["player_data"].update(delta["player_data"])
+        report["death_index"].update(delta["death_index"])
+        for key in ("endTime", "loaded_at", "last_queried_death_timestamp", "last_fight_id"):
+            report[key] = delta[key]
+        report["version"] = mark["version"]
+        report["versions"] = (report.get("versions", []) + [mark])[-VERSION_HISTORY:]
+        report["columnar"] = self.__columnar
+        report["bucketed"] = True
+        delta["version"] = report["version"]
+        return 200, report, delta
+
+    @staticmethod
+    def __version_mark(report: dict) -> dict:
+        """
+        Describe the current version of a report by its number of fights and deaths.
+        :param report: The report.
+        :return: The version mark.
+        """
+        return {"version": report["version"], "fights": len(report["fights"]), "deaths": len(report["deaths"])}
+
+    @staticmethod
+    def __index_deaths(fights: list, deaths: list, offset: int = 0) -> dict:
+        """
+        Group deaths by fight. Deaths are stored in chronological order, so the deaths of a fight are consecutive and
+        the deaths in its wipe come last.
+        :param fights: The fights the deaths belong to.
+        :param deaths: The deaths.
+        :param offset: The position of the first of the given deaths in the deaths of the report.
+        :return: A dictionary of fight ID (as string due to MongoDB limitations) to the position of the first death of
+        the fight in the deaths of the report ("start"), its number of deaths ("count"), how many of them are part of
+        the wipe ("wipe_count", see WIPE_SECONDS) and the IDs of the players who died ("players").
+        """
+        end_times = {fight["id"]: fight["endTime"] for fight in fights}
+        index = {}
+        for position, death in enumerate(deaths, start=offset):
+            entry = index.setdefault(str(death["fight"]), {"start": position, "count": 0, "wipe_count": 0,
+                                                           "players": []})
+            entry["count"] += 1
+            if death["fight"] in end_times and death["timestamp"] >= end_times[death["fight"]] - WIPE_SECONDS:
+                entry["wipe_count"] += 1
+            if death["targetID"] not in entry["players"]:
+                entry["players"].append(death["targetID"])
+        return index
+
+    @staticmethod
+    def __diff_report(report: dict, since_version: int) -> dict:
+        """
+        Reduce a report to what was added after a given version. Fights are only ever added to the front and deaths to
+        the back of a report between versions, so the version marks tell which ones are new.
+        :param report: The full report, with encounter names.
+        :param since_version: The version the client has.
+        :return: A delta with the key "delta" set to True, containing the metadata of the report and the new fights,
+        deaths, player_data entries and encounternames. If the version is unknown, the full report is returned.
+        """
+        mark = next((mark for mark in report.get("versions", []) if mark["version"] == since_version), None)
+        if mark is None:
+            return report
+
+        fights = report["fights"][:len(report["fights"]) - mark["fights"]]
+        deaths = report["deaths"][mark["deaths"]:]
+        pids = set(str(death["targetID"]) for death in deaths)
+        encounter_ids = set(fight["encounterID"] for fight in fights)
+        delta = {key: report[key] for key in REPORT_FIELDS["metadata"] if key in report}
+        delta.update({
+            "delta": True,
+            "fights": fights,
+            "deaths": deaths,
+            "death_index": {fight_id: entry for fight_id, entry in report.get("death_index", {}).items()
+                            if entry["start"] >= mark["deaths"]},
+            "player_data": {pid: player for pid, player in report["player_data"].items() if pid in pids},
+            "encounternames": {eid: name for eid, name in report.get("encounternames", {}).items()
+                               if eid in encounter_ids},
+        })
+        return delta
+
     def __append_encounter_dict(self, report: dict, fflogs_token: str) -> (int, Optional[dict]):
         """
         Appends the encounter dictionary for the encounter ID of all fights provided in the report to it.
@@ -115,30 +823,77 @@ class MongoDBConnection:
         """
         status = 200
         required_id_set = set([fight["encounterID"] for fight in report["fights"]])
-        for encounter_id in required_id_set:
-            # The encounter dictionary uses strings due to MongoDB limitations.
-            if str(encounter_id) not in self.__fflogs_encounters:
-                # Try to query each missing encounter ID from FFLogs.
-                status, name = FFLogs.API.query_for_encounter_name(fflogs_token, encounter_id)
-                if status == 200:
-                    # If the name was found, store it in the dictionary and the database.
-                    # This is not very performant, but it is a one-time cost, and ensures that if we fail partway
-                    # through the process, we don't have to start over.
-                    self.__fflogs_encounters[str(encounter_id)] = name
-                    self.__metadata_collection.replace_one({"name": "encounter_dict"},
-                                                           {"name": "encounter_dict",
-                                                            "encounter_mappings": self.__fflogs_encounters},
-                                                           upsert=True)
-                else:
-                    # We stop on a non-200 status code.
-                    break
+        # The encounter dictionary uses strings due to MongoDB limitations.
+        encounters = self.__fflogs_encounters
+        missing_ids = [eid for eid in required_id_set if str(eid) not in encounters]
+        if missing_ids:
+            # Requests in this process which are waiting for the same names wait for the first one to resolve them.
+            with self.__encounter_lock:
+                # Another request or worker may have resolved the names already.
+                self.__reload_encounter_dict()
+                encounters = self.__fflogs_encounters
+                missing_ids = [eid for eid in missing_ids if str(eid) not in encounters]
+                if missing_ids and self.__preload_encounters and not self.__encounters_preloaded:
+                    # Only attempt the bulk load once per process, whether it succeeds or not.
+                    self.__encounters_preloaded = True
+                    self.preload_encounter_names(fflogs_token)
+                    encounters = self.__fflogs_encounters
+                    missing_ids = [eid for eid in missing_ids if str(eid) not in encounters]
+                if missing_ids:
+                    # Query all missing encounter IDs from FFLogs at once.
+                    status, names = FFLogs.API.query_for_encounter_names(fflogs_token, missing_ids)
+                    if status == 200:
+                        self.__store_encounter_names(names)
+                        encounters = self.__fflogs_encounters
         # If we succeeded, append the dictionary to the report.
         if status == 200:
-            report["encounternames"] = {int(k): v for k, v in self.__fflogs_encounters.items()
-                                        if int(k) in required_id_set}
+            report["encounternames"] = {int(k): v for k, v in encounters.items() if int(k) in required_id_set}
 
         return status, report
 
+    @Metrics.registry.timed("vodsync_mongo_operation_seconds")
+    def preload_encounter_names(self, fflogs_token: str) -> int:
+        """
+        Loads the names of all encounters in the current zones from FFLogs and stores the unknown ones.
+        :param fflogs_token: The fflogs auth token.
+        :return: The status code of the FFLogs query.
+        """
+        # Names which are missing afterwards are queried individually, so the bulk load may be skipped.
+        with FFLogs.API.priority(PREFETCH):
+            status, names = FFLogs.API.query_for_zone_encounters(fflogs_token)
+        if status == 200:
+            encounters = self.__fflogs_encounters
+            self.__store_encounter_names({eid: name for eid, name in names.items() if str(eid) not in encounters})
+        return status
+
+    def __reload_encounter_dict(self) -> None:
+        """
+        Refreshes the cached encounter dictionary from the database.
+        """
+        encounters = self.__metadata_collection.find_one({"name": "encounter_dict"})
+        if encounters:
+            self.__fflogs_encounters = dict(self.__fflogs_encounters, **encounters["encounter_mappings"])
+
+    def __store_encounter_names(self, names: dict) -> None:
+        """
+        Stores encounter names in the cached dictionary and the database. Only the given keys are written.
+        :param names: Dictionary of encounter ID to name.
+        """
+        if len(names) == 0:
+            return
+        self.__fflogs_encounters = dict(self.__fflogs_encounters, **{str(eid): name for eid, name in names.items()})
+        self.__metadata_collection.update_one({"name": "encounter_dict"},
+                                              {"$set": {f"encounter_mappings.{eid}": name
+                                                        for eid, name in names.items()}},
+                                              upsert=True)
+
+    def verify_query_plans(self) -> dict:
+        """
+        Explains every hot query of the application.
+        :return: A dictionary of query name to the stages of its winning plan. See Indexes.verify_query_plans.
+        """
+        return Indexes.verify_query_plans(self.__db)
+
     def get_client(self) -> MongoClient:
         """
         Returns the underlying MongoClient.
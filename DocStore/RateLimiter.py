@@ -0,0 +1,198 @@
+import threading
+import time
+from typing import Optional
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+# Request priorities, from most to least important.
+INTERACTIVE = 0
+BACKGROUND = 1
+PREFETCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background", PREFETCH: "prefetch"}
+
+
+class RateLimiter:
+    def __init__(self, collection: Collection, key: str = "fflogs", default_limit: int = 3600,
+                 ceilings: Optional[dict] = None, slowdown_fraction: float = 0.25, max_delay: float = 5.0,
+                 max_wait: float = 10.0, sync_seconds: float = 30.0, batch_size: int = 10,
+                 state_seconds: float = 1.0) -> None:
+        """
+        Budgets the calls to an API with an hourly points limit (like FFLogs) across all workers. The points spent in
+        the current hour are counted in a shared document:
+        - Every call reserves its points before it is sent, from an allowance of batch_size points which each worker
+          draws from the shared count at once. Most calls therefore don't touch the database. A worker wastes at most
+          one allowance per hour. The count is corrected whenever the API reports how many points were actually spent
+          (see record).
+        - Less important calls may only spend part of the budget (ceilings), so interactive requests keep working
+          when background refreshes and prefetching would exhaust it.
+        - Once less than slowdown_fraction of the budget of a priority is left, its calls are spread over the rest of
+          the hour instead of being sent at once. Calls whose budget is exhausted wait for the next hour, up to
+          max_wait seconds for interactive calls. Other calls are rejected right away.
+        :param collection: The collection storing the budget.
+        :param key: The ID of the budget document.
+        :param default_limit: The points per hour until the API reported its limit.
+        :param ceilings: A dictionary of priority to the fraction of the hourly limit calls of that priority may spend.
+        :param slowdown_fraction: The fraction of its budget below which calls of a priority are spread out.
+        :param max_delay: The maximum time in seconds a call is delayed to spread out calls.
+        :param max_wait: The maximum time in seconds an interactive call waits for the next hour.
+        :param sync_seconds: The minimum time in seconds between requests for the points actually spent (see
+        sync_due).
+        :param batch_size: The points a worker draws from the shared count at once. Near the ceiling of a priority,
+        only the points of a single call are drawn.
+        :param state_seconds: How long a worker trusts that a priority is out of budget without reading the count.
+        """
+        self.__collection = collection
+        self.__key = key
+        self.__default_limit = default_limit
+        self.__ceilings = ceilings or {INTERACTIVE: 1.0, BACKGROUND: 0.8, PREFETCH: 0.6}
+        self.__slowdown_fraction = slowdown_fraction
+        self.__max_delay = max_delay
+        self.__max_wait = max_wait
+        self.__sync_seconds = sync_seconds
+        self.__last_sync = 0.0
+        self.__sync_lock = threading.Lock()
+        self.__batch_size = batch_size
+        self.__state_seconds = state_seconds
+        # The budget document as of the last draw, the time it was read, and the points of it this worker drew but
+        # did not spend yet.
+        self.__state = None
+        self.__state_read_at = 0.0
+        self.__allowance = 0
+        self.__allowance_lock = threading.Lock()
+
+    def acquire(self, priority: int = INTERACTIVE, cost: float = 1) -> bool:
+        """
+        Reserve points for a call, waiting as long as the budget requires.
+        :param priority: The priority of the call.
+        :param cost: The estimated points the call costs.
+        :return: True if the call may be sent, False if the budget of its priority is exhausted.
+        """
+        deadline = time.time() + (self.__max_wait if priority == INTERACTIVE else 0)
+        while True:
+            allowed, delay = self.__reserve(priority, cost)
+            if allowed or time.time() + delay > deadline:
+                break
+            time.sleep(delay)
+        if allowed and delay > 0:
+            time.sleep(delay)
+        return allowed
+
+    def sync_due(self) -> bool:
+        """
+        Check whether the next call should ask the API for the points spent, and if so, reset the timer. Asking with
+        every call would make every response larger.
+        :return: True if the points spent were last reported more than sync_seconds ago.
+        """
+        with self.__sync_lock:
+            if time.time() - self.__last_sync < self.__sync_seconds:
+                return False
+            self.__last_sync = time.time()
+            return True
+
+    def record(self, limit: float, spent: float, reset_in: float) -> None:
+        """
+        Correct the budget with the points spent as reported by the API.
+        :param limit: The points per hour.
+        :param spent: The points spent in the current hour.
+        :param reset_in: Seconds until the points spent are reset.
+        """
+        reset_at = time.time() + reset_in
+        # A reset a minute or more later than the stored one means a new hour has started, otherwise the reported points
+        # may lag behind reservations made since the query was answered.
+        self.__collection.update_one({"_id": self.__key, "reset_at": {"$lt": reset_at - 60}},
+                                     {"$set": {"limit": limit, "spent": spent, "reset_at": reset_at}})
+        self.__collection.update_one({"_id": self.__key},
+                                     {"$set": {"limit": limit, "reset_at": reset_at}, "$max": {"spent": spent}},
+                                     upsert=True)
+
+    def get_budget(self) -> dict:
+        """
+        Get the budget of the current hour.
+        :return: A dictionary with the points per hour ("limit"), the points spent and remaining, the epoch time at
+        which the points are reset ("reset_at"), and the points left for each priority by name ("available").
+        """
+        state = self.__get_state()
+        return {
+            "limit": state["limit"],
+            "spent": state["spent"],
+            "remaining": max(state["limit"] - state["spent"], 0),
+            "reset_at": state["reset_at"],
+            "available": {name: max(state["limit"] * self.__ceilings[priority] - state["spent"], 0)
+                          for priority, name in PRIORITY_NAMES.items()},
+        }
+
+    def __reserve(self, priority: int, cost: float) -> (bool, float):
+        """
+        Try to reserve points for a call from the allowance of this worker, drawing more from the shared count if
+        needed.
+        :param priority: The priority of the call.
+        :param cost: The estimated points the call costs.
+        :return: A tuple of whether the points were reserved, and the time in seconds to wait: before sending the
+        call if it was, or before trying again if not.
+        """
+        with self.__allowance_lock:
+            now = time.time()
+            if self.__state is None or self.__state["reset_at"] <= now:
+                # The allowance of the previous hour is void.
+                self.__read_state(self.__get_state())
+                self.__allowance = 0
+            ceiling = self.__state["limit"] * self.__ceilings[priority]
+            # Points drawn but not spent yet are not really spent.
+            if self.__allowance < cost or self.__state["spent"] - self.__allowance + cost > ceiling:
+                if not self.__draw(ceiling, cost):
+                    # Exhausted until the next hour.
+                    return False, max(self.__state["reset_at"] - now, 0)
+            self.__allowance -= cost
+            available = ceiling - (self.__state["spent"] - self.__allowance)
+            if available >= ceiling * self.__slowdown_fraction:
+                return True, 0
+            # Spread the remaining budget over the rest of the hour.
+            return True, min((self.__state["reset_at"] - now) * cost / max(available, cost), self.__max_delay)
+
+    def __draw(self, ceiling: float, cost: float) -> bool:
+        """
+        Draw points from the shared count into the allowance of this worker.
+        :param ceiling: The points calls of the priority may spend this hour.
+        :param cost: The points the call needs.
+        :return: True if at least the points of the call were drawn.
+        """
+        if self.__state["spent"] + cost > ceiling and time.time() - self.__state_read_at < self.__state_seconds:
+            # The count was just read, don't ask again for every rejected call.
+            return False
+        # Near the ceiling, only draw what the call needs, so this worker doesn't hold points others could use.
+        batch = self.__batch_size if ceiling - self.__state["spent"] >= ceiling * self.__slowdown_fraction else cost
+        for amount in dict.fromkeys((max(batch, cost), cost)):
+            state = self.__collection.find_one_and_update({"_id": self.__key, "spent": {"$lte": ceiling - amount}},
+                                                          {"$inc": {"spent": amount}},
+                                                          return_document=ReturnDocument.AFTER)
+            if state is not None:
+                self.__read_state(state)
+                self.__allowance += amount
+                return True
+        self.__read_state(self.__get_state())
+        return False
+
+    def __read_state(self, state: dict) -> None:
+        """
+        Remember the budget document.
+        :param state: The budget document.
+        """
+        self.__state = state
+        self.__state_read_at = time.time()
+
+    def __get_state(self) -> dict:
+        """
+        Read the budget document, starting a new hour if the previous one is over.
+        :return: The budget document.
+        """
+        now = time.time()
+        state = self.__collection.find_one({"_id": self.__key})
+        if state is None or state["reset_at"] <= now:
+            # Only one worker starts the new hour, the others read what it stored.
+            query = {"_id": self.__key} if state is None else {"_id": self.__key, "reset_at": state["reset_at"]}
+            update = {"$set": {"spent": 0, "reset_at": now + 3600}}
+            if state is None:
+                update["$setOnInsert"] = {"limit": self.__default_limit}
+            self.__collection.update_one(query, update, upsert=state is None)
+            state = self.__collection.find_one({"_id": self.__key})
+        return state
@@ -0,0 +1,254 @@
+import datetime
+import pickle
+import time
+import uuid
+from typing import Iterable, Optional
+from flask import Flask, Request, Response
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from itsdangerous import BadSignature
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from werkzeug.datastructures import CallbackDict
+from DocStore.Cache import LRUCache
+
+
+class CachedSession(CallbackDict, SessionMixin):
+    def __init__(self, initial: Optional[dict] = None, sid: Optional[str] = None, version: int = 0,
+                 stored: Optional[bytes] = None, stored_expires_at: Optional[float] = None,
+                 cookie_data: Optional[dict] = None, cookie_expires_at: Optional[float] = None,
+                 reissue: bool = False) -> None:
+        """
+        A session which remembers what was loaded, so it is only written back if it changed.
+        :param initial: The session data.
+        :param sid: The session id, or None if the session has no server side part yet.
+        :param version: The version of the stored session.
+        :param stored: The serialized server side part as loaded, or None if nothing is stored.
+        :param stored_expires_at: Epoch time at which the stored part expires.
+        :param cookie_data: The part of the session loaded from the signed cookie.
+        :param cookie_expires_at: Epoch time at which the signed cookie expires.
+        :param reissue: Whether the session cookie has to be replaced, because it names an old version or a session
+        which is not stored anymore.
+        """
+
+        def on_update(self) -> None:
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.stored = stored
+        self.stored_expires_at = stored_expires_at
+        self.cookie_data = cookie_data or {}
+        self.cookie_expires_at = cookie_expires_at
+        self.reissue = reissue
+        self.modified = False
+
+
+class CachedMongoSessionInterface(SessionInterface):
+    serializer = pickle
+    session_class = CachedSession
+
+    def __init__(self, collection: Collection, key_prefix: str = "session:", cache_max_bytes: int = 8 * 1024 * 1024,
+                 cache_seconds: int = 300, refresh_seconds: int = 24 * 60 * 60,
+                 cookie_keys: Iterable[str] = ()) -> None:
+        """
+        Stores sessions in MongoDB, in the same documents as Flask-Session ({id, val, expiration}), but avoids most of
+        its database round trips:
+        - Sessions are cached in-process. The session cookie carries the version of the stored session next to its
+          id, so a worker only uses its cached copy if it is the version the browser last received. Sessions changed
+          by other workers are read from the database.
+        - Sessions are only written if they changed (including changes to nested values, e.g. a refreshed token in
+          session["auths"]), or once per refresh_seconds to extend their expiration.
+        - Optionally, keys which hold no secrets are stored in a signed cookie instead (requires a secret key).
+          Sessions consisting only of such keys never touch the database.
+        A logout on one worker is seen by the other workers once their cached copy expires, after cache_seconds.
+        :param collection: The collection storing the sessions.
+        :param key_prefix: The prefix of the session ids in the collection.
+        :param cache_max_bytes: The maximum size of the in-process session cache.
+        :param cache_seconds: How long sessions are cached in-process.
+        :param refresh_seconds: Time in seconds after which an unchanged session is written again, to extend its
+        expiration.
+        :param cookie_keys: The session keys stored in the signed cookie, e.g. ["user"].
+        """
+        self.__collection = collection
+        self.__key_prefix = key_prefix
+        self.__cache = LRUCache(cache_max_bytes)
+        self.__cache_seconds = cache_seconds
+        self.__refresh_seconds = refresh_seconds
+        self.__cookie_keys = set(cookie_keys)
+        self.__cookie_serializer = SecureCookieSessionInterface()
+
+    def open_session(self, app: Flask, request: Request) -> CachedSession:
+        """
+        Load the session of a request, from the cookies, the in-process cache or the database.
+        :param app: The application.
+        :param request: The request.
+        :return: The session.
+        """
+        cookie_data, cookie_expires_at = self.__load_cookie_data(app, request)
+
+        sid, version = self.__parse_cookie(request.cookies.get(app.session_cookie_name))
+        if sid is None:
+            return self.session_class(cookie_data, cookie_data=cookie_data, cookie_expires_at=cookie_expires_at)
+
+        entry = self.__cache.get(sid)
+        if entry is not None:
+            stored_version, stored_expires_at, stored = self.serializer.loads(entry)
+        if entry is None or stored_version != version:
+            stored_version, stored_expires_at, stored = self.__load(sid)
+
+        if stored is None:
+            # the session expired or was deleted. A new session gets a new id rather than the one sent by the browser.
+            return self.session_class(cookie_data, cookie_data=cookie_data, cookie_expires_at=cookie_expires_at,
+                                      reissue=True)
+
+        data = dict(cookie_data)
+        data.update(self.serializer.loads(stored))
+        return self.session_class(data, sid=sid, version=stored_version, stored=stored,
+                                  stored_expires_at=stored_expires_at, cookie_data=cookie_data,
+                                  cookie_expires_at=cookie_expires_at, reissue=stored_version != version)
+
+    def save_session(self, app: Flask, session: CachedSession, response: Response) -> None:
+        """
+        Write the parts of the session which changed, and set the cookies.
+        :param app: The application.
+        :param session: The session.
+        :param response: The response.
+        """
+        signing_serializer = self.__cookie_serializer.get_signing_serializer(app)
+        cookie_keys = self.__cookie_keys if signing_serializer is not None else set()
+        server_data = {key: value for key, value in session.items() if key not in cookie_keys}
+        cookie_data = {key: value for key, value in session.items() if key in cookie_keys}
+
+        # server side part
+        if not server_data:
+            if session.sid is not None:
+                self.__collection.delete_one({"id": self.__key_prefix + session.sid})
+                self.__cache.delete(session.sid)
+            if session.sid is not None or session.reissue:
+                self.__delete_cookie(app, response, app.session_cookie_name)
+        else:
+            stored = self.serializer.dumps(server_data)
+            if session.sid is None:
+                session.sid = str(uuid.uuid4())
+            if stored != session.stored or self.__refresh_due(app, session.stored_expires_at):
+                self.__store(app, session, stored)
+                session.reissue = True
+            if session.reissue:
+                self.__set_cookie(app, response, app.session_cookie_name, f"{session.sid}.{session.version}")
+
+        # signed cookie part
+        if not cookie_data:
+            if session.cookie_data:
+                self.__delete_cookie(app, response, self.__data_cookie_name(app))
+        elif cookie_data != session.cookie_data or self.__refresh_due(app, session.cookie_expires_at):
+            self.__set_cookie(app, response, self.__data_cookie_name(app), signing_serializer.dumps(cookie_data))
+
+    def __load(self, sid: str) -> (int, Optional[float], Optional[bytes]):
+        """
+        Read a session from the database and cache it.
+        :param sid: The session id.
+        :return: A tuple of the version, the epoch time at which the session expires and the serialized session, or
+        (0, None, None) if no session is stored.
+        """
+        document = self.__collection.find_one({"id": self.__key_prefix + sid})
+        if document is None:
+            return 0, None, None
+        expires_at = document["expiration"].replace(tzinfo=datetime.timezone.utc).timestamp()
+        if expires_at <= time.time():
+            return 0, None, None
+        entry = (document.get("version", 0), expires_at, bytes(document["val"]))
+        self.__cache.set(sid, self.serializer.dumps(entry), min(expires_at, time.time() + self.__cache_seconds))
+        return entry
+
+    def __store(self, app: Flask, session: CachedSession, stored: bytes) -> None:
+        """
+        Write the server side part of a session to the database and the cache.
+        :param app: The application.
+        :param session: The session. Its version and expiration are updated.
+        :param stored: The serialized server side part.
+        """
+        expiration = datetime.datetime.utcnow() + app.permanent_session_lifetime
+        # the version is incremented by the database, so concurrent writes from several workers never share a version
+        document = self.__collection.find_one_and_update({"id": self.__key_prefix + session.sid},
+                                                         {"$set": {"val": stored, "expiration": expiration},
+                                                          "$inc": {"version": 1}},
+                                                         projection={"version": 1}, upsert=True,
+                                                         return_document=ReturnDocument.AFTER)
+        session.version = document["version"]
+        session.stored = stored
+        session.stored_expires_at = expiration.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.__cache.set(session.sid, self.serializer.dumps((session.version, session.stored_expires_at, stored)),
+                         min(session.stored_expires_at, time.time() + self.__cache_seconds))
+
+    def __refresh_due(self, app: Flask, expires_at: Optional[float]) -> bool:
+        """
+        Check whether an unchanged part of the session has to be written again to extend its expiration.
+        :param app: The application.
+        :param expires_at: Epoch time at which the part expires, or None if unknown.
+        :return: True if the part was last written more than refresh_seconds ago.
+        """
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        return expires_at is None or expires_at - time.time() < lifetime - self.__refresh_seconds
+
+    def __load_cookie_data(self, app: Flask, request: Request) -> (dict, Optional[float]):
+        """
+        Read the part of the session stored in the signed cookie.
+        :param app: The application.
+        :param request: The request.
+        :return: A tuple of the data and the epoch time at which the cookie expires. Invalid or expired cookies are
+        ignored.
+        """
+        signing_serializer = self.__cookie_serializer.get_signing_serializer(app)
+        value = request.cookies.get(self.__data_cookie_name(app))
+        if not self.__cookie_keys or signing_serializer is None or not value:
+            return {}, None
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        try:
+            data, signed_at = signing_serializer.loads(value, max_age=lifetime, return_timestamp=True)
+        except BadSignature:
+            return {}, None
+        return data, signed_at.timestamp() + lifetime
+
+    @staticmethod
+    def __parse_cookie(value: Optional[str]) -> (Optional[str], Optional[int]):
+        """
+        Split the session cookie into the session id and version. Cookies set by Flask-Session only hold the id.
+        :param value: The cookie value.
+        :return: The session id (or None if there is no cookie) and the version (or None if it is unknown).
+        """
+        if not value:
+            return None, None
+        sid, _, version = value.partition(".")
+        return sid, int(version) if version.isdigit() else None
+
+    def __set_cookie(self, app: Flask, response: Response, name: str, value: str) -> None:
+        """
+        Set a session cookie with the configured cookie options.
+        :param app: The application.
+        :param response: The response.
+        :param name: The cookie name.
+        :param value: The cookie value.
+        """
+        response.set_cookie(name, value,
+                            expires=datetime.datetime.now(datetime.timezone.utc) + app.permanent_session_lifetime,
+                            httponly=self.get_cookie_httponly(app), domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def __delete_cookie(self, app: Flask, response: Response, name: str) -> None:
+        """
+        Delete a session cookie.
+        :param app: The application.
+        :param response: The response.
+        :param name: The cookie name.
+        """
+        response.delete_cookie(name, domain=self.get_cookie_domain(app), path=self.get_cookie_path(app))
+
+    @staticmethod
+    def __data_cookie_name(app: Flask) -> str:
+        """
+        :param app: The application.
+        :return: The name of the signed cookie.
+        """
+        return f"{app.session_cookie_name}_data"
@@ -0,0 +1,88 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from pymongo.collection import Collection
+import Metrics.registry
+
+logger = logging.getLogger(__name__)
+
+
+class SharedMetrics:
+    def __init__(self, collection: Collection, flush_seconds: float = 15.0, retention_seconds: int = 24 * 60 * 60) \
+            -> None:
+        """
+        Shares the metrics of all worker processes (see Metrics.registry), so any worker can serve them. Every worker
+        stores a snapshot of its series in its own document from a background thread. Recording a metric never waits
+        for the database. When the metrics are read:
+        - Counters and histograms of all snapshots are added up. The snapshots of workers which exited are kept for
+          retention_seconds, so the totals don't drop on every restart.
+        - Gauges are only read from workers which are alive (updated within three flushes), one series per worker
+          labeled with its host and process ID.
+        :param collection: The collection storing the snapshots.
+        :param flush_seconds: Time in seconds between snapshots. Series of other workers are up to this old.
+        :param retention_seconds: Time in seconds the snapshot of a worker is kept after its last update.
+        """
+        self.__collection = collection
+        self.__flush_seconds = flush_seconds
+        self.__retention_seconds = retention_seconds
+        self.__owner = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def ensure_running(self) -> None:
+        """
+        Start the background thread of this worker if it is not running yet. Cheap enough to call on every request.
+        """
+        if self.__pid == os.getpid():
+            return
+        with self.__lock:
+            # The thread is started lazily, so it runs in the worker process rather than a pre-fork master.
+            if self.__pid != os.getpid():
+                self.__pid = os.getpid()
+                self.__owner = f"{socket.gethostname()}:{self.__pid}:{uuid.uuid4()}"
+                threading.Thread(target=self.__run, name="metrics", daemon=True).start()
+
+    def collect(self) -> list:
+        """
+        Get the series of all workers, with the current series of this worker. Reads the snapshots of the other
+        workers, but doesn't write.
+        :return: The merged series (see Metrics.registry.snapshot).
+        """
+        self.ensure_running()
+        alive_since = datetime.datetime.utcnow() - datetime.timedelta(seconds=3 * self.__flush_seconds)
+        snapshots, gauges = [], []
+        documents = self.__collection.find({"_id": {"$ne": self.__owner}}, {"series": 1, "updated_at": 1})
+        for owner, series, alive in [(document["_id"], document["series"], document["updated_at"] >= alive_since)
+                                     for document in documents] + [(self.__owner, Metrics.registry.snapshot(), True)]:
+            snapshots.append([entry for entry in series if not Metrics.registry.is_gauge(entry["name"])])
+            if alive:
+                worker = owner.rsplit(":", 1)[0]
+                gauges += [dict(entry, labels=dict(entry["labels"], worker=worker))
+                           for entry in series if Metrics.registry.is_gauge(entry["name"])]
+        return Metrics.registry.merge(snapshots) + gauges
+
+    def flush(self) -> None:
+        """
+        Store the current series of this worker.
+        """
+        now = datetime.datetime.utcnow()
+        self.__collection.replace_one({"_id": self.__owner},
+                                      {"updated_at": now,
+                                       "expires_at": now + datetime.timedelta(seconds=self.__retention_seconds),
+                                       "series": Metrics.registry.snapshot()},
+                                      upsert=True)
+
+    def __run(self) -> None:
+        """
+        Store the series of this worker periodically until it exits.
+        """
+        while True:
+            time.sleep(self.__flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not store metrics")
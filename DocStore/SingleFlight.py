@@ -0,0 +1,143 @@
+import copy
+import datetime
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Optional, TypeVar
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self, lease_collection: Collection, lease_seconds: int = 120, poll_interval: float = 0.25) -> None:
+        """
+        Makes sure that only one caller across all workers runs an operation for a given key at the same time.
+        Callers in the same process wait for the running operation and share its result. Callers in other processes
+        wait until the lease document of the running operation is released (or expires), and then read the result from
+        the database themselves.
+        :param lease_collection: The collection storing the lease documents.
+        :param lease_seconds: How long a lease is valid unless it is renewed. Leases are renewed while their operation
+        runs, so other workers only take over after this time if the worker holding a lease died.
+        :param poll_interval: Time in seconds between checks whether a lease held by another worker was released.
+        """
+        self.__lease_collection = lease_collection
+        self.__lease_seconds = lease_seconds
+        self.__poll_interval = poll_interval
+        self.__owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4()}"
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def run(self, key: str, lead: Callable[[], T], follow: Callable[[], Optional[T]]) -> T:
+        """
+        Run an operation for a key, unless it is already running.
+        :param key: The key identifying the operation, e.g. "report:<code>".
+        :param lead: The operation. Called if no other caller is running it for this key.
+        :param follow: Called after waiting for another worker to finish the operation, to read its result from the
+        database. If it returns None (e.g. the other worker failed), the operation is run by this caller instead.
+        :return: The result of the operation. Callers which waited on another caller in this process get a copy.
+        """
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.__in_flight[key] = future
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = self.__run_with_lease(key, lead, follow)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+
+    def __run_with_lease(self, key: str, lead: Callable[[], T], follow: Callable[[], Optional[T]]) -> T:
+        """
+        Run the operation while holding the lease for the key, or wait for the worker holding it. The operation is
+        never run without holding the lease.
+        :param key: The key identifying the operation.
+        :param lead: The operation.
+        :param follow: Reads the result of another worker.
+        :return: The result of the operation.
+        """
+        while not self.__try_acquire(key):
+            self.__wait_for_release(key)
+            result = follow()
+            if result is not None:
+                return result
+            # The other worker did not produce a result, so try to run the operation ourselves. If yet another worker
+            # acquired the lease first, wait for that one instead.
+
+        # Keep the lease while the operation runs, however long it takes.
+        done = threading.Event()
+        renewal = threading.Thread(target=self.__renew, args=(key, done), name="lease-renewal", daemon=True)
+        renewal.start()
+        try:
+            return lead()
+        finally:
+            done.set()
+            renewal.join()
+            self.__lease_collection.delete_one({"_id": key, "owner": self.__owner})
+
+    def try_lease(self, key: str, lease_seconds: int) -> bool:
+        """
+        Try to acquire a lease which is never released, but expires after the given time. Only one caller across all
+        workers acquires it per period, which makes it usable as a distributed rate limit.
+        :param key: The key of the lease, e.g. "live:<code>".
+        :param lease_seconds: How long the lease is held.
+        :return: True if the lease was acquired.
+        """
+        return self.__try_acquire(key, lease_seconds)
+
+    def __try_acquire(self, key: str, lease_seconds: Optional[int] = None) -> bool:
+        """
+        Try to acquire the lease for a key. Expired leases are taken over.
+        :param key: The key of the lease.
+        :param lease_seconds: How long the lease is valid. Defaults to the lease time of this instance.
+        :return: True if the lease was acquired.
+        """
+        now = datetime.datetime.utcnow()
+        lease_seconds = self.__lease_seconds if lease_seconds is None else lease_seconds
+        lease = {"owner": self.__owner, "expires_at": now + datetime.timedelta(seconds=lease_seconds)}
+        try:
+            self.__lease_collection.insert_one(dict(lease, _id=key))
+            return True
+        except DuplicateKeyError:
+            taken_over = self.__lease_collection.find_one_and_update({"_id": key, "expires_at": {"$lt": now}},
+                                                                     {"$set": lease})
+            return taken_over is not None
+
+    def __renew(self, key: str, done: threading.Event) -> None:
+        """
+        Extend the lease for a key every third of the lease time, until the operation is done. If the worker dies, the
+        lease expires and other workers take over.
+        :param key: The key of the lease.
+        :param done: Set when the operation is done.
+        """
+        while not done.wait(self.__lease_seconds / 3):
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.__lease_seconds)
+            self.__lease_collection.update_one({"_id": key, "owner": self.__owner},
+                                               {"$set": {"expires_at": expires_at}})
+
+    def __wait_for_release(self, key: str) -> None:
+        """
+        Wait until the lease for a key is released or expired. The holder renews the lease while it runs the operation,
+        so the lease only expires if the holder died.
+        :param key: The key of the lease.
+        """
+        while True:
+            lease = self.__lease_collection.find_one({"_id": key})
+            if not lease or lease["expires_at"] < datetime.datetime.utcnow():
+                return
+            time.sleep(self.__poll_interval)
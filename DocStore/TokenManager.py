@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+from pymongo.collection import Collection
+import Metrics.registry
+from DocStore.SingleFlight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class TokenManager:
+    def __init__(self, mongo, lease_collection: Collection, refreshers: dict, expiry_margin: int = 30,
+                 refresh_ahead: int = 600, poll_interval: float = 60.0, active_seconds: int = 3600) -> None:
+        """
+        Keeps the OAuth tokens of the users valid. Every provider auth stores when its access token expires:
+        - Tokens which are about to expire are refreshed before they are used, instead of failing the call first.
+        - Tokens of users which were active recently are refreshed ahead of their expiry in a background thread, so
+          most requests never wait for a refresh.
+        - Tokens rejected by a provider anyway (e.g. revoked) are refreshed once and the call is retried.
+        Refreshes of the same user and provider run only once at a time across all workers (see SingleFlight), and
+        callers which waited for another refresh use its result. Twitch and FFLogs rotate the refresh token on every
+        refresh, so concurrent refreshes would otherwise invalidate each other.
+        :param mongo: The MongoDBConnection storing the auths.
+        :param lease_collection: The collection storing the refresh leases.
+        :param refreshers: A dictionary of provider ("fflogs", "twitch" or "youtube") to a function which takes a
+        refresh token and returns a tuple of the status code, and the access token, refresh token and lifetime of the
+        access token in seconds if the refresh was successful.
+        :param expiry_margin: Tokens expiring within this many seconds are refreshed before they are used.
+        :param refresh_ahead: Tokens expiring within this many seconds are refreshed in the background.
+        :param poll_interval: Time in seconds between checks for tokens to refresh in the background.
+        :param active_seconds: Tokens are refreshed in the background until they were not used for this long.
+        """
+        self.__mongo = mongo
+        self.__single_flight = SingleFlight(lease_collection, lease_seconds=30)
+        self.__refreshers = refreshers
+        self.__expiry_margin = expiry_margin
+        self.__refresh_ahead = refresh_ahead
+        self.__poll_interval = poll_interval
+        self.__active_seconds = active_seconds
+        # (username, provider) -> (last use, auth) of the tokens used by this worker
+        self.__active = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def call_with_auth(self, username: str, auths: dict, provider: str,
+                       call: Callable[[str], tuple[int, T]]) -> (int, Optional[T]):
+        """
+        Call an API with the token of a user, refreshing the token before the call if it is about to expire, or once
+        after the call if the token was rejected.
+        :param username: The user.
+        :param auths: The auths of the user (e.g. from the session). Refreshed tokens are stored in it, and the auth of
+        the provider is removed if the user has to authorize again.
+        :param provider: "fflogs", "twitch" or "youtube".
+        :param call: The API call. Takes the access token and returns a tuple of the status code and the data.
+        :return: The status code and data of the call. If the status is 401, the token could not be refreshed and the
+        auth of the user for the provider was removed.
+        """
+        auth = auths[provider]
+        if self.__expires_within(auth, self.__expiry_margin):
+            status, auth = self.__refresh_auth(username, auths, provider, auth["token"])
+            if status != 200:
+                return status, None
+
+        status, data = call(auth["token"])
+        if status == 401:
+            status, auth = self.__refresh_auth(username, auths, provider, auth["token"])
+            if status != 200:
+                return status, None
+            status, data = call(auth["token"])
+
+        self.__track(username, provider, auth)
+        return status, data
+
+    def __refresh_auth(self, username: str, auths: dict, provider: str, stale_token: str) -> (int, Optional[dict]):
+        """
+        Replace a stale token of a user, and update their auths.
+        :param username: The user.
+        :param auths: The auths of the user.
+        :param provider: The provider.
+        :param stale_token: The token to replace.
+        :return: The status code and the new auth of the provider.
+        """
+        status, auth = self.__refresh(username, provider, stale_token)
+        if status == 200:
+            auths[provider] = auth
+        elif status == 401:
+            auths.pop(provider, None)
+        return status, auth
+
+    def __refresh(self, username: str, provider: str, stale_token: str) -> (int, Optional[dict]):
+        """
+        Replace a stale token of a user, unless another caller replaced it already.
+        :param username: The user.
+        :param provider: The provider.
+        :param stale_token: The token to replace.
+        :return: A tuple of the status code and the new auth of the provider. The status is 401 if the refresh token was
+        rejected and the auth was removed, or if the user is not authorized with the provider anymore.
+        """
+
+        def lead() -> (int, Optional[dict]):
+            # another worker may have refreshed the token since the caller read it
+            stored = self.__mongo.get_auth_keys(username)
+            auth = stored.get(provider)
+            if auth is None:
+                return 401, None
+            if auth["token"] != stale_token and not self.__expires_within(auth, self.__expiry_margin):
+                return 200, auth
+
+            with Metrics.registry.timer("vodsync_token_refresh_seconds", provider=provider) as t:
+                status, data = self.__refreshers[provider](auth["refresh_token"])
+                t.labels["status"] = status
+            if status == 200:
+                auth = dict(auth, token=data[0], refresh_token=data[1], expires_at=time.time() + data[2])
+                self.__mongo.update_provider(username, provider, auth)
+                return 200, auth
+            if 400 <= status < 500:
+                # the refresh token is invalid, the user has to authorize again
+                logger.info("Refresh token of %s for %s was rejected with %s", username, provider, status)
+                self.__mongo.remove_provider(username, provider)
+                return 401, None
+            # keep the auth if the provider is unavailable, the refresh is retried on the next call
+            return status, None
+
+        def follow() -> Optional[tuple[int, dict]]:
+            auth = self.__mongo.get_auth_keys(username).get(provider)
+            if auth is None or auth["token"] == stale_token:
+                return None
+            return 200, auth
+
+        return self.__single_flight.run(f"auth:{username}:{provider}", lead, follow)
+
+    def __track(self, username: str, provider: str, auth: dict) -> None:
+        """
+        Remember a token which was used, so it is refreshed in the background while the user is active.
+        :param username: The user.
+        :param provider: The provider.
+        :param auth: The auth of the provider.
+        """
+        if "expires_at" not in auth:
+            # auths stored before expiry times were recorded are only refreshed when they are rejected
+            return
+        with self.__lock:
+            self.__active[(username, provider)] = (time.time(), auth)
+            # The thread is started lazily, so it runs in the worker process rather than a pre-fork master.
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="token-refresh", daemon=True)
+                self.__thread.start()
+
+    def __run(self) -> None:
+        """
+        Refresh the tokens of active users ahead of their expiry until the worker exits.
+        """
+        while True:
+            try:
+                self.__refresh_active()
+            except Exception:
+                logger.exception("Could not refresh tokens")
+            time.sleep(self.__poll_interval)
+
+    def __refresh_active(self) -> None:
+        """
+        Refresh the tokens which were used recently and expire soon, and forget the tokens which were not used
+        recently.
+        """
+        now = time.time()
+        with self.__lock:
+            for key in [key for key, (last_used, _) in self.__active.items()
+                        if now - last_used > self.__active_seconds]:
+                del self.__active[key]
+            due = [(key, auth) for key, (_, auth) in self.__active.items()
+                   if self.__expires_within(auth, self.__refresh_ahead)]
+
+        for (username, provider), auth in due:
+            status, new_auth = self.__refresh(username, provider, auth["token"])
+            with self.__lock:
+                if status == 200 and (username, provider) in self.__active:
+                    self.__active[(username, provider)] = (self.__active[(username, provider)][0], new_auth)
+                elif status == 401:
+                    self.__active.pop((username, provider), None)
+
+    @staticmethod
+    def __expires_within(auth: dict, seconds: float) -> bool:
+        """
+        Check whether a token expires soon.
+        :param auth: The auth of a provider.
+        :param seconds: The time in seconds.
+        :return: True if the token expires within the given time. False if its expiry time is unknown.
+        """
+        return "expires_at" in auth and auth["expires_at"] - time.time() < seconds
@@ -1,7 +1,60 @@
+import contextlib
+import contextvars
+import math
 import time
-from typing import Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Iterable, Dict, Callable, Iterator
 import requests
 from requests import Response
+import HTTP.client
+import Metrics.registry
+from DocStore.RateLimiter import RateLimiter, INTERACTIVE
+
+# Maximum number of death queries sent to FFLogs at the same time for a single report.
+DEATH_QUERY_CONCURRENCY = 4
+
+# Number of fight IDs after the last known fight requested at once by an incremental refresh.
+FIGHT_ID_WINDOW = 100
+
+# Fight timestamps are stored in seconds, so the time windows of death queries are padded by this many milliseconds.
+DEATH_WINDOW_PADDING = 1000
+
+# Appended to a query to get the points spent, see __with_rate_limit_data.
+RATE_LIMIT_QUERY = "rateLimitData { limitPerHour, pointsSpentThisHour, pointsResetIn }"
+
+# The budget of the FFLogs API shared by all workers, if any (see set_rate_limiter).
+_rate_limiter: Optional[RateLimiter] = None
+
+# The priority of the queries sent in the current priority() block.
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("fflogs_priority", default=INTERACTIVE)
+
+
+def set_rate_limiter(rate_limiter: Optional[RateLimiter]) -> None:
+    """
+    Budget all queries of this process with a rate limiter. Without one, queries are sent as they come.
+    :param rate_limiter: The rate limiter, or None.
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+@contextlib.contextmanager
+def priority(level: int) -> Iterator[None]:
+    """
+    Send all queries within this block with the given priority (see DocStore.RateLimiter), e.g. background refreshes
+    with BACKGROUND, so they yield to interactive requests when the budget runs low:
+
+        with FFLogs.API.priority(BACKGROUND):
+            status, delta = FFLogs.API.try_load_report_delta(token, report)
+
+    Queries of a rate limited priority which is out of budget fail with status 429.
+    :param level: The priority.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
 
 
 def get_username(token: str) -> Optional[dict]:
@@ -24,31 +77,42 @@ def get_username(token: str) -> Optional[dict]:
    }
    """
 
-    status, data = __call_user_endpoint(token, query)
+    status, data = __call_user_endpoint(token, query, "username")
     if status == 200:
         return data.json()['data']['userData']['currentUser']
     else:
         return None
 
 
-def get_report_data(token: str, code: str) -> Tuple[int, Optional[dict]]:
+def get_report_data(token: str, code: str,
+                    progress: Optional[Callable[[str, dict], None]] = None) -> Tuple[int, Optional[dict]]:
     """
     Load a report from FFLogs.
+    The fights, the first page of deaths and the player details are fetched in a single query. Further queries are only
+    sent if the deaths do not fit on the first page.
     :param token: The FFLogs API access token.
     :param code: The report code.
+    :param progress: Optional callback, called with the name of each completed stage ("fights", "deaths", "players")
+    and the data loaded so far. The data must not be modified.
     :return: A tuple of (status, data) if successful, otherwise (status, None).
     """
 
-    # get basic report
-    status, data = __load_base_report(token, code)
+    # get report with the first page of deaths and all player details
+    status, data, player_details = __load_full_report(token, code)
     if status != 200:
         return status, None
-    # append death data
+    if progress:
+        progress("fights", data)
+    # append the remaining death data, if any
     if not __append_death_info(token, data):
         return 800, None
-    # append player data
-    if not __append_player_info(token, data):
+    if progress:
+        progress("deaths", data)
+    # append player data from the details we already have
+    if not __append_player_info(token, data, player_details):
         return 800, None
+    if progress:
+        progress("players", data)
     # If all data was loaded successfully, append the current time to the data and return it.
     data["loaded_at"] = time.time()
     return 200, data
@@ -73,14 +137,123 @@ def try_update_report(token: str, previous_report: dict, unknown=False) -> Tuple
     # update death data
     if not __append_death_info(token, data):
         return 800, None
-    # update player data
-    if not __append_player_info(token, data):
+    # update player data, only the players who died since the previous state can be unknown
+    if not __append_player_info(token, data, known_deaths=len(previous_report["deaths"])):
         return 800, None
     # If all data was loaded successfully, append the current time to the data and return it.
     data["loaded_at"] = time.time()
     return 200, data
 
 
+def try_load_report_delta(token: str, previous_report: dict) -> Tuple[int, Optional[dict]]:
+    """
+    Try to load only the data that was added to a report since it was last loaded: fights after the last known fight
+    ID, their deaths, and the players who died in them. Encounters with ID 0 are dismissed.
+    :param token: The FFLogs API access token.
+    :param previous_report: The previous state of the report.
+    :return: A tuple of (status, delta) if successful, otherwise (status, None). The delta contains the new fights
+    (latest first), the new deaths, the new player_data entries, and the updated endTime, last_fight_id,
+    last_queried_death_timestamp and loaded_at of the report. If the last known fight was still in progress when the
+    report was loaded, it can't be replaced by a delta, and the delta only contains last_fight_changed=True.
+    """
+    last_fight_id = previous_report.get("last_fight_id",
+                                        max([fight["id"] for fight in previous_report["fights"]], default=0))
+    # The last known fight is requested again with the first window, to find out whether it has changed since.
+    known_fight = next((fight for fight in previous_report["fights"] if fight["id"] == last_fight_id), None)
+    delta = {
+        "code": previous_report["code"],
+        "startTime": previous_report["startTime"],
+        "endTime": previous_report["endTime"],
+        "fights": [],
+        "deaths": [],
+        "player_data": dict(previous_report["player_data"]),
+        "last_queried_death_timestamp": previous_report["last_queried_death_timestamp"],
+    }
+
+    # request windows of fight IDs after the last known one, until a window is not full
+    window_full = True
+    while window_full:
+        fight_ids = ", ".join(str(fid) for fid in range(last_fight_id + 1, last_fight_id + FIGHT_ID_WINDOW + 1))
+        queried_fight_ids = f"{known_fight['id']}, {fight_ids}" if known_fight else fight_ids
+        query = """
+        query
+        {
+            reportData
+            {
+                report(code: \"""" + previous_report["code"] + """\")
+                {
+                    endTime,
+                    fights(fightIDs: [""" + queried_fight_ids + """])
+                    {
+                        id
+                        startTime,
+                        endTime,
+                        encounterID,
+                    },
+                    events(dataType: Deaths, killType: Encounters, fightIDs: [""" + fight_ids + """])
+                    {
+                        data,
+                        nextPageTimestamp
+                    }
+                }
+            }
+        }"""
+        status, data = __call_client_endpoint(token, query, "report_delta")
+        if status != 200:
+            return status, None
+
+        data = data.json()['data']['reportData']['report']
+        if not data:
+            return 800, None
+
+        fights = data["fights"]
+        if known_fight:
+            current = next((fight for fight in fights if fight["id"] == known_fight["id"]), None)
+            if current and delta["startTime"] + round(current["endTime"] / 1000, 0) != known_fight["endTime"]:
+                return 200, {"last_fight_changed": True}
+            fights = [fight for fight in fights if fight["id"] != known_fight["id"]]
+            known_fight = None
+        window_full = any(fight["id"] == last_fight_id + FIGHT_ID_WINDOW for fight in fights)
+        last_fight_id = max([fight["id"] for fight in fights], default=last_fight_id)
+        delta["endTime"] = round(data["endTime"] / 1000, 0)
+
+        # convert the fights the same way a full load does, and drop trash
+        fights = [fight for fight in fights if fight["encounterID"] != 0]
+        for fight in fights:
+            fight["startTime"] = delta["startTime"] + round(fight["startTime"] / 1000, 0)
+            fight["endTime"] = delta["startTime"] + round(fight["endTime"] / 1000, 0)
+        fights.sort(key=lambda x: x["endTime"], reverse=True)
+        if len(fights) == 0:
+            continue
+
+        # the first page of deaths came with the fights, follow pagination for the rest
+        page = {"code": delta["code"], "startTime": delta["startTime"], "fights": fights,
+                "deaths": __parse_deaths(delta, data["events"])}
+        if data["events"]["nextPageTimestamp"]:
+            page["last_queried_death_timestamp"] = data["events"]["nextPageTimestamp"]
+        else:
+            page["last_queried_death_timestamp"] = (__relative_timestamp(delta, fights[0]["endTime"])
+                                                    + DEATH_WINDOW_PADDING)
+        if not __append_death_info(token, page):
+            return 800, None
+
+        delta["fights"] = fights + delta["fights"]
+        delta["deaths"] += page["deaths"]
+        delta["last_queried_death_timestamp"] = page["last_queried_death_timestamp"]
+
+    # get names of players who died in the new fights, and only keep the new entries
+    if not __append_player_info(token, delta):
+        return 800, None
+    delta["player_data"] = {pid: player for pid, player in delta["player_data"].items()
+                            if pid not in previous_report["player_data"]}
+
+    delta["last_fight_id"] = last_fight_id
+    delta["loaded_at"] = time.time()
+    del delta["code"]
+    del delta["startTime"]
+    return 200, delta
+
+
 def query_for_encounter_name(token: str, eid: int) -> Tuple[int, Optional[str]]:
     """
     Gets the name of a given encounter ID.
@@ -100,7 +273,7 @@ def query_for_encounter_name(token: str, eid: int) -> Tuple[int, Optional[str]]:
         }
     }
     """
-    status, data = __call_client_endpoint(token, query)
+    status, data = __call_client_endpoint(token, query, "encounter_name")
     if status == 200:
         try:
             name = data.json()['data']['worldData']['encounter']['name']
@@ -113,6 +286,73 @@ def query_for_encounter_name(token: str, eid: int) -> Tuple[int, Optional[str]]:
         return status, None
 
 
+def query_for_encounter_names(token: str, eids: Iterable[int]) -> Tuple[int, Optional[Dict[int, str]]]:
+    """
+    Gets the names of multiple encounter IDs in a single query.
+    :param token: The FFLogs API access token.
+    :param eids: The encounter IDs to query for.
+    :return: A tuple of (status code, dictionary of encounter ID to name) if successful, otherwise (status code, None).
+    """
+    eids = sorted(set(eids))
+    if len(eids) == 0:
+        return 200, {}
+
+    # every encounter is selected under its own alias, e.g. e1234: encounter(id: 1234)
+    query = """
+    query
+    {
+        worldData
+        {
+            """ + "\n            ".join(f"e{eid}: encounter(id: {eid}) {{ name }}" for eid in eids) + """
+        }
+    }
+    """
+    status, data = __call_client_endpoint(token, query, "encounter_names")
+    if status == 200:
+        data = data.json()['data']['worldData']
+        # Encounters without a name (e.g. dungeons) are returned as null, just place them as unknown zone.
+        return 200, {eid: data[f"e{eid}"]["name"] if data.get(f"e{eid}") else "Unknown Zone" for eid in eids}
+    else:
+        return status, None
+
+
+def query_for_zone_encounters(token: str) -> Tuple[int, Optional[Dict[int, str]]]:
+    """
+    Gets the names of all encounters in the zones of the current (latest) expansion.
+    :param token: The FFLogs API access token.
+    :return: A tuple of (status code, dictionary of encounter ID to name) if successful, otherwise (status code, None).
+    """
+    query = """
+    query
+    {
+        worldData
+        {
+            expansions
+            {
+                id,
+                zones
+                {
+                    encounters
+                    {
+                        id,
+                        name
+                    }
+                }
+            }
+        }
+    }
+    """
+    status, data = __call_client_endpoint(token, query, "zone_encounters")
+    if status != 200:
+        return status, None
+
+    expansions = data.json()['data']['worldData']['expansions']
+    if not expansions:
+        return 200, {}
+    current = max(expansions, key=lambda x: x["id"])
+    return 200, {encounter["id"]: encounter["name"] for zone in current["zones"] for encounter in zone["encounters"]}
+
+
 def __load_base_report(token: str, code: str, unknown: bool = False) -> Tuple[int, Optional[dict]]:
     """
     Try to load the basic report structure for a given code.
@@ -142,7 +382,7 @@ def __load_base_report(token: str, code: str, unknown: bool = False) -> Tuple[in
             }
         }
     }"""
-    status, data = __call_client_endpoint(token, query)
+    status, data = __call_client_endpoint(token, query, "base_report")
     if status != 200:
         return status, None
     else:
@@ -151,25 +391,122 @@ def __load_base_report(token: str, code: str, unknown: bool = False) -> Tuple[in
         if not data:
             return 800, None
 
-        # remove trash fights unless unknown fights should be included
-        if not unknown:
-            data["fights"] = [fight for fight in data["fights"] if fight["encounterID"] != 0]
+        return 200, __parse_base_report(data, code, unknown)
+
+
+def __load_full_report(token: str, code: str) -> Tuple[int, Optional[dict], Optional[dict]]:
+    """
+    Try to load the basic report structure for a given code, together with the first page of deaths in boss fights and
+    the player details of the report, in a single query.
+    :param token: The FFLogs API access token.
+    :param code: The report code.
+    :return: A tuple of (status, data, player details) if successful, otherwise (status, None, None). If successful,
+    data contains the first page of deaths, and last_queried_death_timestamp points to where the next page starts.
+    """
+
+    query = """
+    query
+    {
+        reportData
+        {
+            report(code: \"""" + code + """\")
+            {
+                startTime,
+                endTime,
+                fights
+                {
+                    id
+                    startTime,
+                    endTime,
+                    encounterID,
+                },
+                title,
+                events(dataType: Deaths, killType: Encounters)
+                {
+                    data,
+                    nextPageTimestamp
+                },
+                playerDetails(killType: Encounters)
+            }
+        }
+    }"""
+    status, data = __call_client_endpoint(token, query, "full_report")
+    if status != 200:
+        return status, None, None
+
+    data = data.json()['data']['reportData']['report']
+    # if there is no data in the report, return a custom error code.
+    if not data:
+        return 800, None, None
+
+    events = data.pop("events")
+    player_details = data.pop("playerDetails")
+    data = __parse_base_report(data, code)
+
+    # Deal with the special case when there are no valid fights in the report.
+    if len(data["fights"]) == 0:
+        data["deaths"] = []
+        data["last_queried_death_timestamp"] = 0
+        return 200, data, player_details
+
+    data["deaths"] = __parse_deaths(data, events)
+    if events["nextPageTimestamp"]:
+        # continue pagination from the next page
+        data["last_queried_death_timestamp"] = events["nextPageTimestamp"]
+    else:
+        # all deaths fit on the first page
+        data["last_queried_death_timestamp"] = (__relative_timestamp(data, data["fights"][0]["endTime"])
+                                                + DEATH_WINDOW_PADDING)
+    return 200, data, player_details
+
+
+def __parse_base_report(data: dict, code: str, unknown: bool = False) -> dict:
+    """
+    Convert the raw report structure returned by FFLogs into the stored format.
+    :param data: The report data returned by FFLogs (startTime, endTime, fights and title).
+    :param code: The report code.
+    :param unknown: Whether to keep or dismiss encounters with ID 0.
+    :return: The converted report data.
+    """
+    # remember the latest fight ID (including trash), so a refresh can continue after it
+    data["last_fight_id"] = max([fight["id"] for fight in data["fights"]], default=0)
+
+    # remove trash fights unless unknown fights should be included
+    if not unknown:
+        data["fights"] = [fight for fight in data["fights"] if fight["encounterID"] != 0]
+
+    # change the timestamps from milliseconds to seconds
+    data["startTime"] = round(data["startTime"] / 1000, 0)
+    data["endTime"] = round(data["endTime"] / 1000, 0)
+    for fight in data["fights"]:
+        fight["startTime"] = data["startTime"] + round(fight["startTime"] / 1000, 0)
+        fight["endTime"] = data["startTime"] + round(fight["endTime"] / 1000, 0)
 
-        # change the timestamps from milliseconds to seconds
-        data["startTime"] = round(data["startTime"] / 1000, 0)
-        data["endTime"] = round(data["endTime"] / 1000, 0)
-        for fight in data["fights"]:
-            fight["startTime"] = data["startTime"] + round(fight["startTime"] / 1000, 0)
-            fight["endTime"] = data["startTime"] + round(fight["endTime"] / 1000, 0)
+    # append report ID to data
+    data["code"] = code
 
-        # append report ID to data
-        data["code"] = code
+    # order fights by their end time (latest pull first)
+    data["fights"].sort(key=lambda x: x["endTime"], reverse=True)
 
-        # order fights by their end time (latest pull first)
-        data["fights"].sort(key=lambda x: x["endTime"], reverse=True)
+    return data
 
-        # return the data
-        return 200, data
+
+def __parse_deaths(report_data: dict, events: dict) -> list:
+    """
+    Convert a page of death events returned by FFLogs into the stored format.
+    :param report_data: The report data the events belong to.
+    :param events: The events object returned by FFLogs (data and nextPageTimestamp).
+    :return: A list of deaths.
+    """
+    deaths = []
+    if "data" in events:
+        for death in events["data"]:
+            deaths.append({
+                "timestamp": report_data["startTime"] + round(death["timestamp"] / 1000, 0),
+                "targetID": death["targetID"],
+                "fight": death["fight"],
+            })
+    return deaths
 
 
 def __append_death_info(token: str, report_data: dict) -> bool:
@@ -191,16 +528,68 @@ def __append_death_info(token: str, report_data: dict) -> bool:
         previous_timestamp = report_data["last_queried_death_timestamp"]
     else:
         # Otherwise, we start at the earliest pull in the report.
-        previous_timestamp = int(report_data["fights"][-1]["startTime"] - report_data["startTime"]) * 1000
+        previous_timestamp = __relative_timestamp(report_data, report_data["fights"][-1]["startTime"])
 
     # this is the last timestamp for which we need to query
-    last_timestamp = int(report_data["fights"][0]["endTime"] - report_data["startTime"]) * 1000
+    last_timestamp = __relative_timestamp(report_data, report_data["fights"][0]["endTime"]) + DEATH_WINDOW_PADDING
+
+    # Only fights whose (padded) end is after the previous timestamp still need to be queried, oldest first.
+    fights = [fight for fight in reversed(report_data["fights"])
+              if __relative_timestamp(report_data, fight["endTime"]) + DEATH_WINDOW_PADDING > previous_timestamp]
+
+    # Split the remaining fights into contiguous groups, one for each concurrent query. Each group is scoped to its
+    # fight IDs, so the time in between (e.g. trash) is never paged through.
+    group_size = max(math.ceil(len(fights) / DEATH_QUERY_CONCURRENCY), 1)
+    groups = [fights[i:i + group_size] for i in range(0, len(fights), group_size)]
+
+    # The worker threads don't inherit the priority of this thread.
+    level = _priority.get()
+
+    def query_group(group: list) -> Tuple[int, list]:
+        with priority(level):
+            return __query_deaths(token, report_data, group, previous_timestamp)
+
+    with ThreadPoolExecutor(max_workers=DEATH_QUERY_CONCURRENCY) as executor:
+        results = list(executor.map(query_group, groups))
+
+    # if one of the queries failed, return false
+    if any(status != 200 for status, _ in results):
+        return False
+
+    # merge the deaths of all groups in timestamp order
+    deaths = sorted([death for _, group_deaths in results for death in group_deaths], key=lambda x: x["timestamp"])
+
+    # append the death data to the report data
+    report_data["last_queried_death_timestamp"] = last_timestamp
+    if "deaths" not in report_data:
+        report_data["deaths"] = deaths
+    else:
+        report_data["deaths"] = report_data["deaths"] + deaths
+    return True
+
+
+def __query_deaths(token: str, report_data: dict, fights: list, previous_timestamp: int) -> Tuple[int, list]:
+    """
+    Query all deaths within a group of fights, following pagination.
+    :param token: The FFLogs API access token.
+    :param report_data: The report data the fights belong to.
+    :param fights: The fights to query deaths for, in chronological order.
+    :param previous_timestamp: The timestamp (relative to the report start in milliseconds) up to which deaths were
+    already queried.
+    :return: A tuple of (status, deaths). If the status is not 200, the deaths are incomplete.
+    """
+    # The window is padded on both ends (see DEATH_WINDOW_PADDING). The fight IDs make sure no deaths outside the
+    # fights are returned.
+    start_timestamp = max(__relative_timestamp(report_data, fights[0]["startTime"]) - DEATH_WINDOW_PADDING,
+                          previous_timestamp)
+    last_timestamp = __relative_timestamp(report_data, fights[-1]["endTime"]) + DEATH_WINDOW_PADDING
+    fight_ids = ", ".join(str(fight["id"]) for fight in fights)
 
     deaths = []
-    previous_status = 200
+    status = 200
 
     # iterate over deaths until we reach the last timestamp
-    while previous_status == 200 and previous_timestamp is not None and previous_timestamp < last_timestamp:
+    while status == 200 and start_timestamp is not None and start_timestamp < last_timestamp:
         death_query = """
         query
         {
@@ -208,8 +597,8 @@ def __append_death_info(token: str, report_data: dict) -> bool:
                 {
                         report(code: \"""" + report_data["code"] + """\")
                         {
-                            events(dataType: Deaths, startTime: """ + str(previous_timestamp) + """,endTime: """ \
-                      + str(last_timestamp) + """)
+                            events(dataType: Deaths, fightIDs: [""" + fight_ids + """], startTime: """ \
+                      + str(start_timestamp) + """,endTime: """ + str(last_timestamp) + """)
                             {
                                 data,
                                 nextPageTimestamp
@@ -217,41 +606,40 @@ def __append_death_info(token: str, report_data: dict) -> bool:
                         }
                 }
         }"""
-        previous_status, data = __call_client_endpoint(token, death_query)
-        if previous_status != 200:
+        status, data = __call_client_endpoint(token, death_query, "death_page")
+        if status != 200:
             break
 
         data = data.json()["data"]["reportData"]["report"]["events"]
-        if "data" in data:
-            for death in data["data"]:
-                deaths.append({
-                    "timestamp": report_data["startTime"] + round(death["timestamp"] / 1000, 0),
-                    "targetID": death["targetID"],
-                    "fight": death["fight"],
-                })
+        deaths += __parse_deaths(report_data, data)
         if data["nextPageTimestamp"]:
-            previous_timestamp = data["nextPageTimestamp"]
+            start_timestamp = data["nextPageTimestamp"]
         else:
-            previous_timestamp = None
+            start_timestamp = None
 
-    # if one of the queries failed, return false
-    if previous_status != 200:
-        return False
+    return status, deaths
 
-    # append the death data to the report data
-    report_data["last_queried_death_timestamp"] = last_timestamp
-    if "deaths" not in report_data:
-        report_data["deaths"] = deaths
-    else:
-        report_data["deaths"] = report_data["deaths"] + deaths
-    return True
+
+def __relative_timestamp(report_data: dict, timestamp: float) -> int:
+    """
+    Convert a stored timestamp (epoch seconds) into a timestamp relative to the report start in milliseconds, as used
+    by the FFLogs API.
+    :param report_data: The report data.
+    :param timestamp: The stored timestamp.
+    :return: The relative timestamp.
+    """
+    return int(timestamp - report_data["startTime"]) * 1000
 
 
-def __append_player_info(token: str, report_data: dict) -> bool:
+def __append_player_info(token: str, report_data: dict, player_details: Optional[dict] = None,
+                         known_deaths: int = 0) -> bool:
     """
     Append player information to a given report.
     :param token: The FFLogs API access token.
     :param report_data: The report data (collected by the __load_base_report function, and with appended deaths).
+    :param player_details: The playerDetails of the report if they were already queried (e.g. by __load_full_report).
+    If given, no query is sent.
+    :param known_deaths: The number of deaths at the start of the report whose players are already in player_data.
     :return: True if successful, false if not. If true, player_data is appended to report_data.
     """
 
@@ -259,9 +647,9 @@ def __append_player_info(token: str, report_data: dict) -> bool:
     if "deaths" not in report_data:
         return False
 
-    # If there are no deaths, we can just return an empty list.
-    if len(report_data["deaths"]) == 0:
-        report_data["player_data"] = {}
+    # If there are no new deaths, there are no new players.
+    if len(report_data["deaths"]) <= known_deaths:
+        report_data.setdefault("player_data", {})
         return True
 
     # get and parse the time range
@@ -269,7 +657,7 @@ def __append_player_info(token: str, report_data: dict) -> bool:
     start_time = int(report_data["fights"][-1]["startTime"] - report_data["startTime"]) * 1000
 
     # get player ids who died
-    pids = set([death["targetID"] for death in report_data["deaths"]])
+    pids = set([death["targetID"] for death in report_data["deaths"][known_deaths:]])
 
     # get already existing player data (if any)
     player_data = report_data["player_data"] if "player_data" in report_data else {}
@@ -278,34 +666,37 @@ def __append_player_info(token: str, report_data: dict) -> bool:
     if len([pid for pid in pids if str(pid) not in player_data]) == 0:
         return True
 
-    query = """
-    query
-    {
-        reportData
+    if player_details is None:
+        query = """
+        query
         {
-            report(code: \"""" + report_data["code"] + """\")
+            reportData
             {
-                playerDetails(startTime: """ + str(start_time) + """, endTime: """ + str(end_time) + """)
+                report(code: \"""" + report_data["code"] + """\")
+                {
+                    playerDetails(startTime: """ + str(start_time) + """, endTime: """ + str(end_time) + """)
+                }
             }
-        }
-    }"""
-    status, data = __call_client_endpoint(token, query)
+        }"""
+        status, data = __call_client_endpoint(token, query, "player_details")
 
-    if status != 200:
-        return False
+        if status != 200:
+            return False
+
+        player_details = data.json()["data"]["reportData"]["report"]["playerDetails"]
 
     # unpack the data
-    data = data.json()["data"]["reportData"]["report"]["playerDetails"]["data"]["playerDetails"]
+    data = player_details["data"]["playerDetails"]
     for role in data:
         for player in data[role]:
-            if player["id"] in pids and player["id"] not in player_data:
+            if player["id"] in pids and str(player["id"]) not in player_data:
                 player_data[str(player["id"])] = {
                     "name": player["name"],
                     "class": player["type"]
                 }
 
     # If a player name was not found, we just place an unknown player. Not really worth returning failure over.
-    player_data = player_data | {pid: {"name": "Unknown", "class": "Unknown"}
+    player_data = player_data | {str(pid): {"name": "Unknown", "class": "Unknown"}
                                  for pid in pids if str(pid) not in player_data}
 
     # append data
@@ -313,29 +704,76 @@ def __append_player_info(token: str, report_data: dict) -> bool:
     return True
 
 
-def __call_user_endpoint(token: str, query: str) -> Tuple[int, Optional[Response]]:
+def __call_user_endpoint(token: str, query: str, query_type: str) -> Tuple[int, Optional[Response]]:
     """
     Send a query to the FFLogs user endpoint.
     :param token: The bearer token.
     :param query: The query to send.
+    :param query_type: The kind of query, for the metrics.
     :return: A tuple of (Status Code, Data) if successful, otherwise (Status Code, None)
     """
-    url = 'https://www.fflogs.com/api/v2/user'
-    r = requests.post(url, json={'query': query}, headers={"Authorization": f"Bearer {token}"})
-    if r.status_code == 200:
-        return 200, r
-    return r.status_code, None
+    return __call_endpoint('https://www.fflogs.com/api/v2/user', token, query, query_type)
 
 
-def __call_client_endpoint(token: str, query: str) -> Tuple[int, Optional[Response]]:
+def __call_client_endpoint(token: str, query: str, query_type: str) -> Tuple[int, Optional[Response]]:
     """
     Send a query to the FFLogs client endpoint.
     :param token: The bearer token.
     :param query: The query to send.
+    :param query_type: The kind of query, for the metrics.
     :return: A tuple of (Status Code, Data) if successful, otherwise (Status Code, None)
     """
-    url = 'https://www.fflogs.com/api/v2/client'
-    r = requests.post(url, json={'query': query}, headers={"Authorization": f"Bearer {token}"})
+    return __call_endpoint('https://www.fflogs.com/api/v2/client', token, query, query_type)
+
+
+def __call_endpoint(url: str, token: str, query: str, query_type: str) -> Tuple[int, Optional[Response]]:
+    """
+    Send a query to an FFLogs endpoint within the budget of the rate limiter, if there is one.
+    :param url: The URL of the endpoint.
+    :param token: The bearer token.
+    :param query: The query to send.
+    :param query_type: The kind of query, for the metrics.
+    :return: A tuple of (Status Code, Data) if successful, otherwise (Status Code, None). If the priority of the query
+    is out of budget, the query is not sent and the status is 429.
+    """
+    with Metrics.registry.timer("vodsync_fflogs_query_seconds", query=query_type) as t:
+        rate_limiter = _rate_limiter
+        if rate_limiter is not None and not rate_limiter.acquire(_priority.get()):
+            t.labels["status"] = 429
+            return 429, None
+        sync = rate_limiter is not None and rate_limiter.sync_due()
+        try:
+            r = HTTP.client.post(url, json={'query': __with_rate_limit_data(query) if sync else query},
+                                 headers={"Authorization": f"Bearer {token}"})
+        except requests.RequestException:
+            # Timeouts and connection errors are reported as a gateway timeout, so callers can treat them like any
+            # other failed call.
+            t.labels["status"] = 504
+            return 504, None
+        t.labels["status"] = r.status_code
     if r.status_code == 200:
+        if sync:
+            __record_rate_limit_data(rate_limiter, r.json())
         return 200, r
     return r.status_code, None
+
+
+def __with_rate_limit_data(query: str) -> str:
+    """
+    Add the points spent to a query, so they are returned alongside its data without a query of their own.
+    :param query: The query.
+    :return: The query, with the rate limit data selected as the last field of the root.
+    """
+    end = query.rindex("}")
+    return query[:end] + RATE_LIMIT_QUERY + "\n" + query[end:]
+
+
+def __record_rate_limit_data(rate_limiter: RateLimiter, body: dict) -> None:
+    """
+    Correct the budget with the points spent returned by a query sent with __with_rate_limit_data.
+    :param rate_limiter: The rate limiter.
+    :param body: The JSON body of the response.
+    """
+    data = (body.get("data") or {}).get("rateLimitData")
+    if data:
+        rate_limiter.record(data["limitPerHour"], data["pointsSpentThisHour"], data["pointsResetIn"])
@@ -1,20 +1,20 @@
 import json
 from typing import Optional
-import requests
+import HTTP.client
 
 
 class FFLogsAuth:
     def __init__(self, client_id: str):
         self.client_id = client_id
 
-    def try_refresh_fflogs_token(self, refresh_token: str) -> (int, Optional[tuple[str, str]]):
+    def try_refresh_fflogs_token(self, refresh_token: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Tries to use a refresh token to get a new access token
         :param refresh_token: The refresh token
         :return: A tuple containing the status code of the call, and optionally the new access and refresh tokens
-        (in that order) if the call was successful.
+        and the lifetime of the new access token in seconds (in that order) if the call was successful.
         """
-        r = requests.post("https://www.fflogs.com/oauth/token", data={
+        r = HTTP.client.post("https://www.fflogs.com/oauth/token", data={
             "client_id": self.client_id,
             "refresh_token": refresh_token,
             "grant_type": "refresh_token",
@@ -22,30 +22,51 @@ class FFLogsAuth:
         # return new auth data if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], data["refresh_token"])
+            return 200, (data["access_token"], data["refresh_token"], data["expires_in"])
         else:
             return r.status_code, None
 
-    def try_obtain_token(self, code: str, verifier: str, redirect_uri: str) -> (int, Optional[tuple[str, str]]):
+    def try_obtain_token(self, code: str, verifier: str, redirect_uri: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Try to obtain an access token using a PKCE exchange.
         :param code: The code obtained by the user's login flow.
         :param verifier: The verifier obtained from the PKCE flow.
         :param redirect_uri: The redirect uri of the token process.
-        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens (in that
-        order) if the call was successful.
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
         """
-        r = requests.post("https://www.fflogs.com/oauth/token", data={
+        r = HTTP.client.post("https://www.fflogs.com/oauth/token", data=self.__token_request(code, verifier,
+                                                                                            redirect_uri))
+        return self.__parse_tokens(r)
+
+    def __token_request(self, code: str, verifier: str, redirect_uri: str) -> dict:
+        """
+        Build the form data for a PKCE exchange.
+        :param code: The code obtained by the user's login flow.
+        :param verifier: The verifier obtained from the PKCE flow.
+        :param redirect_uri: The redirect uri of the token process.
+        :return: The form data.
+        """
+        return {
             "client_id": self.client_id,
             "code_verifier": verifier,
             "redirect_uri": redirect_uri,
             "grant_type": "authorization_code",
             "code": code
-        })
+        }
+
+    @staticmethod
+    def __parse_tokens(r) -> (int, Optional[tuple[str, str, int]]):
+        """
+        Read the tokens from a response of the token endpoint.
+        :param r: The response (of requests).
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
+        """
         # return fflogs token and refresh token if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], data["refresh_token"])
+            return 200, (data["access_token"], data["refresh_token"], data["expires_in"])
         else:
             return r.status_code, None
 
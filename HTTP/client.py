@@ -0,0 +1,96 @@
+import os
+import threading
+from typing import Optional
+from urllib.parse import urlsplit
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+import Metrics.registry
+
+# Default (connect, read) timeouts in seconds for every outbound call. The connect timeout is slightly larger than a
+# multiple of 3, which is the default TCP packet retransmission window.
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# Number of keep-alive connections kept open per host. FFLogs gets the largest pool, as a single report load can fire
+# many GraphQL queries (death pages) in a short amount of time.
+HOST_POOL_SIZES = {
+    "www.fflogs.com": 16,
+    "api.twitch.tv": 8,
+    "id.twitch.tv": 4,
+    "www.googleapis.com": 8,
+    "oauth2.googleapis.com": 4,
+}
+
+# Pool size for any host not listed above.
+DEFAULT_POOL_SIZE = 4
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Get the shared HTTP session of this process. The session keeps connections alive between calls, so consecutive
+    requests to the same host skip the TCP and TLS handshake.
+    The session is created lazily and re-created after a fork, so gunicorn workers never share sockets.
+    :return: The shared requests session.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = __create_session()
+                _session_pid = pid
+    return _session
+
+
+def request(method: str, url: str, **kwargs) -> Response:
+    """
+    Send a request through the shared session.
+    :param method: The HTTP method.
+    :param url: The URL to send the request to.
+    :param kwargs: Any keyword arguments accepted by requests. If no timeout is given, DEFAULT_TIMEOUT is used.
+    :return: The response.
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    parts = urlsplit(url)
+    with Metrics.registry.timer("vodsync_upstream_request_seconds", host=parts.hostname, path=parts.path) as t:
+        response = get_session().request(method, url, **kwargs)
+        t.labels["status"] = response.status_code
+    return response
+
+
+def get(url: str, **kwargs) -> Response:
+    """
+    Send a GET request through the shared session.
+    :param url: The URL to send the request to.
+    :param kwargs: Any keyword arguments accepted by requests.
+    :return: The response.
+    """
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> Response:
+    """
+    Send a POST request through the shared session.
+    :param url: The URL to send the request to.
+    :param kwargs: Any keyword arguments accepted by requests.
+    :return: The response.
+    """
+    return request("POST", url, **kwargs)
+
+
+def __create_session() -> requests.Session:
+    """
+    Create a new session with one connection pool adapter per known host.
+    :return: The new session.
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=len(HOST_POOL_SIZES) + 1, pool_maxsize=DEFAULT_POOL_SIZE))
+    session.mount("http://", HTTPAdapter(pool_maxsize=DEFAULT_POOL_SIZE))
+    # requests picks the adapter with the longest matching prefix, so these take precedence over the defaults above.
+    for host, size in HOST_POOL_SIZES.items():
+        session.mount(f"https://{host}/", HTTPAdapter(pool_connections=1, pool_maxsize=size))
+    return session
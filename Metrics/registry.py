@@ -0,0 +1,213 @@
+import bisect
+import functools
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+# Latency buckets in seconds, from cached reads to slow upstream calls.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Every metric as name -> (type, help).
+METRICS = {
+    "vodsync_route_seconds": ("histogram", "Latency of the routes by endpoint and status code."),
+    "vodsync_upstream_request_seconds": ("histogram", "Latency of HTTP calls to FFLogs, Twitch and Google by host, "
+                                                      "path and status code."),
+    "vodsync_fflogs_query_seconds": ("histogram", "Latency of FFLogs API queries by query type and status code."),
+    "vodsync_mongo_operation_seconds": ("histogram", "Latency of MongoDBConnection operations by operation and "
+                                                     "returned status."),
+    "vodsync_token_refresh_seconds": ("histogram", "Latency of OAuth token refreshes by provider and status code."),
+    "vodsync_report_cache_events_total": ("counter", "Report cache lookups and invalidations by event."),
+    "vodsync_report_cache_bytes": ("gauge", "Size of the in-process report caches in bytes."),
+    "vodsync_fflogs_points": ("gauge", "FFLogs API points of the current hour: limit, spent and remaining."),
+    "vodsync_fflogs_points_available": ("gauge", "FFLogs API points left for each request priority."),
+}
+
+# (name, labels as given) -> values. Histograms store the count of every bucket (the last one is +Inf) followed by the
+# sum, counters and gauges store a single value.
+_series = {}
+_series_lock = threading.Lock()
+
+# Functions returning (name, labels, value) of counters and gauges which are read when a snapshot is taken.
+_collectors = []
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """
+    Record a duration in a histogram.
+    :param name: The name of the histogram.
+    :param seconds: The duration.
+    :param labels: The labels of the series. Values are converted to strings.
+    """
+    # Labels are normalized when a snapshot is taken, rather than on every call.
+    key = (name, tuple(labels.items()))
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+    with _series_lock:
+        values = _series.get(key)
+        if values is None:
+            values = _series[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        values[bucket] += 1
+        values[-1] += seconds
+
+
+class Timer:
+    def __init__(self, name: str, labels: dict) -> None:
+        """
+        Records the duration of a with block in a histogram (see timer).
+        :param name: The name of the histogram.
+        :param labels: The labels of the series. The "status" label can be set within the block.
+        """
+        self.name = name
+        self.labels = labels
+        self.__start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.labels["status"] = "error"
+        observe(self.name, time.perf_counter() - self.__start, **self.labels)
+
+
+def timer(name: str, **labels) -> Timer:
+    """
+    Record the duration of a with block in a histogram. The status is set by the block, or "error" if it raises:
+
+        with Metrics.registry.timer("vodsync_token_refresh_seconds", provider="twitch") as t:
+            status, data = refresh()
+            t.labels["status"] = status
+
+    :param name: The name of the histogram.
+    :param labels: The labels of the series.
+    :return: The timer.
+    """
+    return Timer(name, labels)
+
+
+def timed(name: str, label: str = "operation") -> Callable[[Callable], Callable]:
+    """
+    Decorate a function to record the duration of its calls in a histogram, labeled with the function name and the
+    status it returns: the first element of a (status, data) tuple, an integer status, "ok" for any other result, or
+    "error" if it raises.
+    :param name: The name of the histogram.
+    :param label: The label holding the function name.
+    :return: The decorator.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        labels = {label: function.__name__}
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Timer(name, dict(labels)) as t:
+                result = function(*args, **kwargs)
+                status = result[0] if isinstance(result, tuple) and result else result
+                t.labels["status"] = status if isinstance(status, int) and not isinstance(status, bool) else "ok"
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def register_collector(collector: Callable[[], Iterable[tuple]]) -> None:
+    """
+    Register a function which is called for every snapshot, and returns the current values of counters and gauges
+    kept elsewhere (e.g. cache statistics) as tuples of (name, labels, value).
+    :param collector: The function.
+    """
+    _collectors.append(collector)
+
+
+def snapshot() -> list:
+    """
+    Get the current values of all series of this process.
+    :return: A list of series as dictionaries with name, labels and values (see _series).
+    """
+    with _series_lock:
+        series = [{"name": name, "labels": {label: str(value) for label, value in labels}, "values": list(values)}
+                  for (name, labels), values in _series.items()]
+    for collector in _collectors:
+        series += [{"name": name, "labels": {label: str(value) for label, value in labels.items()}, "values": [value]}
+                   for name, labels, value in collector()]
+    # the same series may have been recorded with its labels in another order
+    return merge([series])
+
+
+def is_gauge(name: str) -> bool:
+    """
+    :param name: The name of a metric.
+    :return: True if the metric is a gauge, whose values must not be added up across snapshots.
+    """
+    return METRICS.get(name, ("untyped", ""))[0] == "gauge"
+
+
+def merge(snapshots: Iterable[list]) -> list:
+    """
+    Add up the counters and histograms of several snapshots, e.g. of all worker processes. Gauges keep the value of the
+    last snapshot.
+    :param snapshots: The snapshots.
+    :return: The merged snapshot.
+    """
+    merged = {}
+    for series in snapshots:
+        for entry in series:
+            key = (entry["name"], tuple(sorted(entry["labels"].items())))
+            values = merged.get(key)
+            if values is None or is_gauge(entry["name"]):
+                merged[key] = list(entry["values"])
+            elif len(values) == len(entry["values"]):
+                # series recorded with other buckets (e.g. by an older deployment) are skipped
+                merged[key] = [a + b for a, b in zip(values, entry["values"])]
+    return [{"name": name, "labels": dict(labels), "values": values} for (name, labels), values in merged.items()]
+
+
+def render(series: list) -> str:
+    """
+    Render series in the Prometheus text exposition format.
+    :param series: The series (see snapshot).
+    :return: The text.
+    """
+    by_name = {}
+    for entry in series:
+        by_name.setdefault(entry["name"], []).append(entry)
+    lines = []
+    for name, entries in sorted(by_name.items()):
+        kind, description = METRICS.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for entry in sorted(entries, key=lambda x: sorted(x["labels"].items())):
+            values = entry["values"]
+            if kind != "histogram":
+                lines.append(f"{name}{__format_labels(entry['labels'])} {__format_value(values[0])}")
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (None,), values[:-1]):
+                cumulative += count
+                le = "+Inf" if bound is None else __format_value(bound)
+                lines.append(f"{name}_bucket{__format_labels(entry['labels'], le)} {cumulative}")
+            lines.append(f"{name}_sum{__format_labels(entry['labels'])} {__format_value(values[-1])}")
+            lines.append(f"{name}_count{__format_labels(entry['labels'])} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def __format_labels(labels: dict, le: Optional[str] = None) -> str:
+    """
+    :param labels: The labels of a series.
+    :param le: The upper bound of a histogram bucket, if any.
+    :return: The labels in the exposition format, e.g. {status="200"}.
+    """
+    pairs = sorted(labels.items()) + ([("le", le)] if le is not None else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+
+def __format_value(value: float) -> str:
+    """
+    :param value: A sample value.
+    :return: The value, without a fraction if it is a whole number.
+    """
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
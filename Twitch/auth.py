@@ -1,6 +1,9 @@
 import json
 from typing import Optional
-import requests
+import HTTP.client
+
+# Maximum number of VOD IDs per call to the Helix videos endpoint.
+VIDEOS_PER_CALL = 100
 
 
 class TwitchAuth:
@@ -16,21 +19,94 @@ class TwitchAuth:
         """
         headers = {'Authorization': 'Bearer ' + token, 'Client-ID': self.client_id}
         url = 'https://api.twitch.tv/helix/users'
-        r = requests.get(url, headers=headers)
+        r = HTTP.client.get(url, headers=headers)
+        return self.__parse_username(r)
+
+    @staticmethod
+    def __parse_username(r) -> (int, Optional[str]):
+        """
+        Read the username from a response of the users endpoint.
+        :param r: The response (of requests).
+        :return: A tuple containing the status code of the call, and optionally the name if the call was successful.
+        """
         if r.status_code == 200:
             data = json.loads(r.text)
             return 200, data['data'][0]['login']
         else:
             return r.status_code, None
 
-    def try_refresh_twitch_token(self, refresh_token: str) -> (int, Optional[tuple[str, str]]):
+    def try_get_video(self, token: str, video_id: str) -> (int, Optional[dict]):
+        """
+        Tries to get the metadata of a Twitch VOD.
+        :param token: The access token of the user.
+        :param video_id: The ID of the VOD.
+        :return: A tuple containing the status code of the call, and the metadata of the VOD (id, title, username and
+        created_at) if the call was successful. The metadata is None if the VOD does not exist.
+        """
+        status, videos = self.try_get_videos(token, [video_id])
+        return status, videos[video_id] if status == 200 else None
+
+    def try_get_videos(self, token: str, video_ids: list[str]) -> (int, Optional[dict]):
+        """
+        Tries to get the metadata of several Twitch VODs, with one call per VIDEOS_PER_CALL VODs.
+        :param token: The access token of the user.
+        :param video_ids: The IDs of the VODs.
+        :return: A tuple containing the status code of the calls, and a dictionary of VOD ID to metadata (see
+        try_get_video) if all calls were successful. The metadata is None for VODs which do not exist.
+        """
+        videos = {video_id: None for video_id in video_ids}
+        # VOD IDs are numeric, Helix rejects the whole call with 400 if any ID is not
+        valid_ids = [video_id for video_id in videos if video_id.isascii() and video_id.isdigit()]
+        for i in range(0, len(valid_ids), VIDEOS_PER_CALL):
+            batch = valid_ids[i:i + VIDEOS_PER_CALL]
+            status, data = self.__get_videos(token, batch)
+            if status == 400 and len(batch) > 1:
+                # one ID was rejected anyway, ask for each VOD on its own so the others are still found
+                for video_id in batch:
+                    status, data = self.__get_videos(token, [video_id])
+                    if status not in (200, 400):
+                        return status, None
+                    videos.update(data or {})
+                continue
+            if status == 400:
+                # the only ID of the call was rejected, so the VOD does not exist
+                continue
+            if status != 200:
+                return status, None
+            videos.update(data)
+        return 200, videos
+
+    def __get_videos(self, token: str, video_ids: list[str]) -> (int, Optional[dict]):
+        """
+        Get the metadata of up to VIDEOS_PER_CALL Twitch VODs with one call.
+        :param token: The access token of the user.
+        :param video_ids: The IDs of the VODs.
+        :return: A tuple containing the status code of the call, and a dictionary of VOD ID to metadata of the VODs
+        which exist if the call was successful.
+        """
+        r = HTTP.client.get("https://api.twitch.tv/helix/videos",
+                            params=[("id", video_id) for video_id in video_ids],
+                            headers={"Authorization": f"Bearer {token}", "Client-Id": self.client_id})
+        # Helix rejects the whole call with 404 if none of the VODs exist
+        if r.status_code == 404:
+            return 200, {}
+        if r.status_code != 200:
+            return r.status_code, None
+        return 200, {video['id']: {
+            "id": video['id'],
+            "title": video['title'],
+            "username": video['user_name'],
+            "created_at": video['created_at']
+        } for video in r.json()['data']}
+
+    def try_refresh_twitch_token(self, refresh_token: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Tries to use a refresh token to get a new access token.
         :param refresh_token: The refresh token.
         :return: A tuple containing the status code of the call, and optionally the new access and refresh tokens
-        (in that order) if the call was successful.
+        and the lifetime of the new access token in seconds (in that order) if the call was successful.
         """
-        r = requests.post("https://id.twitch.tv/oauth2/token", data={
+        r = HTTP.client.post("https://id.twitch.tv/oauth2/token", data={
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "refresh_token": refresh_token,
@@ -39,29 +115,48 @@ class TwitchAuth:
         # return new auth data if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], data["refresh_token"])
+            return 200, (data["access_token"], data["refresh_token"], data["expires_in"])
         else:
             return r.status_code, None
 
-    def try_obtain_token(self, code: str, redirect_uri: str) -> (int, Optional[tuple[str, str]]):
+    def try_obtain_token(self, code: str, redirect_uri: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Try to obtain an access token using an OAuth code.
         :param code: The code obtained by the user's login flow.
         :param redirect_uri: The redirect uri of the token process.
-        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens (in that
-        order) if the call was successful.
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
         """
-        r = requests.post("https://id.twitch.tv/oauth2/token", data={
+        r = HTTP.client.post("https://id.twitch.tv/oauth2/token", data=self.__token_request(code, redirect_uri))
+        return self.__parse_tokens(r)
+
+    def __token_request(self, code: str, redirect_uri: str) -> dict:
+        """
+        Build the form data to exchange an OAuth code for tokens.
+        :param code: The code obtained by the user's login flow.
+        :param redirect_uri: The redirect uri of the token process.
+        :return: The form data.
+        """
+        return {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "code": code,
             "redirect_uri": redirect_uri,
             "grant_type": "authorization_code",
-        })
+        }
+
+    @staticmethod
+    def __parse_tokens(r) -> (int, Optional[tuple[str, str, int]]):
+        """
+        Read the tokens from a response of the token endpoint.
+        :param r: The response (of requests).
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
+        """
         # return twitch token and refresh token if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], data["refresh_token"])
+            return 200, (data["access_token"], data["refresh_token"], data["expires_in"])
         else:
             return r.status_code, None
 
@@ -1,6 +1,9 @@
 import json
 from typing import Optional
-import requests
+import HTTP.client
+
+# Maximum number of video IDs per call to the YouTube Data videos endpoint.
+VIDEOS_PER_CALL = 50
 
 
 class YouTubeAuth:
@@ -8,36 +11,55 @@ class YouTubeAuth:
         self.client_id = client_id
         self.client_secret = client_secret
 
-    def try_obtain_token(self, code: str, redirect_uri: str) -> (int, Optional[tuple[str, str]]):
+    def try_obtain_token(self, code: str, redirect_uri: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Try to obtain an access token using an OAuth code.
         :param code: The code obtained by the user's login flow.
         :param redirect_uri: The redirect uri of the token process.
-        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens (in that
-        order) if the call was successful.
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
+        """
+        r = HTTP.client.post("https://oauth2.googleapis.com/token", data=self.__token_request(code, redirect_uri))
+        return self.__parse_tokens(r)
+
+    def __token_request(self, code: str, redirect_uri: str) -> dict:
         """
-        r = requests.post("https://oauth2.googleapis.com/token", data={
+        Build the form data to exchange an OAuth code for tokens.
+        :param code: The code obtained by the user's login flow.
+        :param redirect_uri: The redirect uri of the token process.
+        :return: The form data.
+        """
+        return {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "code": code,
             "redirect_uri": redirect_uri,
             "grant_type": "authorization_code",
-        })
+        }
+
+    @staticmethod
+    def __parse_tokens(r) -> (int, Optional[tuple[str, str, int]]):
+        """
+        Read the tokens from a response of the token endpoint.
+        :param r: The response (of requests).
+        :return: A tuple containing the status code of the call, and optionally the access and refresh tokens and the
+        lifetime of the access token in seconds (in that order) if the call was successful.
+        """
         # return YouTube token and refresh token if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], data["refresh_token"])
+            return 200, (data["access_token"], data["refresh_token"], data["expires_in"])
         else:
             return r.status_code, None
 
-    def try_refresh_youtube_token(self, refresh_token: str) -> (int, Optional[tuple[str, str]]):
+    def try_refresh_youtube_token(self, refresh_token: str) -> (int, Optional[tuple[str, str, int]]):
         """
         Tries to use a refresh token to get a new access token.
         :param refresh_token: The refresh token.
         :return: A tuple containing the status code of the call, and optionally the new access and refresh tokens
-        (in that order) if the call was successful.
+        and the lifetime of the new access token in seconds (in that order) if the call was successful.
         """
-        r = requests.post("https://oauth2.googleapis.com/token", data={
+        r = HTTP.client.post("https://oauth2.googleapis.com/token", data={
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "refresh_token": refresh_token,
@@ -46,7 +68,7 @@ class YouTubeAuth:
         # return new auth data if successful
         if r.status_code == 200:
             data = json.loads(r.text)
-            return 200, (data["access_token"], refresh_token)
+            return 200, (data["access_token"], refresh_token, data["expires_in"])
         else:
             return r.status_code, None
 
@@ -59,13 +81,59 @@ class YouTubeAuth:
         """
         headers = {'Authorization': 'Bearer ' + token}
         url = 'https://www.googleapis.com/oauth2/v3/userinfo'
-        r = requests.get(url, headers=headers)
+        r = HTTP.client.get(url, headers=headers)
+        return YouTubeAuth.__parse_username(r)
+
+    @staticmethod
+    def __parse_username(r) -> (int, Optional[str]):
+        """
+        Read the e-mail from a response of the userinfo endpoint.
+        :param r: The response (of requests).
+        :return: A tuple containing the status code of the call, and optionally the e-mail if the call was successful.
+        """
         if r.status_code == 200:
             data = json.loads(r.text)
             return 200, data['email']
         else:
             return r.status_code, None
 
+    @staticmethod
+    def try_get_video(token: str, video_id: str) -> (int, Optional[dict]):
+        """
+        Tries to get the metadata of a YouTube video.
+        :param token: The access token of the user.
+        :param video_id: The ID of the video.
+        :return: A tuple containing the status code of the call, and the metadata of the video (id, title, created_at
+        and username) if the call was successful. The metadata is None if the video does not exist.
+        """
+        status, videos = YouTubeAuth.try_get_videos(token, [video_id])
+        return status, videos[video_id] if status == 200 else None
+
+    @staticmethod
+    def try_get_videos(token: str, video_ids: list[str]) -> (int, Optional[dict]):
+        """
+        Tries to get the metadata of several YouTube videos, with one call per VIDEOS_PER_CALL videos.
+        :param token: The access token of the user.
+        :param video_ids: The IDs of the videos.
+        :return: A tuple containing the status code of the calls, and a dictionary of video ID to metadata (see
+        try_get_video) if all calls were successful. The metadata is None for videos which do not exist.
+        """
+        videos = {video_id: None for video_id in video_ids}
+        for i in range(0, len(video_ids), VIDEOS_PER_CALL):
+            r = HTTP.client.get("https://www.googleapis.com/youtube/v3/videos",
+                                params={"part": "snippet", "id": ",".join(video_ids[i:i + VIDEOS_PER_CALL])},
+                                headers={"Authorization": f"Bearer {token}"})
+            if r.status_code != 200:
+                return r.status_code, None
+            for video in r.json()['items']:
+                videos[video['id']] = {
+                    "id": video['id'],
+                    "title": video['snippet']['title'],
+                    "created_at": video['snippet']['publishedAt'],
+                    "username": video['snippet']['channelTitle']
+                }
+        return 200, videos
+
     def get_auth_url(self, redirect_uri: str):
         """
         Gets the URL to redirect the user to for the login flow.
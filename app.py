@@ -1,18 +1,28 @@
 import base64
 import os
+import sys
+import time
 
-from bson import json_util
 from dotenv import load_dotenv
-from flask import Flask, render_template, redirect, url_for, session, request
-from flask_session import Session
+from flask import Flask, render_template, redirect, url_for, session, request, g
 
+import FFLogs.API
 import FFLogs.auth
+import Metrics.registry
 from DocStore import MongoDB
+from DocStore.Cache import VodMetadataCache, MongoCacheBackend
+from DocStore.IngestJobs import IngestJobs
+from DocStore.LiveReports import LiveReports
+from DocStore.RateLimiter import RateLimiter
+from DocStore.Sessions import CachedMongoSessionInterface
+from DocStore.SharedMetrics import SharedMetrics
+from DocStore.TokenManager import TokenManager
 from Twitch.auth import TwitchAuth
 from YouTube.auth import YouTubeAuth
 from views.ajax import ajax_routes
 from views.auth import auth_routes
 from views.fflogs import fflogs_routes
+from views.metrics import metrics_routes
 from views.twitch import twitch_routes
 from views.youtube import youtube_routes
 
@@ -31,7 +41,26 @@ if not os.path.isfile(os.getenv("MONGODB_CERT")):
 app.config["MONGO_CLIENT"] = MongoDB.MongoDBConnection(
     os.getenv("MONGODB_URI"),
     os.getenv("MONGODB_CERT"),
-    int(os.getenv("UPDATE_CADENCE"))
+    int(os.getenv("UPDATE_CADENCE")),
+    preload_encounters=os.getenv("PRELOAD_ENCOUNTERS") == "True",
+    cache_max_bytes=int(os.getenv("REPORT_CACHE_MB", "64")) * 1024 * 1024,
+    shared_cache=os.getenv("REPORT_CACHE_SHARED"),
+    columnar=os.getenv("COLUMNAR_REPORTS") == "True"
+)
+
+# all workers share the hourly FFLogs points budget
+app.config["FFLOGS_RATE_LIMITER"] = RateLimiter(
+    app.config["MONGO_CLIENT"].get_client().VodSync.rate_limits,
+    default_limit=int(os.getenv("FFLOGS_POINTS_PER_HOUR", "3600"))
+)
+FFLogs.API.set_rate_limiter(app.config["FFLOGS_RATE_LIMITER"])
+
+# every live report stream holds a thread, so only part of the threads of a worker may serve streams
+app.config["LIVE_REPORTS"] = LiveReports(app.config["MONGO_CLIENT"], int(os.getenv("UPDATE_CADENCE")),
+                                         max_subscriptions=int(os.getenv("LIVE_STREAMS_PER_WORKER", "8")))
+
+app.config["VOD_CACHE"] = VodMetadataCache(
+    MongoCacheBackend(app.config["MONGO_CLIENT"].get_client().VodSync.vod_metadata)
 )
 
 app.config["YOUTUBE_CLIENT"] = YouTubeAuth(
@@ -48,15 +77,41 @@ app.config["FFLOGS_CLIENT"] = FFLogs.auth.FFLogsAuth(
     os.getenv("FFLOGS_CLIENT_ID"),
 )
 
+app.config["TOKEN_MANAGER"] = TokenManager(
+    app.config["MONGO_CLIENT"],
+    app.config["MONGO_CLIENT"].get_client().VodSync.leases,
+    {
+        "fflogs": app.config["FFLOGS_CLIENT"].try_refresh_fflogs_token,
+        "twitch": app.config["TWITCH_CLIENT"].try_refresh_twitch_token,
+        "youtube": app.config["YOUTUBE_CLIENT"].try_refresh_youtube_token,
+    }
+)
+
+app.config["INGEST_JOBS"] = IngestJobs(
+    app.config["MONGO_CLIENT"],
+    app.config["MONGO_CLIENT"].get_client().VodSync.ingest_jobs,
+    app.config["TOKEN_MANAGER"],
+    workers=int(os.getenv("INGEST_WORKERS", "2"))
+)
+
+# metrics of all workers, served by /metrics
+app.config["METRICS"] = SharedMetrics(
+    app.config["MONGO_CLIENT"].get_client().VodSync.metrics,
+    flush_seconds=float(os.getenv("METRICS_FLUSH_SECONDS", "15"))
+)
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
+
 # store other config variables
 app.config["HOST_URL"] = os.getenv("HOST_URL")
 app.config["GOOGLE_ID"] = os.getenv("GOOGLE_CLIENT_ID")
-app.config["SESSION_TYPE"] = "mongodb"
-app.config["SESSION_MONGODB"] = app.config["MONGO_CLIENT"].get_client()
-app.config["SESSION_MONGODB_DB"] = "VodSync"
+app.secret_key = os.getenv("SECRET_KEY")
 
-# setup session
-Session(app)
+# setup session. Keys listed in SESSION_COOKIE_KEYS (e.g. "user") are kept in a signed cookie instead of the database,
+# which requires SECRET_KEY to be set. Never list keys holding secrets, such as "auths".
+app.session_interface = CachedMongoSessionInterface(
+    app.config["MONGO_CLIENT"].get_client().VodSync.sessions,
+    cookie_keys=[key for key in os.getenv("SESSION_COOKIE_KEYS", "").split(",") if key]
+)
 
 # register routes
 with app.app_context():
@@ -65,6 +120,43 @@ with app.app_context():
     app.register_blueprint(twitch_routes)
     app.register_blueprint(ajax_routes)
     app.register_blueprint(auth_routes)
+    app.register_blueprint(metrics_routes)
+
+
+def report_cache_metrics() -> list:
+    """
+    Read the report cache statistics of this worker for the metrics.
+    :return: The counters and gauges as tuples of (name, labels, value).
+    """
+    stats = app.config["MONGO_CLIENT"].get_cache_stats()
+    return [("vodsync_report_cache_events_total", {"event": event}, stats[event])
+            for event in ("local_hits", "shared_hits", "misses", "invalidations")] \
+        + [("vodsync_report_cache_bytes", {}, stats["local_bytes"])]
+
+
+Metrics.registry.register_collector(report_cache_metrics)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Remember when the request started, for the route metrics.
+    """
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Record the latency and status code of the request by route.
+    :param response: The response.
+    :return: The response.
+    """
+    if "request_started" in g:
+        Metrics.registry.observe("vodsync_route_seconds", time.perf_counter() - g.request_started,
+                                 endpoint=request.endpoint or "unmatched", status=response.status_code)
+    app.config["METRICS"].ensure_running()
+    return response
 
 
 @app.route('/home')
@@ -111,37 +203,51 @@ def report():
     if not request.args.get("code"):
         return redirect(url_for("home"))
 
-    # get all fights in report for given code
-    report_status, data = app.config["MONGO_CLIENT"].find_or_load_report(request.args.get("code"),
-                                                                         session["auths"]["fflogs"]["token"])
+    # only read the metadata of a stored report. The page fetches the report payload itself.
+    code = request.args.get("code")
+    report_status, data = app.config["TOKEN_MANAGER"].call_with_auth(
+        session["user"], session["auths"], "fflogs",
+        lambda token: app.config["MONGO_CLIENT"].find_or_load_report(code, token, fields=["metadata"], load=False))
 
-    # TODO we can turn this into a utils function to arbitrarily double-try a function with a re-auth attempt inbetween.
+    # the FFLogs auth was removed if it could not be refreshed, the user has to authorize again
     if report_status == 401:
-        refresh_status, refresh_data = app.config["FFLOGS_CLIENT"].try_refresh_fflogs_token(
-            refresh_token=session["auths"]["fflogs"]["refresh_token"])
-        if refresh_status != 200:
-            # jank auth, reset and redirect
-            del session["auths"]["fflogs"]
-            app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-            return redirect(url_for("home"))
-        else:
-            session["auths"]["fflogs"]["token"] = refresh_data[0]
-            session["auths"]["fflogs"]["refresh_token"] = refresh_data[1]
-            app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-        # re-query
-        report_status, data = app.config["MONGO_CLIENT"].find_or_load_report(request.args.get("code"),
-                                                                             session["auths"]["fflogs"]["token"])
-
-    # simply redirect home if we get an error after a potential 401 retry
+        return redirect(url_for("home"))
+
+    # if the report isn't stored yet, load it in the background. The page shows it as it comes in.
+    if report_status == 404:
+        app.config["INGEST_JOBS"].enqueue(code, session["user"])
+        return render_template('report.html',
+                               title=code,
+                               code=code,
+                               ingest=True,
+                               auths=session["auths"],
+                               username=session["user"])
+
+    # simply redirect home on any other error
     if report_status != 200:
         return redirect(url_for("home"))
 
-    return render_template('report.html', data=json_util.dumps(data).replace("\"", "\\\""),
+    return render_template('report.html',
                            title=data['title'],
-                           code=request.args.get("code"),
+                           code=code,
                            auths=session["auths"],
                            username=session["user"])
 
 
+@app.cli.command("check-indexes")
+def check_indexes():
+    """
+    Explain every hot database query and fail if any of them is not served by an index.
+    """
+    failed = False
+    for name, stages in app.config["MONGO_CLIENT"].verify_query_plans().items():
+        print(f"{name}: {' <- '.join(stages)}")
+        if "COLLSCAN" in stages:
+            failed = True
+    if failed:
+        print("At least one query falls back to a collection scan.")
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,109 @@
+"""
+Compares the size and the encoding/decoding time of synthetic reports with their fights and deaths stored as lists of
+objects and in the columnar format (see DocStore.Columnar): as BSON documents, as JSON and as compressed JSON. If
+BENCHMARK_MONGODB_URI is set, the reports are also written to and read from a scratch database on that (non-production!)
+MongoDB instance, which is dropped afterwards. Run from the repository root:
+
+    [BENCHMARK_MONGODB_URI=mongodb://localhost:27017] python -m benchmarks.columnar [pulls] [deaths per pull] [runs]
+"""
+import gzip
+import os
+import random
+import statistics
+import sys
+import time
+
+import bson
+from bson import json_util
+from pymongo import MongoClient
+
+from DocStore import Columnar
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DATABASE = "VodSyncBenchmark"
+MAX_DOCUMENT_BYTES = 16 * 1024 * 1024
+
+
+def make_report(pulls: int, deaths_per_pull: int) -> dict:
+    """
+    Build a report of a long progression night: pulls of 1 to 10 minutes, with a random number of deaths each.
+    """
+    random.seed(0)
+    start = 1700000000.0
+    fights, deaths = [], []
+    time_in_report = 0
+    for fight_id in range(1, pulls + 1):
+        duration = random.randint(60, 600)
+        fight = {"id": fight_id, "startTime": start + time_in_report, "endTime": start + time_in_report + duration,
+                 "encounterID": random.choice([1069, 1070, 1071])}
+        fights.append(fight)
+        for timestamp in sorted(random.sample(range(duration), random.randint(0, 2 * deaths_per_pull))):
+            deaths.append({"timestamp": fight["startTime"] + timestamp, "targetID": random.randint(1, 8),
+                           "fight": fight_id})
+        time_in_report += duration + random.randint(20, 90)
+    fights.reverse()
+    return {"code": "benchmark", "title": "Benchmark", "startTime": start, "endTime": start + time_in_report,
+            "loaded_at": time.time(), "version": 1, "fights": fights, "deaths": deaths,
+            "player_data": {str(pid): {"name": f"Player {pid}", "type": "Paladin"} for pid in range(1, 9)}}
+
+
+def timed(function, runs: int) -> float:
+    """
+    :return: The median time of a call in milliseconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def measure(label: str, document: dict, runs: int, collection=None) -> None:
+    encoded = bson.encode(document)
+    text = json_util.dumps(document).encode("utf-8")
+    print(f"{label}:")
+    print(f"    BSON {len(encoded) / 1024:9.1f} KiB ({len(encoded) / MAX_DOCUMENT_BYTES:6.2%} of the document limit), "
+          f"encode {timed(lambda: bson.encode(document), runs):6.2f} ms, "
+          f"decode {timed(lambda: bson.decode(encoded), runs):6.2f} ms")
+    print(f"    JSON {len(text) / 1024:9.1f} KiB, gzip {len(gzip.compress(text)) / 1024:7.1f} KiB"
+          + (f", brotli {len(brotli.compress(text)) / 1024:7.1f} KiB" if brotli is not None else "")
+          + f", serialize {timed(lambda: json_util.dumps(document), runs):6.2f} ms")
+    if collection is not None:
+        collection.delete_many({})
+
+        def write():
+            collection.replace_one({"code": document["code"]}, document, upsert=True)
+
+        write_ms = timed(write, runs)
+        read_ms = timed(lambda: collection.find_one({"code": document["code"]}), runs)
+        print(f"    MongoDB write {write_ms:6.2f} ms, read {read_ms:6.2f} ms")
+
+
+def main() -> None:
+    pulls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    deaths_per_pull = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    report = make_report(pulls, deaths_per_pull)
+    columnar = Columnar.encode_report(report)
+    print(f"{pulls} pulls, {len(report['deaths'])} deaths, median of {runs} runs")
+    print(f"Columnar encode {timed(lambda: Columnar.encode_report(report), runs):6.2f} ms, "
+          f"decode {timed(lambda: Columnar.decode_report(dict(columnar)), runs):6.2f} ms")
+
+    uri = os.getenv("BENCHMARK_MONGODB_URI")
+    client = MongoClient(uri) if uri else None
+    collection = client[DATABASE].reports if client else None
+    try:
+        measure("Lists of objects", report, runs, collection)
+        measure("Columnar", columnar, runs, collection)
+    finally:
+        if client:
+            client.drop_database(DATABASE)
+
+
+if __name__ == "__main__":
+    main()
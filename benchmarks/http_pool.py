@@ -0,0 +1,96 @@
+"""
+Compares bare requests calls with the pooled HTTP client against a local HTTPS stub server which serves FFLogs-like
+death pages. Run from the repository root:
+
+    python -m benchmarks.http_pool [pages]
+
+Requires the openssl binary to generate a throwaway self-signed certificate.
+"""
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import HTTP.client
+
+
+class DeathPageHandler(BaseHTTPRequestHandler):
+    # Keep-alive requires HTTP/1.1.
+    protocol_version = "HTTP/1.1"
+    # Buffer the response so headers and body go out in one segment (avoids delayed ACK stalls).
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"data": {"reportData": {"report": {"events": {
+            "data": [{"timestamp": i * 1000, "targetID": i % 8, "fight": 1} for i in range(25)],
+            "nextPageTimestamp": None
+        }}}}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = 0
+
+    def get_request(self):
+        # Every accepted socket is a new TCP + TLS handshake.
+        self.connections += 1
+        return super().get_request()
+
+
+def make_certificate(directory: str) -> (str, str):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+
+def run(label: str, send, url: str, server: CountingServer, pages: int) -> None:
+    server.connections = 0
+    start = time.perf_counter()
+    for _ in range(pages):
+        send(url, json={"query": "{}"}, verify=False).json()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>8}: {pages} pages in {elapsed * 1000:8.1f} ms "
+          f"({elapsed * 1000 / pages:6.2f} ms/page, {server.connections} handshakes)")
+
+
+def main() -> None:
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    warnings.filterwarnings("ignore")
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory)
+        server = CountingServer(("localhost", 0), DeathPageHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"https://localhost:{server.server_address[1]}/api/v2/client"
+
+        run("bare", requests.post, url, server, pages)
+        run("pooled", HTTP.client.post, url, server, pages)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
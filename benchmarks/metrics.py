@@ -0,0 +1,57 @@
+"""
+Measures the overhead the metrics (see Metrics.registry) add to every instrumented call: recording a duration, a timer
+block and a decorated function, compared with an undecorated one. Also measures how long a snapshot and rendering all
+series takes, which happens off the request path (flushes) or per scrape. Run from the repository root:
+
+    python -m benchmarks.metrics [calls]
+"""
+import sys
+import time
+
+import Metrics.registry
+
+
+def per_call(function, calls: int) -> float:
+    """
+    :return: The mean time of a call in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1_000_000
+
+
+def operation() -> tuple:
+    return 200, None
+
+
+def timer_block() -> None:
+    with Metrics.registry.timer("vodsync_fflogs_query_seconds", query="death_page") as t:
+        t.labels["status"] = 200
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    timed_operation = Metrics.registry.timed("vodsync_mongo_operation_seconds")(operation)
+
+    print(f"Mean of {calls} calls")
+    plain = per_call(operation, calls)
+    print(f"    undecorated call     {plain:6.2f} us")
+    decorated = per_call(timed_operation, calls)
+    print(f"    decorated call       {decorated:6.2f} us (+{decorated - plain:.2f} us)")
+    print(f"    timer block          {per_call(timer_block, calls):6.2f} us")
+    observe = per_call(lambda: Metrics.registry.observe("vodsync_route_seconds", 0.01, endpoint="report", status=200),
+                       calls)
+    print(f"    observe              {observe:6.2f} us")
+
+    # a realistic number of series: every route, query type, operation and upstream path with a few status codes
+    for i in range(400):
+        Metrics.registry.observe("vodsync_route_seconds", 0.01, endpoint=f"endpoint{i % 100}", status=200 + i // 100)
+    series = Metrics.registry.snapshot()
+    snapshot_ms = per_call(Metrics.registry.snapshot, 100) / 1000
+    render_ms = per_call(lambda: Metrics.registry.render(Metrics.registry.merge([series] * 4)), 20) / 1000
+    print(f"{len(series)} series: snapshot {snapshot_ms:.2f} ms, merge of 4 workers and render {render_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures report lookups by code on a synthetic collection of 100k reports, without and with the indexes created by
+DocStore.Indexes. Uses a scratch database, which is dropped afterwards. Run from the repository root; without
+BENCHMARK_MONGODB_URI an ephemeral mongod is started with pymongo_inmemory (see requirements-dev.txt), which downloads
+the MongoDB binaries on its first run. Otherwise point it at a local (non-production!) MongoDB instance:
+
+    python -m benchmarks.mongo_indexes [reports] [lookups]
+    BENCHMARK_MONGODB_URI=mongodb://localhost:27017 python -m benchmarks.mongo_indexes [reports] [lookups]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+from pymongo import MongoClient
+
+from DocStore import Indexes
+
+DATABASE = "VodSyncBenchmark"
+
+
+def random_code() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=16))
+
+
+def synthetic_report(code: str) -> dict:
+    start = random.randint(1_600_000_000, 1_700_000_000)
+    return {
+        "code": code,
+        "title": "Synthetic Report",
+        "startTime": start,
+        "endTime": start + 3600,
+        "fights": [{"id": i, "startTime": start + i * 60, "endTime": start + i * 60 + 50, "encounterID": 1000}
+                   for i in range(1, 11)],
+        "deaths": [],
+        "player_data": {},
+        "last_queried_death_timestamp": 0,
+        "loaded_at": time.time(),
+        "version": 1,
+    }
+
+
+def measure(label: str, db, codes: list, lookups: int) -> None:
+    sample = random.choices(codes, k=lookups)
+    start = time.perf_counter()
+    for code in sample:
+        db.reports.find_one({"code": code}, {"_id": 1})
+    elapsed = time.perf_counter() - start
+    stages = Indexes.plan_stages(db.reports.find({"code": sample[0]}).explain()["queryPlanner"]["winningPlan"])
+    print(f"{label:>14}: {lookups} lookups in {elapsed * 1000:9.1f} ms "
+          f"({elapsed * 1000 / lookups:7.3f} ms/lookup), plan: {' <- '.join(stages)}")
+
+
+def main() -> None:
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    if os.getenv("BENCHMARK_MONGODB_URI"):
+        client = MongoClient(os.getenv("BENCHMARK_MONGODB_URI"))
+    else:
+        import pymongo_inmemory
+        client = pymongo_inmemory.MongoClient()
+    client.drop_database(DATABASE)
+    db = client[DATABASE]
+    try:
+        codes = [random_code() for _ in range(reports)]
+        for i in range(0, reports, 5000):
+            db.reports.insert_many([synthetic_report(code) for code in codes[i:i + 5000]])
+        print(f"Inserted {reports} synthetic reports.")
+
+        measure("no index", db, codes, lookups)
+        Indexes.ensure_indexes(db)
+        measure("indexed", db, codes, lookups)
+
+        for name, stages in Indexes.verify_query_plans(db).items():
+            print(f"{name}: {' <- '.join(stages)}")
+    finally:
+        client.drop_database(DATABASE)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
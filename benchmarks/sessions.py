@@ -0,0 +1,153 @@
+"""
+Measures the latency of requests of a logged-in user with Flask-Session's MongoDB backend and with DocStore.Sessions.
+The database is reached through a local TCP proxy which delays all traffic, to simulate the round trip time to a hosted
+(e.g. Atlas) cluster. Requests alternate randomly between two app instances sharing the database, like two gunicorn
+workers, and 1 in 20 requests changes the session (like a token refresh). Uses a scratch database, which is dropped
+afterwards. Run from the repository root against a local (non-production!) MongoDB instance:
+
+    BENCHMARK_MONGODB_URI=mongodb://localhost:27017 python -m benchmarks.sessions [rtt ms] [requests]
+
+The Flask-Session baseline is skipped if Flask-Session is not installed.
+"""
+import os
+import queue
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from flask import Flask, session
+from pymongo import MongoClient, uri_parser
+
+from DocStore import Indexes
+from DocStore.Sessions import CachedMongoSessionInterface
+
+try:
+    from flask_session.sessions import MongoDBSessionInterface
+except ImportError:
+    MongoDBSessionInterface = None
+
+DATABASE = "VodSyncBenchmark"
+
+
+class DelayProxy:
+    def __init__(self, upstream: tuple, rtt: float) -> None:
+        """
+        Forwards TCP connections to an upstream server, delaying the data in each direction by half the round trip time.
+        """
+        self.upstream = upstream
+        self.delay = rtt / 2
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            client, _ = self.listener.accept()
+            server = socket.create_connection(self.upstream)
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pipe(client, server)
+            self.pipe(server, client)
+
+    def pipe(self, source: socket.socket, target: socket.socket) -> None:
+        # Reading and writing in separate threads delays every chunk without limiting the throughput.
+        chunks = queue.Queue()
+
+        def read() -> None:
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                chunks.put((time.perf_counter() + self.delay, data))
+                if not data:
+                    return
+
+        def write() -> None:
+            while True:
+                due, data = chunks.get()
+                time.sleep(max(0.0, due - time.perf_counter()))
+                try:
+                    if not data:
+                        target.shutdown(socket.SHUT_WR)
+                        return
+                    target.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+
+def make_app(interface) -> Flask:
+    app = Flask(__name__)
+    app.secret_key = "benchmark"
+    app.session_interface = interface
+
+    @app.route("/login")
+    def login():
+        session["user"] = "user@example.com"
+        session["auths"] = {provider: {"token": "t" * 30, "refresh_token": "r" * 50, "username": "user",
+                                       "expires_at": time.time() + 3600}
+                            for provider in ("fflogs", "twitch", "youtube")}
+        return "ok"
+
+    @app.route("/poll")
+    def poll():
+        return session["auths"]["fflogs"]["token"]
+
+    @app.route("/refresh")
+    def refresh():
+        session["auths"]["twitch"]["token"] = str(random.random())
+        return "ok"
+
+    return app
+
+
+def measure(label: str, interfaces: list, requests: int) -> None:
+    apps = [make_app(interface) for interface in interfaces]
+    clients = [app.test_client() for app in apps]
+    for client in clients[1:]:
+        client.cookie_jar = clients[0].cookie_jar
+    clients[0].get("/login")
+
+    latencies = []
+    for i in range(requests):
+        path = "/refresh" if i % 20 == 19 else "/poll"
+        start = time.perf_counter()
+        response = random.choice(clients).get(path)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{label:>24}: p50 {percentiles[49]:7.2f} ms, p99 {percentiles[98]:7.2f} ms, "
+          f"mean {statistics.mean(latencies):7.2f} ms")
+
+
+def main() -> None:
+    rtt = (int(sys.argv[1]) if len(sys.argv) > 1 else 30) / 1000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    uri = os.getenv("BENCHMARK_MONGODB_URI", "mongodb://localhost:27017")
+    proxy = DelayProxy(uri_parser.parse_uri(uri)["nodelist"][0], rtt)
+    client = MongoClient(f"mongodb://127.0.0.1:{proxy.port}", directConnection=True)
+    client.drop_database(DATABASE)
+    db = client[DATABASE]
+    try:
+        Indexes.ensure_indexes(db)
+        print(f"{requests} requests, {rtt * 1000:.0f} ms simulated round trip time to MongoDB")
+        if MongoDBSessionInterface is not None:
+            interface = MongoDBSessionInterface(client, DATABASE, "sessions", "session:")
+            measure("Flask-Session", [interface, interface], requests)
+        else:
+            print("Flask-Session is not installed, skipping the baseline")
+        measure("DocStore.Sessions", [CachedMongoSessionInterface(db.sessions),
+                                      CachedMongoSessionInterface(db.sessions)], requests)
+    finally:
+        client.drop_database(DATABASE)
+
+
+if __name__ == "__main__":
+    main()
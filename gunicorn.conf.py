@@ -0,0 +1,8 @@
+import os
+
+# Every worker process serves requests on a pool of threads, so live report streams and slow upstream calls only hold
+# a thread instead of a whole process. Only LIVE_STREAMS_PER_WORKER threads (default 8) serve streams, further viewers
+# poll for new pulls instead.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
@@ -0,0 +1,87 @@
+import threading
+import time
+import types
+import mongomock
+import pytest
+import DocStore.Cache
+from DocStore.Cache import LRUCache, MongoCacheBackend, ReportCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=time.time())
+    monkeypatch.setattr(DocStore.Cache, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def report(loaded_at: float) -> dict:
+    return {"_id": 1, "code": "abc", "title": "Report", "loaded_at": loaded_at}
+
+
+def test_least_recently_used_entries_are_evicted_by_size():
+    cache = LRUCache(10)
+    cache.set("a", b"aaaa", time.time() + 60)
+    cache.set("b", b"bbbb", time.time() + 60)
+    cache.get("a")
+    cache.set("c", b"cccc", time.time() + 60)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (b"aaaa", None, b"cccc")
+    assert cache.size() == 8
+
+    # replacing an entry only counts its new size, values larger than the cache are not stored
+    cache.set("a", b"aa", time.time() + 60)
+    assert cache.size() == 6
+    cache.set("d", b"d" * 11, time.time() + 60)
+    assert cache.get("d") is None and cache.size() == 6
+
+
+def test_report_is_cached_until_it_may_be_refreshed(clock):
+    cache = ReportCache(1024 * 1024, allow_updates_every_n_seconds=600, min_ttl=30)
+    cache.set(report(loaded_at=clock.now - 100))
+    clock.now += 499
+    assert cache.get("abc")["title"] == "Report"
+    clock.now += 2
+    assert cache.get("abc") is None
+
+
+def test_report_is_cached_for_at_least_min_ttl(clock):
+    cache = ReportCache(1024 * 1024, allow_updates_every_n_seconds=600, min_ttl=30)
+    # the report could have been refreshed long ago
+    cache.set(report(loaded_at=clock.now - 10_000))
+    clock.now += 29
+    assert cache.get("abc") is not None
+    clock.now += 2
+    assert cache.get("abc") is None
+
+
+def test_invalidation_reaches_the_shared_backend():
+    backend = MongoCacheBackend(mongomock.MongoClient().db.cache)
+    writer, reader, other = (ReportCache(1024 * 1024, 600, backend) for _ in range(3))
+    writer.set(report(loaded_at=time.time()))
+    assert reader.get("abc")["title"] == "Report"
+    assert reader.get_stats()["shared_hits"] == 1
+
+    writer.invalidate("abc")
+    assert writer.get("abc") is None
+    assert other.get("abc") is None
+    assert backend.get("report:abc") is None
+    # workers which read the report before keep it in-process, for up to min_ttl
+    assert reader.get("abc") is not None
+    assert (writer.get_stats()["invalidations"], other.get_stats()["misses"]) == (1, 1)
+
+
+def test_counters_are_exact_under_concurrent_use():
+    cache = ReportCache(1024 * 1024, 600)
+    cache.set(report(loaded_at=time.time()))
+
+    def read():
+        for _ in range(500):
+            cache.get("abc")
+            cache.get("missing")
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.get_stats()
+    assert (stats["local_hits"], stats["misses"]) == (4000, 4000)
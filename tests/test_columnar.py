@@ -0,0 +1,58 @@
+from DocStore import Columnar
+
+START = 1_650_000_000
+
+
+def make_report() -> dict:
+    fights = [{"id": fight_id, "encounterID": 1000 + fight_id, "startTime": START + fight_id * 600,
+               "endTime": START + fight_id * 600 + 295.5} for fight_id in (3, 2, 1)]
+    deaths = [{"timestamp": START + fight_id * 600 + second, "targetID": target, "fight": fight_id}
+              for fight_id in (1, 2, 3) for second, target in ((10, 1), (10, 2), (200, 3))]
+    return {"code": "abc", "startTime": START, "endTime": START + 3600, "fights": fights, "deaths": deaths,
+            "player_data": {"1": {"name": "Tank"}}}
+
+
+def test_fights_round_trip():
+    fights = make_report()["fights"]
+    columns = Columnar.encode_fights(fights, START)
+    assert columns["id"] == [3, 2, 1]
+    # whole numbers are stored as integers
+    assert columns["start"] == [1800, 1200, 600]
+    assert columns["duration"] == [295.5] * 3
+    assert Columnar.decode_fights(columns) == fights
+
+
+def test_deaths_round_trip():
+    deaths = make_report()["deaths"]
+    columns = Columnar.encode_deaths(deaths, START)
+    # the time since the previous death
+    assert columns["timestamp"][:4] == [610, 0, 190, 410]
+    assert Columnar.decode_deaths(columns) == deaths
+
+    # deaths appended to stored ones continue from the last stored death
+    appended = Columnar.encode_deaths(deaths[6:], START, previous=deaths[5]["timestamp"])
+    stored = Columnar.encode_deaths(deaths[:6], START)
+    for key in ("timestamp", "targetID", "fight"):
+        stored[key] += appended[key]
+    assert Columnar.decode_deaths(stored) == deaths
+
+    # deaths stored per fight don't store their fight
+    del columns["fight"]
+    assert Columnar.decode_deaths(columns) == [{key: value for key, value in death.items() if key != "fight"}
+                                               for death in deaths]
+
+
+def test_report_round_trip():
+    report = make_report()
+    encoded = Columnar.encode_report(report)
+    assert Columnar.is_columnar(encoded) and not Columnar.is_columnar(report)
+    assert encoded["columnar"] is True
+    # the report itself is not modified
+    assert report == make_report()
+    assert Columnar.decode_report(encoded) == dict(make_report(), columnar=True)
+
+
+def test_legacy_report_is_read_as_it_is():
+    report = make_report()
+    assert Columnar.decode_report(report) == dict(make_report(), columnar=False)
+    assert Columnar.decode_report(None) is None
@@ -0,0 +1,138 @@
+import re
+import threading
+import pytest
+import FFLogs.API
+
+START = 1_650_000_000_000
+PAGE_SIZE = 2
+
+
+class FakeResponse:
+    def __init__(self, report: dict) -> None:
+        self.report = report
+
+    def json(self) -> dict:
+        return {"data": {"reportData": {"report": self.report}}}
+
+
+class FakeFFLogs:
+    """
+    The client endpoint of FFLogs for one report, which pages deaths like FFLogs does: PAGE_SIZE deaths per page, and
+    the timestamp of the next death as nextPageTimestamp. Timestamps are in milliseconds relative to the report start.
+    """
+
+    def __init__(self, fights: list, deaths: list) -> None:
+        self.fights = fights
+        self.deaths = deaths
+        self.death_pages = []
+        self.lock = threading.Lock()
+
+    def __call__(self, token: str, query: str, query_type: str) -> tuple:
+        if query_type == "full_report":
+            return 200, FakeResponse({
+                "startTime": START,
+                "endTime": START + 6_000_000,
+                "title": "Report",
+                "fights": [dict(fight) for fight in self.fights],
+                "events": self.page([fight["id"] for fight in self.fights if fight["encounterID"] != 0], 0, None),
+                "playerDetails": {"data": {"playerDetails": {"tanks": [
+                    {"id": target, "name": f"Player {target}", "type": "Paladin"} for target in (1, 2, 3)]}}},
+            })
+        assert query_type == "death_page"
+        fight_ids = [int(fid) for fid in re.search(r"fightIDs: \[([^]]*)]", query).group(1).split(", ")]
+        start = int(re.search(r"startTime: (\d+)", query).group(1))
+        end = int(re.search(r"endTime: (\d+)", query).group(1))
+        with self.lock:
+            self.death_pages.append((fight_ids, start, end))
+        return 200, FakeResponse({"events": self.page(fight_ids, start, end)})
+
+    def page(self, fight_ids: list, start: int, end) -> dict:
+        matching = [death for death in self.deaths
+                    if death["fight"] in fight_ids and start <= death["timestamp"] and (end is None or
+                                                                                      death["timestamp"] < end)]
+        return {"data": matching[:PAGE_SIZE],
+                "nextPageTimestamp": matching[PAGE_SIZE]["timestamp"] if len(matching) > PAGE_SIZE else None}
+
+
+def make_report(boss_fights: int) -> FakeFFLogs:
+    """
+    A report with a trash fight after the first boss fight. The boss fights start and end off the full second, and
+    each has a death right after its start, one in the middle, and one right before its end.
+    """
+    fights, deaths = [], []
+    for fight_id in range(1, boss_fights + 2):
+        start = fight_id * 600_000 + 600
+        end = start + 299_800
+        fights.append({"id": fight_id, "encounterID": 0 if fight_id == 2 else 1000, "startTime": start,
+                       "endTime": end})
+        for target, timestamp in ((1, start + 200), (2, start + 100_000), (3, end - 100)):
+            deaths.append({"timestamp": timestamp, "targetID": target, "fight": fight_id})
+    return FakeFFLogs(fights, deaths)
+
+
+@pytest.fixture
+def concurrency(monkeypatch):
+    monkeypatch.setattr(FFLogs.API, "DEATH_QUERY_CONCURRENCY", 3)
+
+
+def test_deaths_are_paged_per_fight_group(monkeypatch, concurrency):
+    fflogs = make_report(boss_fights=7)
+    monkeypatch.setattr(FFLogs.API, "__call_client_endpoint", fflogs)
+    status, report = FFLogs.API.get_report_data("token", "abc")
+    assert status == 200
+
+    # every death of the boss fights, ordered by fight, and none of the trash fight
+    boss_deaths = [death for death in fflogs.deaths if death["fight"] != 2]
+    assert [(d["fight"], d["targetID"]) for d in report["deaths"]] == \
+           [(d["fight"], d["targetID"]) for d in boss_deaths]
+    assert [d["timestamp"] for d in report["deaths"]] == sorted(d["timestamp"] for d in report["deaths"])
+    assert set(report["player_data"]) == {"1", "2", "3"}
+
+    # the first page came with the report, the 7 fights still to be queried (starting with the rest of fight 1) are
+    # split into 3 groups of contiguous fights, the last one shorter
+    groups = sorted({tuple(fight_ids) for fight_ids, _, _ in fflogs.death_pages})
+    assert groups == [(1, 3, 4), (5, 6, 7), (8,)]
+    # each group follows pagination until its deaths are complete
+    pages = {group: len([page for page in fflogs.death_pages if tuple(page[0]) == group]) for group in groups}
+    assert pages == {(1, 3, 4): 4, (5, 6, 7): 5, (8,): 2}
+
+
+def test_death_windows_are_padded_to_the_full_second(monkeypatch, concurrency):
+    fflogs = make_report(boss_fights=2)
+    monkeypatch.setattr(FFLogs.API, "__call_client_endpoint", fflogs)
+    status, report = FFLogs.API.get_report_data("token", "abc")
+    assert status == 200
+    # the death right before the end of the last fight is after its end as stored in seconds
+    assert len(report["deaths"]) == 6
+
+    # 2 fights left for 3 queries: one fight per group. The window of fight 1 starts where the first page ended, the
+    # window of fight 3 starts a second before its stored start and ends a second after its stored end.
+    windows = {}
+    for fight_ids, start, end in fflogs.death_pages:
+        windows.setdefault(tuple(fight_ids), (start, end))
+    assert windows == {(1,): (900_300, 900_000 + 1000), (3,): (1_801_000 - 1000, 2_100_000 + 1000)}
+    assert report["last_queried_death_timestamp"] == 2_100_000 + 1000
+
+
+def test_update_continues_after_the_queried_deaths(monkeypatch, concurrency):
+    fflogs = make_report(boss_fights=3)
+    monkeypatch.setattr(FFLogs.API, "__call_client_endpoint", fflogs)
+    status, report = FFLogs.API.get_report_data("token", "abc")
+    assert status == 200
+
+    # a new pull was added to the report
+    fflogs.fights.append({"id": 5, "encounterID": 1000, "startTime": 3_000_600, "endTime": 3_300_400})
+    fflogs.deaths.append({"timestamp": 3_100_000, "targetID": 1, "fight": 5})
+    fflogs.death_pages.clear()
+
+    def load_base_report(token, code, unknown=False):
+        return 200, FFLogs.API.__parse_base_report(fflogs(token, "", "full_report")[1].json()["data"]["reportData"]
+                                                   ["report"], code, unknown)
+
+    monkeypatch.setattr(FFLogs.API, "__load_base_report", load_base_report)
+    status, updated = FFLogs.API.try_update_report("token", report)
+    assert status == 200
+    # only the new fight is queried, and no death is added twice
+    assert [fight_ids for fight_ids, _, _ in fflogs.death_pages] == [[5]]
+    assert [(d["fight"], d["targetID"]) for d in updated["deaths"]] == \
+           [(d["fight"], d["targetID"]) for d in report["deaths"]] + [(5, 1)]
@@ -0,0 +1,121 @@
+import threading
+import time
+import mongomock
+from DocStore.IngestJobs import IngestJobs
+from DocStore.TokenManager import TokenManager
+
+
+class FakeMongo:
+    """
+    The parts of MongoDBConnection the jobs use: stored auths, and a report load which only accepts one token.
+    """
+
+    def __init__(self, auths: dict, valid_token: str) -> None:
+        self.auths = auths
+        self.valid_token = valid_token
+        self.loads = []
+        # set to pause the load after its first stage
+        self.paused = None
+        self.job_collection = None
+        self.claimed_lease = None
+        self.resume = threading.Event()
+
+    def get_auth_keys(self, username: str) -> dict:
+        return {provider: dict(auth) for provider, auth in self.auths.get(username, {}).items()}
+
+    def update_provider(self, username: str, provider: str, auth: dict) -> None:
+        self.auths[username][provider] = auth
+
+    def remove_provider(self, username: str, provider: str) -> None:
+        self.auths[username].pop(provider, None)
+
+    def ingest_report(self, code: str, fflogs_token: str, progress) -> int:
+        self.loads.append(fflogs_token)
+        if fflogs_token != self.valid_token:
+            return 401
+        if self.job_collection is not None:
+            self.claimed_lease = self.job_collection.find_one({"_id": code})["lease_expires_at"]
+            # stored dates have millisecond precision, the renewed lease has to differ
+            time.sleep(0.01)
+        report = {"code": code, "title": "Report", "fights": [{"id": 1}, {"id": 2}, {"id": 3}], "encounternames": {}}
+        progress("fights", dict(report))
+        if self.paused:
+            self.paused.set()
+            self.resume.wait(5)
+        report.update(deaths=[{"fight": 1}], death_index={"1": {"start": 0, "count": 1}})
+        progress("deaths", dict(report))
+        report.update(player_data={"1": {"name": "Tank"}})
+        progress("players", dict(report))
+        return 200
+
+
+def make_jobs(mongo: FakeMongo) -> (IngestJobs, mongomock.Collection):
+    db = mongomock.MongoClient().db
+    tokens = TokenManager(mongo, db.leases, {"fflogs": lambda refresh_token: (200, ("fresh", "next", 3600))})
+    return IngestJobs(mongo, db.ingest_jobs, tokens, workers=1, poll_interval=0.01), db.ingest_jobs
+
+
+def wait_for_job(jobs: IngestJobs, code: str) -> dict:
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        job = jobs.get_job(code)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_job_stores_the_user_and_not_the_token():
+    mongo = FakeMongo({"user": {"fflogs": {"token": "valid", "refresh_token": "refresh"}}}, "valid")
+    jobs, collection = make_jobs(mongo)
+    jobs.enqueue("abc", "user")
+    stored = collection.find_one({"_id": "abc"})
+    assert stored["user"] == "user"
+    assert "valid" not in stored.values()
+    assert "user" not in jobs.get_job("abc")
+    job = wait_for_job(jobs, "abc")
+    assert job["result_status"] == 200
+    assert job["counts"]["fights"] == 3
+    assert mongo.loads == ["valid"]
+
+
+def test_job_refreshes_a_rejected_token():
+    mongo = FakeMongo({"user": {"fflogs": {"token": "stale", "refresh_token": "refresh"}}}, "fresh")
+    jobs, _ = make_jobs(mongo)
+    jobs.enqueue("abc", "user")
+    assert wait_for_job(jobs, "abc")["result_status"] == 200
+    assert mongo.loads == ["stale", "fresh"]
+    assert mongo.auths["user"]["fflogs"]["token"] == "fresh"
+
+
+def test_job_fails_without_fflogs_auth():
+    mongo = FakeMongo({"user": {}}, "valid")
+    jobs, _ = make_jobs(mongo)
+    jobs.enqueue("abc", "user")
+    job = wait_for_job(jobs, "abc")
+    assert (job["status"], job["result_status"]) == ("failed", 401)
+    assert mongo.loads == []
+
+
+def test_partial_report_is_stored_stage_by_stage():
+    mongo = FakeMongo({"user": {"fflogs": {"token": "valid", "refresh_token": "refresh"}}}, "valid")
+    mongo.paused = threading.Event()
+    jobs, collection = make_jobs(mongo)
+    mongo.job_collection = collection
+    jobs.enqueue("abc", "user")
+    assert mongo.paused.wait(5)
+
+    job = jobs.get_job("abc")
+    assert (job["status"], job["stage"]) == ("running", "fights")
+    assert [fight["id"] for fight in job["report"]["fights"]] == [1, 2, 3]
+    assert "deaths" not in job["report"]
+    # the caller already has the fights
+    assert "fights" not in jobs.get_job("abc", "fights").get("report", {})
+    # the first stage renewed the lease
+    assert collection.find_one({"_id": "abc"})["lease_expires_at"] > mongo.claimed_lease
+
+    mongo.resume.set()
+    job = wait_for_job(jobs, "abc")
+    assert job["counts"] == {"fights": 3, "deaths": 1, "players": 1}
+    # the report is stored by now, the job doesn't keep a copy
+    assert "report" not in job
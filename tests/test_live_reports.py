@@ -0,0 +1,20 @@
+from DocStore.LiveReports import LiveReports
+
+
+class NoReports:
+    def get_report_versions(self, codes) -> dict:
+        return {}
+
+
+def test_viewers_beyond_the_limit_are_rejected():
+    live_reports = LiveReports(NoReports(), 60, max_subscriptions=2)
+    first = live_reports.subscribe("abc", "token", 1)
+    second = live_reports.subscribe("def", "token", 1)
+    assert first is not None and second is not None
+    assert live_reports.subscribe("abc", "token", 1) is None
+
+    live_reports.unsubscribe(first)
+    # unsubscribing twice doesn't free a second slot
+    live_reports.unsubscribe(first)
+    assert live_reports.subscribe("abc", "token", 1) is not None
+    assert live_reports.subscribe("abc", "token", 1) is None
@@ -0,0 +1,50 @@
+import datetime
+import mongomock
+import Metrics.registry
+from DocStore.SharedMetrics import SharedMetrics
+
+
+def histogram(count: int) -> list:
+    return [count] + [0] * len(Metrics.registry.BUCKETS) + [0.001 * count]
+
+
+def worker_document(owner: str, updated_at: datetime.datetime, requests: int, cache_bytes: int) -> dict:
+    return {"_id": owner, "updated_at": updated_at, "series": [
+        {"name": "vodsync_route_seconds", "labels": {"endpoint": "report", "status": "200"},
+         "values": histogram(requests)},
+        {"name": "vodsync_report_cache_events_total", "labels": {"event": "misses"}, "values": [requests]},
+        {"name": "vodsync_report_cache_bytes", "labels": {}, "values": [cache_bytes]},
+    ]}
+
+
+def by_key(series: list) -> dict:
+    return {(entry["name"], tuple(sorted(entry["labels"].items()))): entry["values"] for entry in series}
+
+
+def test_merge_adds_up_counters_and_histograms_but_not_gauges():
+    first = worker_document("a:1:x", datetime.datetime.utcnow(), 2, 100)["series"]
+    second = worker_document("b:2:y", datetime.datetime.utcnow(), 3, 300)["series"]
+    merged = by_key(Metrics.registry.merge([first, second]))
+    assert merged[("vodsync_route_seconds", (("endpoint", "report"), ("status", "200")))][0] == 5
+    assert merged[("vodsync_report_cache_events_total", (("event", "misses"),))] == [5]
+    assert merged[("vodsync_report_cache_bytes", ())] == [300]
+
+
+def test_gauges_are_only_read_from_live_workers():
+    collection = mongomock.MongoClient().db.metrics
+    now = datetime.datetime.utcnow()
+    collection.insert_one(worker_document("alive:1:x", now, 2, 100))
+    collection.insert_one(worker_document("exited:2:y", now - datetime.timedelta(hours=2), 3, 300))
+    shared = SharedMetrics(collection, flush_seconds=1000)
+    series = by_key(shared.collect())
+
+    assert series[("vodsync_report_cache_events_total", (("event", "misses"),))][0] >= 5
+    gauges = {labels: values for (name, labels), values in series.items() if name == "vodsync_report_cache_bytes"}
+    assert gauges[(("worker", "alive:1"),)] == [100]
+    assert not any(("worker", "exited:2") in labels for labels in gauges)
+
+
+def test_collect_does_not_write():
+    collection = mongomock.MongoClient().db.metrics
+    SharedMetrics(collection, flush_seconds=1000).collect()
+    assert collection.count_documents({}) == 0
@@ -0,0 +1,92 @@
+import time
+import mongomock
+from DocStore.RateLimiter import RateLimiter, INTERACTIVE, BACKGROUND, PREFETCH
+
+
+class CountingCollection:
+    """
+    Counts the calls to a collection, to measure database round trips.
+    """
+
+    def __init__(self, collection) -> None:
+        self.collection = collection
+        self.calls = 0
+
+    def __getattr__(self, name):
+        self.calls += 1
+        return getattr(self.collection, name)
+
+
+def make_limiter(collection=None, **kwargs) -> RateLimiter:
+    collection = collection if collection is not None else mongomock.MongoClient().db.rate_limits
+    kwargs = dict(dict(default_limit=100, max_wait=0, max_delay=0), **kwargs)
+    return RateLimiter(collection, **kwargs)
+
+
+def spend_all(limiter: RateLimiter, priority: int) -> int:
+    granted = 0
+    while limiter.acquire(priority):
+        granted += 1
+    return granted
+
+
+def test_priorities_are_capped_at_their_ceilings():
+    limiter = make_limiter()
+    assert spend_all(limiter, PREFETCH) == 60
+    assert spend_all(limiter, BACKGROUND) == 20
+    assert spend_all(limiter, INTERACTIVE) == 20
+    assert limiter.get_budget()["remaining"] == 0
+
+
+def test_budget_is_shared_between_workers():
+    collection = mongomock.MongoClient().db.rate_limits
+    first, second = make_limiter(collection), make_limiter(collection)
+    granted = 0
+    for _ in range(100):
+        granted += first.acquire(PREFETCH) + second.acquire(PREFETCH)
+    assert granted == 60
+    assert collection.find_one({"_id": "fflogs"})["spent"] == 60
+
+
+def test_interactive_calls_keep_working_when_background_is_exhausted():
+    collection = mongomock.MongoClient().db.rate_limits
+    background, interactive = make_limiter(collection), make_limiter(collection)
+    spend_all(background, BACKGROUND)
+    assert not background.acquire(PREFETCH)
+    assert interactive.acquire(INTERACTIVE)
+
+
+def test_most_calls_do_not_touch_the_database():
+    collection = CountingCollection(mongomock.MongoClient().db.rate_limits)
+    limiter = make_limiter(collection, default_limit=3600, batch_size=10)
+    for _ in range(100):
+        assert limiter.acquire(INTERACTIVE)
+    # one read and insert of the budget document, then one draw per 10 calls
+    assert collection.calls <= 2 + 10 + 1
+
+
+def test_unspent_allowance_is_dropped_at_the_next_hour(monkeypatch):
+    limiter = make_limiter()
+    limiter.acquire(INTERACTIVE)
+    next_hour = time.time() + 3601
+    monkeypatch.setattr(time, "time", lambda: next_hour)
+    assert limiter.acquire(PREFETCH)
+    budget = limiter.get_budget()
+    assert budget["reset_at"] > next_hour
+    assert budget["spent"] == 10
+
+
+def test_record_corrects_the_count():
+    collection = mongomock.MongoClient().db.rate_limits
+    limiter = make_limiter(collection)
+    limiter.acquire(INTERACTIVE)
+    reset_in = limiter.get_budget()["reset_at"] - time.time()
+    # reports lagging behind the reservations don't lower the count within the hour
+    limiter.record(3600, 5, reset_in)
+    assert limiter.get_budget()["spent"] == 10
+    limiter.record(3600, 500, reset_in)
+    assert limiter.get_budget()["spent"] == 500
+    # a new hour replaces it
+    limiter.record(3600, 3, reset_in + 3000)
+    assert limiter.get_budget()["spent"] == 3
+    assert limiter.get_budget()["limit"] == 3600
@@ -0,0 +1,117 @@
+import re
+import pytest
+import FFLogs.API
+
+START_MS = 1_650_000_000_000
+START = START_MS // 1000
+
+
+class FakeResponse:
+    def __init__(self, report: dict) -> None:
+        self.report = report
+
+    def json(self) -> dict:
+        return {"data": {"reportData": {"report": self.report}}}
+
+
+class FakeFFLogs:
+    """
+    The client endpoint of FFLogs for the delta queries of one report. Timestamps are in milliseconds relative to the
+    report start.
+    """
+
+    def __init__(self, fights: list, deaths: list) -> None:
+        self.fights = fights
+        self.deaths = deaths
+        self.queries = []
+
+    def __call__(self, token: str, query: str, query_type: str) -> tuple:
+        if query_type == "player_details":
+            return 200, FakeResponse({"playerDetails": {"data": {"playerDetails": {"dps": [
+                {"id": target, "name": f"Player {target}", "type": "Ninja"} for target in range(1, 10)]}}}})
+        assert query_type == "report_delta"
+        fight_ids, event_ids = [[int(fid) for fid in ids.split(", ")]
+                                for ids in re.findall(r"fightIDs: \[([^]]*)]", query)]
+        self.queries.append((fight_ids, event_ids))
+        return 200, FakeResponse({
+            "endTime": START_MS + max(fight["endTime"] for fight in self.fights),
+            "fights": [dict(fight) for fight in self.fights if fight["id"] in fight_ids],
+            "events": {"data": [death for death in self.deaths if death["fight"] in event_ids],
+                       "nextPageTimestamp": None},
+        })
+
+
+def fight(fight_id: int, duration: int = 300_000) -> dict:
+    return {"id": fight_id, "encounterID": 1000, "startTime": fight_id * 600_000,
+            "endTime": fight_id * 600_000 + duration}
+
+
+def death(fight_id: int, target: int) -> dict:
+    return {"timestamp": fight_id * 600_000 + 100_000, "targetID": target, "fight": fight_id}
+
+
+def stored_report(fights: list) -> dict:
+    """
+    A report as it is stored after loading the given fights, with one death per fight of player 1.
+    """
+    fights = [dict(f, startTime=START + f["startTime"] // 1000, endTime=START + f["endTime"] // 1000)
+              for f in reversed(fights)]
+    return {
+        "code": "abc",
+        "startTime": START,
+        "endTime": fights[0]["endTime"],
+        "fights": fights,
+        "deaths": [{"timestamp": START + death(f["id"], 1)["timestamp"] // 1000, "targetID": 1, "fight": f["id"]}
+                   for f in reversed(fights)],
+        "player_data": {"1": {"name": "Player 1", "class": "Ninja"}},
+        "last_queried_death_timestamp": (fights[0]["endTime"] - START) * 1000 + 1000,
+        "last_fight_id": fights[0]["id"],
+    }
+
+
+@pytest.fixture
+def fflogs(monkeypatch):
+    fflogs = FakeFFLogs([fight(1), fight(2), fight(3)], [death(1, 1), death(2, 1), death(3, 1), death(3, 5)])
+    monkeypatch.setattr(FFLogs.API, "__call_client_endpoint", fflogs)
+    return fflogs
+
+
+def test_delta_starts_with_the_first_fight_after_the_known_ones(fflogs):
+    status, delta = FFLogs.API.try_load_report_delta("token", stored_report([fight(1), fight(2)]))
+    assert status == 200
+    assert [f["id"] for f in delta["fights"]] == [3]
+    assert delta["fights"][0]["startTime"] == START + 1800
+    assert [(d["fight"], d["targetID"]) for d in delta["deaths"]] == [(3, 1), (3, 5)]
+    # only the player who wasn't known yet
+    assert list(delta["player_data"]) == ["5"]
+    assert delta["last_fight_id"] == 3
+    assert delta["endTime"] == START + 2100
+
+    # the known fight is only asked for to check whether it changed, its deaths are not queried again
+    (fight_ids, event_ids), = fflogs.queries
+    assert fight_ids[:2] == [2, 3]
+    assert event_ids == list(range(3, 3 + FFLogs.API.FIGHT_ID_WINDOW))
+
+
+def test_delta_without_new_fights(fflogs):
+    status, delta = FFLogs.API.try_load_report_delta("token", stored_report([fight(1), fight(2), fight(3)]))
+    assert status == 200
+    assert (delta["fights"], delta["deaths"], delta["player_data"]) == ([], [], {})
+    assert delta["last_fight_id"] == 3
+    assert len(fflogs.queries) == 1
+
+
+def test_changed_last_fight_is_not_sent_as_delta(fflogs):
+    # the last fight was still in progress when the report was loaded
+    status, delta = FFLogs.API.try_load_report_delta("token", stored_report([fight(1), fight(2, duration=100_000)]))
+    assert (status, delta) == (200, {"last_fight_changed": True})
+
+
+def test_full_windows_are_followed_by_the_next_one(fflogs, monkeypatch):
+    monkeypatch.setattr(FFLogs.API, "FIGHT_ID_WINDOW", 2)
+    fflogs.fights += [fight(4), fight(5)]
+    status, delta = FFLogs.API.try_load_report_delta("token", stored_report([fight(1)]))
+    assert status == 200
+    assert [f["id"] for f in delta["fights"]] == [5, 4, 3, 2]
+    assert [event_ids for _, event_ids in fflogs.queries] == [[2, 3], [4, 5], [6, 7]]
+    assert delta["last_fight_id"] == 5
@@ -0,0 +1,65 @@
+from flask import Flask
+from views.ajax import ajax_routes
+
+
+class UpdatedBetweenReads:
+    """
+    Stands in for MongoDBConnection: the report is updated between the metadata read and the full read.
+    """
+
+    def __init__(self) -> None:
+        self.version = 1
+        self.loads = []
+
+    def find_or_load_report(self, code: str, token: str, fields=None, load: bool = True, **kwargs) -> tuple:
+        self.loads.append(load)
+        if code == "missing" and not load:
+            return 404, None
+        report = {"code": code, "version": self.version, "loaded_at": 1000.0 + self.version, "title": "Report"}
+        if fields is None:
+            report.update(fights=[], deaths=[], player_data={})
+        self.version += 1
+        return 200, report
+
+
+class PassThroughTokens:
+    def call_with_auth(self, username, auths, provider, call):
+        return call(auths[provider]["token"])
+
+
+def make_client():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.config["MONGO_CLIENT"] = UpdatedBetweenReads()
+    app.config["TOKEN_MANAGER"] = PassThroughTokens()
+    app.register_blueprint(ajax_routes)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "user@example.com"
+        session["auths"] = {"fflogs": {"token": "token"}}
+    return client
+
+
+def test_etag_matches_the_data_sent():
+    client = make_client()
+    response = client.get("/ajax/fflogs/report/payload?code=etagtest", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.json["version"] == 2
+    assert response.get_etag()[0].startswith("etagtest-2-")
+
+
+def test_field_groups_have_their_own_etag():
+    client = make_client()
+    response = client.get("/ajax/fflogs/report/payload?code=fieldstest&fields=fights",
+                          headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "deaths" not in response.json
+    assert response.get_etag()[0].endswith("-fights")
+    assert client.get("/ajax/fflogs/report/payload?code=fieldstest&fields=nope").status_code == 400
+
+
+def test_missing_report_is_not_loaded():
+    client = make_client()
+    response = client.get("/ajax/fflogs/report/payload?code=missing")
+    assert response.status_code == 404
+    assert client.application.config["MONGO_CLIENT"].loads == [False]
@@ -0,0 +1,216 @@
+import time
+import mongomock
+import pytest
+import FFLogs.API
+import DocStore.MongoDB
+from DocStore import Columnar
+from DocStore.MongoDB import MongoDBConnection
+
+START = 1_650_000_000
+
+
+def fight(fight_id: int) -> dict:
+    start = START + fight_id * 600
+    return {"id": fight_id, "encounterID": 1000, "startTime": start, "endTime": start + 300}
+
+
+def death(fight_id: int, second: int, target: int) -> dict:
+    return {"timestamp": START + fight_id * 600 + second, "targetID": target, "fight": fight_id}
+
+
+def report_data(fight_ids: list) -> dict:
+    """
+    A report as FFLogs.API.get_report_data returns it, with two deaths per fight, the second one in the wipe.
+    """
+    return {
+        "code": "abc",
+        "title": "Report",
+        "startTime": START,
+        "endTime": START + 3600,
+        "fights": [fight(fight_id) for fight_id in sorted(fight_ids, reverse=True)],
+        "deaths": [d for fight_id in fight_ids for d in (death(fight_id, 100, 1), death(fight_id, 295, 2))],
+        "player_data": {"1": {"name": "Tank"}, "2": {"name": "Healer"}},
+        "last_queried_death_timestamp": START + max(fight_ids) * 600 + 295,
+        "loaded_at": time.time() - 600,
+    }
+
+
+def delta_data(previous: dict, fight_ids: list) -> dict:
+    """
+    A delta as FFLogs.API.try_load_report_delta returns it.
+    """
+    new = report_data(fight_ids)
+    return {
+        "code": previous["code"],
+        "startTime": previous["startTime"],
+        "endTime": START + 7200,
+        "fights": new["fights"],
+        "deaths": new["deaths"],
+        "player_data": dict(previous["player_data"], **{"3": {"name": "Melee"}}),
+        "last_queried_death_timestamp": new["last_queried_death_timestamp"],
+        "last_fight_id": max(fight_ids),
+        "loaded_at": time.time(),
+    }
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = mongomock.MongoClient()
+    client.VodSync.metadata.insert_one({"name": "encounter_dict", "encounter_mappings": {"0": "Undefined Zone",
+                                                                                         "1000": "Boss"}})
+    monkeypatch.setattr(DocStore.MongoDB, "MongoClient", lambda **kwargs: client)
+    monkeypatch.setattr(FFLogs.API, "get_report_data", lambda token, code, progress=None: (200, report_data([1, 2])))
+    monkeypatch.setattr(FFLogs.API, "try_load_report_delta", lambda token, report: (200, delta_data(report, [3])))
+    return client
+
+
+def connect(columnar: bool = False) -> MongoDBConnection:
+    return MongoDBConnection("mongodb://test", "", 0, cache_max_bytes=0, columnar=columnar)
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_update_adds_a_version_with_only_the_new_fights(client, columnar):
+    mongo = connect(columnar)
+    status, report = mongo.find_or_load_report("abc", "token")
+    assert status == 200
+    assert report["version"] == 1
+
+    status, delta = mongo.update_report("abc", "token")
+    assert status == 200
+    assert delta["version"] == 2
+    assert [f["id"] for f in delta["fights"]] == [3]
+
+    status, delta = mongo.find_report_delta("abc", "token", 1)
+    assert status == 200
+    assert delta["delta"] and delta["version"] == 2
+    assert [f["id"] for f in delta["fights"]] == [3]
+    assert [d["fight"] for d in delta["deaths"]] == [3, 3]
+    assert set(delta["player_data"]) == {"1", "2"}
+    assert list(delta["death_index"]) == ["3"]
+
+    # a client with an unknown version gets the full report
+    status, full = mongo.find_report_delta("abc", "token", 7)
+    assert "delta" not in full
+    assert [f["id"] for f in full["fights"]] == [3, 2, 1]
+    assert len(full["deaths"]) == 6
+
+    # nothing is new since the latest version
+    status, delta = mongo.find_report_delta("abc", "token", 2)
+    assert delta["fights"] == [] and delta["deaths"] == []
+
+
+def test_update_is_not_applied_twice(client, monkeypatch):
+    mongo = connect()
+    mongo.find_or_load_report("abc", "token")
+
+    def refreshed_meanwhile(token, report):
+        # another worker stores its refresh while this one waits for FFLogs
+        client.VodSync.reports.update_one({"code": "abc"}, {"$inc": {"version": 1}})
+        return 200, delta_data(report, [3])
+
+    monkeypatch.setattr(FFLogs.API, "try_load_report_delta", refreshed_meanwhile)
+    status, delta = mongo.update_report("abc", "token")
+    assert (status, delta) == (200, None)
+    stored = client.VodSync.reports.find_one({"code": "abc"})
+    assert stored["version"] == 2
+    assert [f["id"] for f in stored["fights"]] == [2, 1]
+
+
+def test_inline_deaths_are_moved_to_buckets(client):
+    legacy = report_data([1, 2])
+    legacy.update(version=1, versions=[{"version": 1, "fights": 2, "deaths": 4}])
+    client.VodSync.reports.insert_one(legacy)
+    mongo = connect()
+
+    # reports stored before deaths were bucketed are read as they are
+    status, report = mongo.find_or_load_report("abc", "token")
+    assert status == 200
+    assert len(report["deaths"]) == 4
+    assert (report["death_index"]["1"]["start"], report["death_index"]["1"]["count"]) == (0, 2)
+
+    status, delta = mongo.update_report("abc", "token")
+    assert status == 200
+    stored = client.VodSync.reports.find_one({"code": "abc"})
+    assert stored["bucketed"] is True
+    assert "deaths" not in stored
+    assert sorted(bucket["fight"] for bucket in client.VodSync.report_deaths.find({"code": "abc"})) == [1, 2, 3]
+
+    status, report = mongo.find_or_load_report("abc", "token")
+    assert [(d["fight"], d["targetID"]) for d in report["deaths"]] == [(1, 1), (1, 2), (2, 1), (2, 2), (3, 1), (3, 2)]
+    assert report["death_index"]["3"]["start"] == 4
+
+    # the fight ID is stored once per bucket, not in every death
+    bucket = client.VodSync.report_deaths.find_one({"code": "abc", "fight": 2})
+    assert [d["targetID"] for d in bucket["deaths"]] == [1, 2]
+    assert all("fight" not in d for d in bucket["deaths"])
+
+
+def test_unknown_encounter_names_are_queried_and_stored(client, monkeypatch):
+    data = report_data([1, 2])
+    data["fights"][0]["encounterID"] = 2000
+    monkeypatch.setattr(FFLogs.API, "get_report_data", lambda token, code, progress=None: (200, data))
+    queried = []
+
+    def query_for_encounter_names(token, eids):
+        queried.append(sorted(eids))
+        return 200, {2000: "New Boss"}
+
+    monkeypatch.setattr(FFLogs.API, "query_for_encounter_names", query_for_encounter_names)
+    status, report = connect().find_or_load_report("abc", "token")
+    assert status == 200
+    assert queried == [[2000]]
+    assert report["encounternames"] == {1000: "Boss", 2000: "New Boss"}
+    stored = client.VodSync.metadata.find_one({"name": "encounter_dict"})["encounter_mappings"]
+    assert stored["2000"] == "New Boss"
+
+
+def test_changed_last_fight_reloads_the_report(client, monkeypatch):
+    mongo = connect()
+    mongo.find_or_load_report("abc", "token")
+
+    # the last pull was still in progress when the report was loaded, it ends later now
+    def reloaded(token, report, unknown=False):
+        data = report_data([1, 2])
+        data["fights"][0]["endTime"] += 120
+        data["deaths"].append(death(2, 400, 3))
+        return 200, data
+
+    monkeypatch.setattr(FFLogs.API, "try_load_report_delta", lambda token, report: (200, {"last_fight_changed": True}))
+    monkeypatch.setattr(FFLogs.API, "try_update_report", reloaded)
+    status, delta = mongo.update_report("abc", "token")
+    assert status == 200
+    assert delta["full"] and delta["version"] == 2
+    assert delta["fights"][0]["endTime"] == START + 2 * 600 + 420
+
+    status, report = mongo.find_or_load_report("abc", "token")
+    assert [f["id"] for f in report["fights"]] == [2, 1]
+    assert [(d["fight"], d["targetID"]) for d in report["deaths"]][-1] == (2, 3)
+    # clients with the previous version get the full report
+    status, full = mongo.find_report_delta("abc", "token", 1)
+    assert "delta" not in full
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_reports_in_every_storage_format_read_the_same(client, monkeypatch, columnar):
+    monkeypatch.setattr(FFLogs.API, "get_report_data",
+                        lambda token, code, progress=None: (200, dict(report_data([1, 2]), code=code)))
+    data = report_data([1, 2])
+    data.update(version=1, versions=[{"version": 1, "fights": 2, "deaths": 4}])
+    # stored before deaths were bucketed, as lists and in the columnar format
+    client.VodSync.reports.insert_one(dict(data, code="legacy"))
+    client.VodSync.reports.insert_one(Columnar.encode_report(dict(data, code="columnar")))
+    # loaded by either connection, with bucketed deaths
+    connect(columnar=False).find_or_load_report("abc", "token")
+    connect(columnar=True).find_or_load_report("def", "token")
+    mongo = connect(columnar)
+
+    expected = None
+    for code in ("legacy", "columnar", "abc", "def"):
+        status, report = mongo.find_or_load_report(code, "token")
+        assert status == 200
+        content = (report["fights"], [(d["fight"], d["targetID"], d["timestamp"]) for d in report["deaths"]],
+                   report["player_data"], report["death_index"])
+        assert expected is None or content == expected
+        expected = content
+        status, fights = mongo.find_or_load_report(code, "token", fields=["fights"])
+        assert fights["fights"] == report["fights"]
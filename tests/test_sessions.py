@@ -0,0 +1,152 @@
+import pickle
+import time
+import types
+import mongomock
+from flask import Flask, session, request
+import DocStore.Cache
+import DocStore.Sessions
+from DocStore.Sessions import CachedMongoSessionInterface
+
+
+def make_app(collection, cookie_keys=(), secret_key="secret") -> Flask:
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    app.session_interface = CachedMongoSessionInterface(collection, cookie_keys=cookie_keys)
+
+    @app.route("/set")
+    def set_values():
+        session.update(request.args)
+        return ""
+
+    @app.route("/auths")
+    def set_auths():
+        session.setdefault("auths", {})["fflogs"] = {"token": request.args["token"]}
+        # nested values are changed in place, as TokenManager does with refreshed tokens
+        session.modified = True
+        return ""
+
+    @app.route("/get")
+    def get_values():
+        return dict(session)
+
+    @app.route("/logout")
+    def logout():
+        session.clear()
+        return ""
+
+    return app
+
+
+def cookies(client) -> dict:
+    return {cookie.name: cookie.value for cookie in client.cookie_jar}
+
+
+def test_unchanged_session_is_not_written():
+    collection = mongomock.MongoClient().db.sessions
+    client = make_app(collection).test_client()
+    client.get("/set?user=alice")
+    sid, version = cookies(client)["session"].split(".")
+    assert collection.find_one({"id": f"session:{sid}"})["version"] == int(version) == 1
+
+    # reading the session neither writes it nor sets the cookie again
+    response = client.get("/get")
+    assert response.json == {"user": "alice"}
+    assert "Set-Cookie" not in response.headers
+    client.get("/set?user=alice")
+    assert collection.find_one({"id": f"session:{sid}"})["version"] == 1
+
+    # changes of nested values are written, and the cookie names the new version
+    response = client.get("/auths?token=abc")
+    assert collection.find_one({"id": f"session:{sid}"})["version"] == 2
+    assert cookies(client)["session"] == f"{sid}.2"
+    assert pickle.loads(collection.find_one({"id": f"session:{sid}"})["val"])["auths"] == {"fflogs": {"token": "abc"}}
+
+    # a session without data is deleted
+    client.get("/logout")
+    assert collection.count_documents({}) == 0
+    assert "session" not in cookies(client)
+
+
+def test_session_of_another_version_is_read_from_the_database():
+    collection = mongomock.MongoClient().db.sessions
+    client = make_app(collection).test_client()
+    client.get("/set?user=alice")
+    sid = cookies(client)["session"].split(".")[0]
+
+    # another worker changed the session, the browser got its new version from there
+    collection.update_one({"id": f"session:{sid}"}, {"$set": {"val": pickle.dumps({"user": "bob"})},
+                                                     "$inc": {"version": 1}})
+    client.set_cookie("localhost", "session", f"{sid}.2")
+    assert client.get("/get").json == {"user": "bob"}
+
+    # cookies set by Flask-Session only hold the id, they are read and replaced by a versioned one
+    client.set_cookie("localhost", "session", sid)
+    response = client.get("/get")
+    assert response.json == {"user": "bob"}
+    assert cookies(client)["session"] == f"{sid}.2"
+
+
+def test_expired_session_is_not_used(monkeypatch):
+    collection = mongomock.MongoClient().db.sessions
+    app = make_app(collection)
+    client = app.test_client()
+    client.get("/set?user=alice")
+    sid = cookies(client)["session"].split(".")[0]
+
+    # unchanged sessions are written again once a day, to extend their expiration
+    later = time.time() + 2 * 24 * 60 * 60
+    clock = types.SimpleNamespace(time=lambda: later)
+    monkeypatch.setattr(DocStore.Sessions, "time", clock)
+    monkeypatch.setattr(DocStore.Cache, "time", clock)
+    client.get("/set?user=alice")
+    assert collection.find_one({"id": f"session:{sid}"})["version"] == 2
+
+    # past the lifetime of the session, it is gone from the cache and the database, and a new one gets a new id
+    later += app.permanent_session_lifetime.total_seconds()
+    assert cookies(client)["session"] == f"{sid}.2"
+    assert client.get("/get").json == {}
+    client.get("/set?user=carol")
+    assert cookies(client)["session"].split(".")[0] != sid
+
+
+def test_cookie_keys_are_kept_in_a_signed_cookie():
+    collection = mongomock.MongoClient().db.sessions
+    client = make_app(collection, cookie_keys=["user"]).test_client()
+    response = client.get("/set?user=alice")
+    assert collection.count_documents({}) == 0
+    assert "session" not in cookies(client)
+    assert response.headers["Set-Cookie"].startswith("session_data=")
+    assert client.get("/get").json == {"user": "alice"}
+
+    # other keys are stored in the database
+    client.get("/auths?token=abc")
+    assert collection.count_documents({}) == 1
+    assert client.get("/get").json == {"user": "alice", "auths": {"fflogs": {"token": "abc"}}}
+    assert "user" not in pickle.loads(collection.find_one()["val"])
+
+
+def test_tampered_cookie_is_ignored():
+    collection = mongomock.MongoClient().db.sessions
+    client = make_app(collection, cookie_keys=["user"]).test_client()
+    client.get("/set?user=alice")
+    value = cookies(client)["session_data"]
+
+    # a cookie with another payload or a broken signature is ignored
+    client.set_cookie("localhost", "session_data", value.replace(value.split(".")[0], "eyJ1c2VyIjoibWFsbG9yeSJ9"))
+    assert client.get("/get").json == {}
+    client.set_cookie("localhost", "session_data", value[:-2])
+    assert client.get("/get").json == {}
+
+    # a cookie signed with another secret key is ignored as well
+    other = make_app(collection, cookie_keys=["user"], secret_key="other").test_client()
+    other.set_cookie("localhost", "session_data", value)
+    assert other.get("/get").json == {}
+
+
+def test_cookie_keys_need_a_secret_key():
+    collection = mongomock.MongoClient().db.sessions
+    client = make_app(collection, cookie_keys=["user"], secret_key=None).test_client()
+    client.get("/set?user=alice")
+    assert "session_data" not in cookies(client)
+    assert pickle.loads(collection.find_one()["val"]) == {"user": "alice"}
+    assert client.get("/get").json == {"user": "alice"}
@@ -0,0 +1,102 @@
+import threading
+import time
+import mongomock
+from DocStore.SingleFlight import SingleFlight
+
+
+def make_workers(count: int, **kwargs) -> list:
+    """
+    Create SingleFlight instances sharing one lease collection, like workers sharing a database.
+    """
+    leases = mongomock.MongoClient().db.leases
+    return [SingleFlight(leases, poll_interval=0.01, **kwargs) for _ in range(count)]
+
+
+def test_callers_in_one_process_share_the_result():
+    single_flight, = make_workers(1)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def lead():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {"value": 1}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.run("key", lead, lambda: None)))
+               for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 4
+
+
+def test_follower_reads_the_result_of_the_leader():
+    leader, follower = make_workers(2)
+    started, release = threading.Event(), threading.Event()
+    stored = []
+
+    def lead():
+        started.set()
+        release.wait()
+        stored.append("report")
+        return "loaded"
+
+    thread = threading.Thread(target=leader.run, args=("key", lead, lambda: None))
+    thread.start()
+    started.wait()
+    threading.Timer(0.05, release.set).start()
+    result = follower.run("key", lambda: "duplicate", lambda: stored[0] if stored else None)
+    thread.join()
+    assert result == "report"
+
+
+def test_follower_never_runs_without_the_lease():
+    leases = mongomock.MongoClient().db.leases
+    first, follower, third = [SingleFlight(leases, poll_interval=0.01) for _ in range(3)]
+    first.try_lease("key", 60)
+    follows, leads = [], []
+
+    def follow():
+        follows.append(1)
+        if len(follows) == 1:
+            # another worker takes the lease between the release and the follower's attempt to acquire it
+            third.try_lease("key", 60)
+            threading.Timer(0.1, leases.delete_one, args=({"_id": "key"},)).start()
+            return None
+        return "loaded by the third worker"
+
+    threading.Timer(0.05, leases.delete_one, args=({"_id": "key"},)).start()
+    result = follower.run("key", lambda: leads.append(1), follow)
+    assert leads == []
+    assert result == "loaded by the third worker"
+    assert len(follows) == 2
+
+
+def test_lease_is_renewed_while_the_operation_runs():
+    leader, follower = make_workers(2, lease_seconds=1)
+    started, release = threading.Event(), threading.Event()
+    leads = []
+
+    def lead():
+        leads.append("leader")
+        started.set()
+        release.wait()
+        return "loaded"
+
+    thread = threading.Thread(target=leader.run, args=("key", lead, lambda: None))
+    thread.start()
+    started.wait()
+    # the operation takes longer than the lease, the follower must keep waiting
+    threading.Timer(2.5, release.set).start()
+    result = follower.run("key", lambda: leads.append("follower"), lambda: "read" if release.is_set() else None)
+    thread.join()
+    assert leads == ["leader"]
+    assert result == "read"
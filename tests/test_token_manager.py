@@ -0,0 +1,142 @@
+import threading
+import time
+import mongomock
+from DocStore.TokenManager import TokenManager
+
+
+class FakeMongo:
+    """
+    The auth storage of MongoDBConnection, shared by all workers.
+    """
+
+    def __init__(self, auth: dict) -> None:
+        self.auths = {"user": {"fflogs": auth}}
+
+    def get_auth_keys(self, username: str) -> dict:
+        return {provider: dict(auth) for provider, auth in self.auths.get(username, {}).items()}
+
+    def update_provider(self, username: str, provider: str, auth: dict) -> None:
+        self.auths[username][provider] = dict(auth)
+
+    def remove_provider(self, username: str, provider: str) -> None:
+        self.auths[username].pop(provider, None)
+
+
+class FakeRefresher:
+    """
+    A token endpoint which hands out numbered tokens, and rejects refresh tokens which were already used.
+    """
+
+    def __init__(self) -> None:
+        self.refreshes = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, refresh_token: str) -> tuple:
+        self.release.wait(5)
+        if refresh_token in self.refreshes:
+            return 400, None
+        self.refreshes.append(refresh_token)
+        count = len(self.refreshes)
+        return 200, (f"token{count}", f"refresh{count}", 3600)
+
+
+def make_workers(mongo: FakeMongo, refresher: FakeRefresher, count: int = 1, **kwargs) -> list:
+    leases = mongomock.MongoClient().db.leases
+    return [TokenManager(mongo, leases, {"fflogs": refresher}, **kwargs) for _ in range(count)]
+
+
+def accept(valid: set, calls: list):
+    def call(token: str) -> tuple:
+        calls.append(token)
+        return (200, token) if token in valid else (401, None)
+
+    return call
+
+
+def test_expiring_token_is_refreshed_once_across_workers():
+    mongo = FakeMongo({"token": "token0", "refresh_token": "refresh0", "expires_at": time.time() + 5})
+    refresher = FakeRefresher()
+    refresher.release.clear()
+    workers = make_workers(mongo, refresher, count=2)
+
+    results, calls = [], []
+    threads = [threading.Thread(target=lambda worker=worker: results.append(worker.call_with_auth(
+        "user", mongo.get_auth_keys("user"), "fflogs", accept({"token1"}, calls)))) for worker in workers]
+    for thread in threads:
+        thread.start()
+    # the second worker waits for the refresh of the first one
+    time.sleep(0.1)
+    refresher.release.set()
+    for thread in threads:
+        thread.join()
+
+    # the refresh token was only used once, and both workers use its result
+    assert refresher.refreshes == ["refresh0"]
+    assert results == [(200, "token1"), (200, "token1")]
+    assert calls == ["token1", "token1"]
+    assert mongo.auths["user"]["fflogs"]["refresh_token"] == "refresh1"
+
+
+def test_rejected_token_is_refreshed_once():
+    mongo = FakeMongo({"token": "revoked", "refresh_token": "refresh0", "expires_at": time.time() + 3600})
+    refresher = FakeRefresher()
+    worker, = make_workers(mongo, refresher)
+    auths = mongo.get_auth_keys("user")
+
+    calls = []
+    assert worker.call_with_auth("user", auths, "fflogs", accept({"token1"}, calls)) == (200, "token1")
+    assert calls == ["revoked", "token1"]
+    # the refreshed token is stored in the auths of the caller
+    assert auths["fflogs"]["token"] == "token1"
+
+    # a refreshed token which is rejected as well is not refreshed again
+    calls.clear()
+    assert worker.call_with_auth("user", auths, "fflogs", accept(set(), calls)) == (401, None)
+    assert calls == ["token1", "token2"]
+    assert refresher.refreshes == ["refresh0", "refresh1"]
+
+
+def test_rejected_refresh_token_removes_the_auth():
+    mongo = FakeMongo({"token": "token0", "refresh_token": "refresh0", "expires_at": time.time() + 5})
+    refresher = FakeRefresher()
+    refresher.refreshes.append("refresh0")
+    worker, = make_workers(mongo, refresher)
+    auths = mongo.get_auth_keys("user")
+
+    calls = []
+    assert worker.call_with_auth("user", auths, "fflogs", accept({"token1"}, calls)) == (401, None)
+    assert calls == []
+    assert "fflogs" not in auths and "fflogs" not in mongo.auths["user"]
+
+
+def wait_for(condition) -> None:
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_tokens_of_active_users_are_refreshed_in_the_background():
+    # the token is still valid for the call, but expires within refresh_ahead
+    mongo = FakeMongo({"token": "token0", "refresh_token": "refresh0", "expires_at": time.time() + 300})
+    refresher = FakeRefresher()
+    worker, = make_workers(mongo, refresher, poll_interval=0.01)
+
+    calls = []
+    assert worker.call_with_auth("user", mongo.get_auth_keys("user"), "fflogs", accept({"token0"}, calls)) == \
+           (200, "token0")
+    wait_for(lambda: mongo.auths["user"]["fflogs"]["token"] == "token1")
+    # the new token is valid for an hour, so it isn't refreshed again
+    time.sleep(0.05)
+    assert refresher.refreshes == ["refresh0"]
+
+
+def test_tokens_of_inactive_users_are_not_refreshed():
+    mongo = FakeMongo({"token": "token0", "refresh_token": "refresh0", "expires_at": time.time() + 300})
+    refresher = FakeRefresher()
+    worker, = make_workers(mongo, refresher, poll_interval=0.01, active_seconds=0)
+
+    worker.call_with_auth("user", mongo.get_auth_keys("user"), "fflogs", accept({"token0"}, []))
+    time.sleep(0.05)
+    assert refresher.refreshes == []
@@ -0,0 +1,48 @@
+import HTTP.client
+from Twitch.auth import TwitchAuth
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, data: list) -> None:
+        self.status_code = status_code
+        self.data = data
+
+    def json(self) -> dict:
+        return {"data": self.data}
+
+
+def fake_helix(existing: set, rejected: set, calls: list):
+    """
+    A videos endpoint which rejects every call containing one of the rejected IDs with 400, like Helix does.
+    """
+
+    def get(url, params=None, headers=None):
+        ids = [video_id for _, video_id in params]
+        calls.append(ids)
+        if any(video_id in rejected for video_id in ids):
+            return FakeResponse(400, [])
+        found = [{"id": video_id, "title": "title", "user_name": "user", "created_at": "2022-01-01T00:00:00Z"}
+                 for video_id in ids if video_id in existing]
+        return FakeResponse(200 if found else 404, found)
+
+    return get
+
+
+def test_non_numeric_ids_are_not_sent(monkeypatch):
+    calls = []
+    monkeypatch.setattr(HTTP.client, "get", fake_helix({"1", "2"}, set(), calls))
+    status, videos = TwitchAuth("id", "secret").try_get_videos("token", ["1", "abc", "2", "3"])
+    assert status == 200
+    assert calls == [["1", "2", "3"]]
+    assert videos["1"]["id"] == "1" and videos["2"]["id"] == "2"
+    assert videos["abc"] is None and videos["3"] is None
+
+
+def test_rejected_batch_falls_back_to_single_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(HTTP.client, "get", fake_helix({"1", "2"}, {"99999999999999999999"}, calls))
+    status, videos = TwitchAuth("id", "secret").try_get_videos("token", ["1", "99999999999999999999", "2"])
+    assert status == 200
+    assert len(calls) == 4
+    assert videos["1"]["id"] == "1" and videos["2"]["id"] == "2"
+    assert videos["99999999999999999999"] is None
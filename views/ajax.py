@@ -1,9 +1,36 @@
-import requests
+import gzip
+import time
+from typing import Callable, Optional
 from bson import json_util
-from flask import session, request, Blueprint, current_app
+from flask import session, request, Blueprint, current_app, Response
+from DocStore import Columnar
+from DocStore.Cache import LRUCache
+from DocStore.IngestJobs import STAGES
+from DocStore.MongoDB import REPORT_FIELDS, FIGHT_SORT_KEYS, MAX_FIGHT_PAGE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ajax_routes = Blueprint('ajax', __name__)
 
+# Serialized and compressed report payloads, keyed by their ETag. A payload is never modified, a changed report gets a
+# new ETag instead.
+payload_cache = LRUCache(32 * 1024 * 1024)
+PAYLOAD_TTL = 24 * 60 * 60
+
+# Video platforms accepted by the bulk VOD endpoint, and the maximum number of videos per platform and request.
+VOD_PLATFORMS = {"twitch": "Twitch", "youtube": "YouTube"}
+MAX_BULK_VODS = 500
+
+# Seconds between keepalive comments on live report streams, and the reconnection delay for browsers.
+STREAM_KEEPALIVE = 15
+STREAM_RETRY_MS = 5000
+
+# Seconds between updates of viewers who poll a live report, because their worker has no thread left for a stream.
+STREAM_POLL_SECONDS = 30
+
 
 @ajax_routes.route('/ajax/twitch/vod', methods=['GET'])
 def ajax_vod_twitch():
@@ -18,39 +45,20 @@ def ajax_vod_twitch():
     if not video_id:
         return "No video ID provided", 400
 
-    r = requests.get(f"https://api.twitch.tv/helix/videos?id={video_id}",
-                     headers={"Authorization": f"Bearer {session['auths']['twitch']['token']}",
-                              "Client-Id": current_app.config["TWITCH_CLIENT"].get_client_id()})
-
-    if r.status_code == 401:
-        # try to refresh the token once if we get 401 (maybe expired)
-        refresh_status, refresh_data = current_app.config["TWITCH_CLIENT"].try_refresh_twitch_token(
-            refresh_token=session['auths']['twitch']['refresh_token'])
-        if refresh_status != 200:
-            # jank auth, reset and throw error. User will have to re-auth.
-            del session["auths"]["twitch"]
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
+    # VOD metadata never changes, so it is only requested from Twitch once
+    cached, metadata = current_app.config["VOD_CACHE"].get("twitch", video_id)
+    if not cached:
+        status, metadata = __call_with_auth(
+            "twitch", lambda token: current_app.config["TWITCH_CLIENT"].try_get_video(token, video_id))
+        if status == 401:
             return "Authorization Issue. Please manually re-authorize.", 401
-        else:
-            session["auths"]["twitch"]["token"] = refresh_data[0]
-            session["auths"]["twitch"]["refresh_token"] = refresh_data[1]
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-            r = requests.get(f"https://api.twitch.tv/helix/videos?id={video_id}",
-                             headers={"Authorization": f"Bearer {session['auths']['twitch']['token']}",
-                                      "Client-Id": current_app.config["TWITCH_CLIENT"].get_client_id()})
-
-    if r.status_code == 200:
-        if len(r.json()['data']) == 0:
-            return "Video not found", 400
-
-        return {
-            "id": video_id,
-            "title": r.json()['data'][0]['title'],
-            "username": r.json()['data'][0]['user_name'],
-            "created_at": r.json()['data'][0]['created_at']
-        }
-    else:
-        return f"Twitch API returned {r.status_code}.", 400
+        if status != 200:
+            return f"Twitch API returned {status}.", 400
+        current_app.config["VOD_CACHE"].set("twitch", video_id, metadata)
+
+    if metadata is None:
+        return "Video not found", 400
+    return metadata
 
 
 @ajax_routes.route('/ajax/youtube/vod', methods=['GET'])
@@ -66,44 +74,64 @@ def ajax_vod_youtube():
     if not video_id:
         return "No video ID provided", 400
 
-    r = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={video_id}",
-                     headers={"Authorization": f"Bearer {session['auths']['youtube']['token']}"})
-
-    if r.status_code == 401:
-        # try to refresh the token once if we get 401 (maybe expired)
-        refresh_status, refresh_data = current_app.config["YOUTUBE_CLIENT"].try_refresh_youtube_token(
-            refresh_token=session['auths']['youtube']['refresh_token'])
-        if refresh_status != 200:
-            # jank auth, reset and throw error. User will have to re-auth.
-            del session["auths"]["youtube"]
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
+    # video metadata never changes, so it is only requested from YouTube once
+    cached, metadata = current_app.config["VOD_CACHE"].get("youtube", video_id)
+    if not cached:
+        status, metadata = __call_with_auth(
+            "youtube", lambda token: current_app.config["YOUTUBE_CLIENT"].try_get_video(token, video_id))
+        if status == 401:
             return "Authorization Issue", 401
+        if status != 200:
+            return f"YouTube API returned {status}.", 400
+        current_app.config["VOD_CACHE"].set("youtube", video_id, metadata)
+
+    if metadata is None:
+        return "Video not found", 400
+    return metadata
+
+
+@ajax_routes.route('/ajax/vods', methods=['POST'])
+def ajax_vods():
+    """
+    Get info on several Twitch and YouTube VODs at once, e.g. to import a stream list. Expects a JSON body of the form
+    {"twitch": [ids], "youtube": [ids]}. VODs which are not cached are requested with as few upstream calls as possible.
+    :return: JSON data of the form {"twitch": {id: info}, "youtube": {id: info}, "errors": {platform: message}}. The
+    info is null for VODs which were not found. Platforms which could not be queried are listed in errors instead.
+    """
+    if "auths" not in session:
+        return "Not authenticated", 401
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return "No video IDs provided", 400
+
+    result = {"errors": {}}
+    for platform, name in VOD_PLATFORMS.items():
+        video_ids = body.get(platform, [])
+        if not isinstance(video_ids, list) or not all(isinstance(video_id, str) for video_id in video_ids):
+            return f"Invalid {name} video IDs", 400
+        if len(video_ids) > MAX_BULK_VODS:
+            return f"At most {MAX_BULK_VODS} {name} videos can be requested at once", 400
+        if not video_ids:
+            result[platform] = {}
+        elif platform not in session["auths"]:
+            result["errors"][platform] = f"Not authenticated with {name}"
         else:
-            session["auths"]["youtube"]["token"] = refresh_data[0]
-            session["auths"]["youtube"]["refresh_token"] = refresh_data[1]
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-            r = requests.get(f"https://www.googleapis.com/youtube/v3/videos?part=snippet&id={video_id}",
-                             headers={"Authorization": f"Bearer {session['auths']['youtube']['token']}"})
-
-    if r.status_code == 200:
-        data = r.json()['items']
-        if len(data) == 0:
-            return "Video not found", 400
-
-        return {
-            "id": video_id,
-            "title": data[0]['snippet']['title'],
-            "created_at": data[0]['snippet']['publishedAt'],
-            "username": data[0]['snippet']['channelTitle']
-        }
-    else:
-        return f"YouTube API returned {r.status_code}.", 400
+            status, videos = __find_vods(platform, list(dict.fromkeys(video_ids)))
+            if status == 200:
+                result[platform] = videos
+            elif status == 401:
+                result["errors"][platform] = "Authorization Issue. Please manually re-authorize."
+            else:
+                result["errors"][platform] = f"{name} API returned {status}."
+    return result
 
 
 @ajax_routes.route('/ajax/fflogs/report', methods=['GET'])
 def ajax_fflogs_report():
     """
-    Get info on a FFLogs report.
+    Get info on a FFLogs report. With format=columnar, the fights and deaths are sent in the columnar format (see
+    DocStore.Columnar).
     :return: JSON data corresponding to the FFLogs report if the call was successful.
     """
     if "auths" not in session or "fflogs" not in session["auths"]:
@@ -114,34 +142,313 @@ def ajax_fflogs_report():
         return "No report code provided.", 400
 
     else:
-        status, data = current_app.config["MONGO_CLIENT"].find_or_load_report(report,
-                                                                              session["auths"]["fflogs"]["token"],
-                                                                              update=request.args.get(
-                                                                                  "update") == "True",
-                                                                              unknown=request.args.get(
-                                                                                  "unknown") == "True")
+        # optional sparse fieldset, e.g. fields=fights,players or fight=12 for the deaths of a single fight
+        fields = request.args.get("fields").split(",") if request.args.get("fields") else None
+        if fields is not None and not set(fields) <= REPORT_FIELDS.keys():
+            return f"Unknown report fields. Allowed: {', '.join(REPORT_FIELDS)}.", 400
+        fight_id = request.args.get("fight", type=int)
+        columnar = request.args.get("format") == "columnar"
+
+        status, data = __find_or_load_report(report,
+                                             update=request.args.get("update") == "True",
+                                             unknown=request.args.get("unknown") == "True",
+                                             fields=fields,
+                                             fight_id=fight_id,
+                                             since_version=request.args.get("since", type=int))
         if status == 401:
-            # try to refresh the token once if we get 401 (maybe expired)
-            refresh_status, refresh_data = current_app.config["FFLOGS_CLIENT"].try_refresh_fflogs_token(
-                refresh_token=session['auths']['fflogs']['refresh_token'])
-            if refresh_status != 200:
-                # jank auth, reset and throw error. User will have to re-auth.
-                del session["auths"]["fflogs"]
-                current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-                return "Authorization Issue", 401
-            else:
-                session["auths"]["fflogs"]["token"] = refresh_data[0]
-                session["auths"]["fflogs"]["refresh_token"] = refresh_data[1]
-                current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
-                status, data = current_app.config["MONGO_CLIENT"].find_or_load_report(report,
-                                                                                      session["auths"]["fflogs"][
-                                                                                          "token"],
-                                                                                      update=request.args.get(
-                                                                                          "update") == "True",
-                                                                                      unknown=request.args.get(
-                                                                                          "unknown") == "True")
+            return "Authorization Issue", 401
 
         if status == 200:
-            return json_util.dumps(data)
+            return json_util.dumps(Columnar.encode_report(data) if columnar else data)
         else:
             return f"FFLogs API returned {status}.", 400
+
+
+@ajax_routes.route('/ajax/fflogs/report/payload', methods=['GET'])
+def ajax_fflogs_report_payload():
+    """
+    Get the full data of a FFLogs report as a pre-serialized and compressed JSON payload. The payload carries a strong
+    ETag which changes whenever the report is updated, so unchanged reports are answered with 304. With format=columnar,
+    the fights and deaths are sent in the columnar format (see DocStore.Columnar). Like /ajax/fflogs/report, the
+    payload can be limited to field groups, e.g. fields=fights.
+    :return: The JSON payload corresponding to the FFLogs report if the call was successful, 404 if the report is not
+    stored.
+    """
+    if "auths" not in session or "fflogs" not in session["auths"]:
+        return "Not authenticated with FFLogs", 401
+
+    report = request.args.get("code")
+    if not report:
+        return "No report code provided.", 400
+
+    fields = sorted(set(request.args.get("fields").split(","))) if request.args.get("fields") else None
+    if fields is not None and not set(fields) <= REPORT_FIELDS.keys():
+        return f"Unknown report fields. Allowed: {', '.join(REPORT_FIELDS)}.", 400
+
+    # only read the metadata first, the version and load time identify the payload. Reports which are not stored yet
+    # are loaded by ingest jobs (see /ajax/fflogs/report/job), not by this request.
+    status, metadata = __find_or_load_report(report, fields=["metadata"], load=False)
+    if status == 401:
+        return "Authorization Issue", 401
+    if status == 404:
+        return "Report not found.", 404
+    if status != 200:
+        return f"FFLogs API returned {status}.", 400
+
+    encoding = __negotiate_encoding()
+    columnar = request.args.get("format") == "columnar"
+    etag = __payload_etag(report, metadata, encoding, columnar, fields)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = payload_cache.get(etag)
+        if body is None:
+            status, data = __find_or_load_report(report, fields=fields, load=False)
+            if status == 404:
+                return "Report not found.", 404
+            if status != 200:
+                return f"FFLogs API returned {status}.", 400
+            # the report may have been updated since its metadata was read, the ETag must match the data sent
+            etag = __payload_etag(report, data, encoding, columnar, fields)
+            if columnar:
+                data = Columnar.encode_report(data)
+            body = __compress(json_util.dumps(data).encode("utf-8"), encoding)
+            payload_cache.set(etag, body, time.time() + PAYLOAD_TTL)
+        response = Response(body, mimetype="application/json")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    # the browser may store the payload, but has to revalidate it on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@ajax_routes.route('/ajax/fflogs/report/fights', methods=['GET'])
+def ajax_fflogs_report_fights():
+    """
+    Get a page of the fights of a stored FFLogs report. Optional filters: encounter (encounter ID), min_duration (in
+    seconds) and deaths ("true" for fights with deaths, "false" for fights without). The fights are sorted by sort
+    (start, duration or deaths) in order (desc or asc, default desc), and paged by offset and limit.
+    :return: JSON data with the fights on the page and the number of fights matching the filters, see
+    MongoDBConnection.find_fights.
+    """
+    if "auths" not in session or "fflogs" not in session["auths"]:
+        return "Not authenticated with FFLogs", 401
+
+    report = request.args.get("code")
+    if not report:
+        return "No report code provided.", 400
+
+    sort = request.args.get("sort", "start")
+    if sort not in FIGHT_SORT_KEYS:
+        return f"Unknown sort key. Allowed: {', '.join(FIGHT_SORT_KEYS)}.", 400
+    order = request.args.get("order", "desc")
+    if order not in ("asc", "desc"):
+        return "Unknown order. Allowed: asc, desc.", 400
+    deaths = request.args.get("deaths")
+    if deaths not in (None, "true", "false"):
+        return "Unknown deaths filter. Allowed: true, false.", 400
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", 100, type=int)
+    if offset < 0 or not 0 < limit <= MAX_FIGHT_PAGE:
+        return f"Invalid page. The limit has to be between 1 and {MAX_FIGHT_PAGE}.", 400
+
+    status, data = __call_with_auth(
+        "fflogs", lambda token: current_app.config["MONGO_CLIENT"].find_fights(
+            report, token, offset=offset, limit=limit,
+            encounter_id=request.args.get("encounter", type=int),
+            min_duration=request.args.get("min_duration", type=float),
+            has_deaths=None if deaths is None else deaths == "true",
+            sort=sort, descending=order == "desc"))
+    if status == 401:
+        return "Authorization Issue", 401
+    if status == 404:
+        return "Report not found.", 404
+    if status != 200:
+        return f"FFLogs API returned {status}.", 400
+    return json_util.dumps(data)
+
+
+@ajax_routes.route('/ajax/fflogs/report/job', methods=['GET'])
+def ajax_fflogs_report_job():
+    """
+    Get the progress of loading a FFLogs report in the background. The optional since parameter is the last stage the
+    client has the partial report of, so every part of the report is only sent once.
+    :return: JSON data with the status and stage of the job, the number of fights, deaths and players loaded so far,
+    and the fields of the partial report added by the stages after since (see DocStore.IngestJobs.STAGE_FIELDS).
+    """
+    if "auths" not in session or "fflogs" not in session["auths"]:
+        return "Not authenticated with FFLogs", 401
+
+    report = request.args.get("code")
+    if not report:
+        return "No report code provided.", 400
+
+    since = request.args.get("since", "queued")
+    if since not in STAGES:
+        return f"Unknown stage. Allowed: {', '.join(STAGES)}.", 400
+
+    job = current_app.config["INGEST_JOBS"].get_job(report, since)
+    if not job:
+        return "No job found for this report.", 404
+
+    return json_util.dumps({
+        "status": job["status"],
+        "stage": job["stage"],
+        "counts": job.get("counts"),
+        "report": job.get("report"),
+        "result_status": job.get("result_status"),
+    })
+
+
+@ajax_routes.route('/ajax/fflogs/budget', methods=['GET'])
+def ajax_fflogs_budget():
+    """
+    Get the FFLogs API budget shared by all workers for the current hour (see DocStore.RateLimiter).
+    :return: JSON data with the points per hour, the points spent and remaining, the epoch time at which they are
+    reset, and the points left for interactive requests, background refreshes and prefetching.
+    """
+    if "auths" not in session or "fflogs" not in session["auths"]:
+        return "Not authenticated with FFLogs", 401
+
+    return json_util.dumps(current_app.config["FFLOGS_RATE_LIMITER"].get_budget())
+
+
+@ajax_routes.route('/ajax/fflogs/report/stream', methods=['GET'])
+def ajax_fflogs_report_stream():
+    """
+    Follow a FFLogs report live. The report is refreshed from FFLogs on the server at the update cadence, and the new
+    fights, deaths and players are pushed as Server-Sent Events: "delta" (see the since parameter of
+    /ajax/fflogs/report), "full" (the full report, if no delta could be built) and "auth" (the FFLogs token was
+    rejected, the client should make a regular request to refresh it and reconnect). If the worker serves as many
+    streams as it may, the stream only sends a "poll" event with the seconds between updates the client should request
+    itself instead, and ends.
+    :return: The event stream.
+    """
+    if "auths" not in session or "fflogs" not in session["auths"]:
+        return "Not authenticated with FFLogs", 401
+
+    report = request.args.get("code")
+    if not report:
+        return "No report code provided.", 400
+
+    version = request.args.get("since", type=int)
+    if version is None:
+        return "No report version provided.", 400
+
+    live_reports = current_app.config["LIVE_REPORTS"]
+    subscription = live_reports.subscribe(report, session["auths"]["fflogs"]["token"], version)
+    if subscription is None:
+        return Response(f"event: poll\ndata: {STREAM_POLL_SECONDS}\n\n", mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+
+    def stream():
+        try:
+            # let the browser reconnect after a few seconds if the connection drops
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            while True:
+                message = subscription.get(timeout=STREAM_KEEPALIVE)
+                if message is None:
+                    # comments keep proxies from closing the connection and detect disconnected clients
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"event: {message[0]}\ndata: {message[1]}\n\n"
+        finally:
+            live_reports.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def __find_vods(platform: str, video_ids: list) -> (int, Optional[dict]):
+    """
+    Get the metadata of several videos of one platform, from the VOD cache or the platform's API.
+    :param platform: "twitch" or "youtube".
+    :param video_ids: The (unique) video IDs.
+    :return: A tuple of the status code and a dictionary of video ID to metadata (None if not found). If the status is
+    401, the token could not be refreshed and the authorization of the user for the platform was removed.
+    """
+    cache = current_app.config["VOD_CACHE"]
+    videos = {}
+    for video_id in video_ids:
+        cached, metadata = cache.get(platform, video_id)
+        if cached:
+            videos[video_id] = metadata
+    missing = [video_id for video_id in video_ids if video_id not in videos]
+    if not missing:
+        return 200, videos
+
+    client = current_app.config["TWITCH_CLIENT"] if platform == "twitch" else current_app.config["YOUTUBE_CLIENT"]
+    status, fetched = __call_with_auth(platform, lambda token: client.try_get_videos(token, missing))
+    if status != 200:
+        return status, None
+
+    for video_id, metadata in fetched.items():
+        cache.set(platform, video_id, metadata)
+    videos.update(fetched)
+    return 200, videos
+
+
+def __payload_etag(code: str, report: dict, encoding: str, columnar: bool, fields: Optional[list] = None) -> str:
+    """
+    Build the ETag of a report payload.
+    :param code: The report code.
+    :param report: The report, or its metadata. Its version and load time identify the payload.
+    :param encoding: The content encoding of the payload.
+    :param columnar: Whether the payload is in the columnar format.
+    :param fields: The sorted field groups of the payload, or None for the full report.
+    :return: The ETag.
+    """
+    return (f"{code}-{report.get('version', 0)}-{int(report['loaded_at'] * 1000)}-{encoding}"
+            f"{'-columnar' if columnar else ''}{'-' + '.'.join(fields) if fields is not None else ''}")
+
+
+def __find_or_load_report(code: str, **kwargs) -> (int, Optional[dict]):
+    """
+    Find or load a report with the FFLogs token of the current user.
+    :param code: The report code.
+    :param kwargs: Further arguments to MongoDBConnection.find_or_load_report.
+    :return: The status code and the report, see MongoDBConnection.find_or_load_report. If the status is 401, the
+    token could not be refreshed and the FFLogs authorization of the user was removed.
+    """
+    return __call_with_auth(
+        "fflogs", lambda token: current_app.config["MONGO_CLIENT"].find_or_load_report(code, token, **kwargs))
+
+
+def __call_with_auth(provider: str, call: Callable[[str], tuple]) -> (int, Optional[object]):
+    """
+    Call an API with the token of the current user, see TokenManager.call_with_auth.
+    :param provider: "fflogs", "twitch" or "youtube".
+    :param call: The API call. Takes the access token and returns a tuple of the status code and the data.
+    :return: The status code and data of the call. If the status is 401, the token could not be refreshed and the
+    authorization of the user for the provider was removed.
+    """
+    return current_app.config["TOKEN_MANAGER"].call_with_auth(session["user"], session["auths"], provider, call)
+
+
+def __negotiate_encoding() -> str:
+    """
+    Pick the best content encoding the client accepts.
+    :return: "br" (if brotli is installed), "gzip" or "identity".
+    """
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def __compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compress a payload.
+    :param data: The payload.
+    :param encoding: The content encoding, see __negotiate_encoding.
+    :return: The compressed payload.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=9)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9)
+    return data
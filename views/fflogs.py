@@ -1,3 +1,4 @@
+import time
 import uuid
 import pkce
 from flask import redirect, url_for, session, request, Blueprint, current_app
@@ -52,21 +53,24 @@ def auth_verify():
         return redirect(current_app.config["HOST_URL"] + url_for("home"))
 
     # request token with verifier and provided auth code
-    status_code, data = current_app.config["FFLOGS_CLIENT"].try_obtain_token(code, verifier,
-                                                                             current_app.config["HOST_URL"] + url_for(
-                                                                                 "fflogs.auth_verify"))
+    status_code, data = current_app.config["FFLOGS_CLIENT"].try_obtain_token(
+        code, verifier, current_app.config["HOST_URL"] + url_for("fflogs.auth_verify"))
 
-    # if successful, store access token for user and get his username and uid, then return to home
-    if status_code == 200:
-        userdata = FFLogsAPI.get_username(data[0])
-        if userdata:
-            session["auths"]["fflogs"] = {
-                "token": data[0],
-                "username": userdata["name"],
-                "uid": userdata["id"],
-                "refresh_token": data[1]
-            }
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
+    # if successful, get his username and uid
+    userdata = FFLogsAPI.get_username(data[0]) if status_code == 200 else None
+
+    # if successful, store access token for user with his username and uid, then return to home
+    if userdata:
+        auth = {
+            "token": data[0],
+            "username": userdata["name"],
+            "uid": userdata["id"],
+            "refresh_token": data[1],
+            "expires_at": time.time() + data[2]
+        }
+        current_app.config["MONGO_CLIENT"].update_provider(session["user"], "fflogs", auth,
+                                                           session["auths"].get("fflogs"))
+        session["auths"]["fflogs"] = auth
 
     return redirect(url_for('home'))
 
@@ -79,6 +83,6 @@ def auth_signout():
     """
     # signout from FFLogs session => delete the data stored by the FFLogs auth flow, then return home
     if "user" in session and "auths" in session and "fflogs" in session["auths"]:
+        current_app.config["MONGO_CLIENT"].remove_provider(session["user"], "fflogs")
         del session["auths"]["fflogs"]
-        current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
     return redirect(url_for('home'))
@@ -0,0 +1,37 @@
+import hmac
+from flask import request, Blueprint, current_app, Response
+import Metrics.registry
+
+metrics_routes = Blueprint('metrics', __name__)
+
+
+@metrics_routes.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Get the metrics of all workers in the Prometheus text format (see Metrics.registry), and the FFLogs API budget.
+    METRICS_TOKEN has to be sent as a bearer token. Without a token configured, the metrics are not served.
+    :return: The metrics.
+    """
+    token = current_app.config["METRICS_TOKEN"]
+    if not token:
+        return "Metrics are disabled.", 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return "Not authorized.", 401
+
+    series = current_app.config["METRICS"].collect()
+    series += __budget_series(current_app.config["FFLOGS_RATE_LIMITER"].get_budget())
+    return Response(Metrics.registry.render(series), mimetype="text/plain; version=0.0.4")
+
+
+def __budget_series(budget: dict) -> list:
+    """
+    Convert the FFLogs API budget to series. The budget is shared by all workers, so it is read when the metrics are
+    requested rather than added up from the workers.
+    :param budget: The budget (see DocStore.RateLimiter.get_budget).
+    :return: The series.
+    """
+    series = [{"name": "vodsync_fflogs_points", "labels": {"kind": kind}, "values": [budget[kind]]}
+              for kind in ("limit", "spent", "remaining")]
+    series += [{"name": "vodsync_fflogs_points_available", "labels": {"priority": priority}, "values": [points]}
+               for priority, points in budget["available"].items()]
+    return series
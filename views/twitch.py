@@ -1,3 +1,4 @@
+import time
 import uuid
 from flask import redirect, url_for, session, request, Blueprint, current_app
 twitch_routes = Blueprint('twitch', __name__)
@@ -19,7 +20,7 @@ def auth_challenge():
 
 
 @twitch_routes.route('/auth/twitch/verify')
-async def auth_verify():
+def auth_verify():
     """
     Twitch auth callback. Verify the state and store the token in the session.
     :return: Redirect to home page.
@@ -35,18 +36,21 @@ async def auth_verify():
         return redirect(current_app.config["HOST_URL"] + url_for("home"))
 
     # try to get a token with the code
-    status_token, data = current_app.config["TWITCH_CLIENT"].try_obtain_token(code, current_app.config["HOST_URL"]
-                                                                              + url_for("twitch.auth_verify"))
+    status_token, data = current_app.config["TWITCH_CLIENT"].try_obtain_token(
+        code, current_app.config["HOST_URL"] + url_for("twitch.auth_verify"))
     # store twitch token and refresh token user auths if successful
     if status_token == 200:
         status_name, name = current_app.config["TWITCH_CLIENT"].try_get_username(data[0])
         if status_name == 200:
-            session["auths"]["twitch"] = {
+            auth = {
                 "token": data[0],
                 "refresh_token": data[1],
+                "expires_at": time.time() + data[2],
                 "username": name
             }
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
+            current_app.config["MONGO_CLIENT"].update_provider(session["user"], "twitch", auth,
+                                                               session["auths"].get("twitch"))
+            session["auths"]["twitch"] = auth
     return redirect(current_app.config["HOST_URL"] + url_for("home"))
 
 
@@ -58,6 +62,6 @@ def auth_signout():
     """
     # signout from twitch session => delete the data stored by the twitch auth flow, then return home
     if "user" in session and "auths" in session and "twitch" in session["auths"]:
+        current_app.config["MONGO_CLIENT"].remove_provider(session["user"], "twitch")
         del session["auths"]["twitch"]
-        current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
     return redirect(url_for('home'))
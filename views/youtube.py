@@ -1,3 +1,4 @@
+import time
 from flask import redirect, url_for, session, request, Blueprint, current_app
 youtube_routes = Blueprint('youtube', __name__)
 
@@ -38,12 +39,15 @@ def auth_verify():
     if status_code == 200:
         status_name, name = current_app.config["YOUTUBE_CLIENT"].try_get_username(data[0])
         if status_name == 200:
-            session["auths"]["youtube"] = {
+            auth = {
                 "token": data[0],
                 "refresh_token": data[1],
+                "expires_at": time.time() + data[2],
                 "username": name
             }
-            current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
+            current_app.config["MONGO_CLIENT"].update_provider(session["user"], "youtube", auth,
+                                                               session["auths"].get("youtube"))
+            session["auths"]["youtube"] = auth
 
     return redirect(url_for('home'))
 
@@ -56,6 +60,6 @@ def auth_signout():
     """
     # Delete the data stored by the YouTube auth flow, then return home
     if "user" in session and "auths" in session and "youtube" in session["auths"]:
+        current_app.config["MONGO_CLIENT"].remove_provider(session["user"], "youtube")
         del session["auths"]["youtube"]
-        current_app.config["MONGO_CLIENT"].store_auth_keys(session["user"], session["auths"])
     return redirect(url_for('home'))